@@ -1,53 +1,135 @@
 import os
 import json
-import subprocess
+import hashlib
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
-def generate_icons(source_image_path):
+from PIL import Image
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.join(SCRIPT_DIR, "z-image", "Assets.xcassets", "AppIcon.appiconset")
+ICNS_PATH = os.path.join(SCRIPT_DIR, "AppIcon.icns")
+# Windows 图标，供 zimagepython/ZImage_Generator.spec 打包使用
+ICO_PATH = os.path.join(SCRIPT_DIR, "..", "zimagepython", "logo.ico")
+STAMP_PATH = os.path.join(BASE_DIR, ".source.sha256")
+# 输出内容或格式变化时递增，使旧的 stamp 失效
+PIPELINE_VERSION = 1
+
+# Define the required sizes for macOS
+# (Size in points, Scale)
+SIZES = [
+    (16, 1), (16, 2),
+    (32, 1), (32, 2),
+    (128, 1), (128, 2),
+    (256, 1), (256, 2),
+    (512, 1), (512, 2),
+    (1024, 1), (1024, 2),
+]
+ICNS_SIZES = [16, 32, 64, 128, 256, 512, 1024]
+ICO_SIZES = [16, 24, 32, 48, 64, 128, 256]
+
+
+def source_digest(data):
+    return hashlib.sha256(data + f"|v{PIPELINE_VERSION}".encode()).hexdigest()
+
+
+def mac_filename(point_size, scale):
+    return f"icon_{point_size}x{point_size}_{scale}x.png"
+
+
+def outputs_exist():
+    paths = [os.path.join(BASE_DIR, mac_filename(p, s)) for p, s in SIZES]
+    paths += [os.path.join(BASE_DIR, "Contents.json"), ICNS_PATH, ICO_PATH]
+    return all(os.path.exists(p) for p in paths)
+
+
+def is_up_to_date(digest):
+    try:
+        with open(STAMP_PATH, "r") as f:
+            return f.read().strip() == digest and outputs_exist()
+    except OSError:
+        return False
+
+
+def build_sizes(source, pixel_sizes):
+    """Resize the decoded source to every pixel size.
+
+    Sizes at or above the source resolution are scaled from the source directly. Smaller
+    sizes cascade: each comes from the smallest image already produced that is still
+    larger, so every LANCZOS step is a small ratio and the large source is read only once.
+    """
+    images = {}
+    for size in sorted(set(pixel_sizes), reverse=True):
+        # 只从缩小得到的图像继续级联，放大的尺寸不作为缩小的来源
+        larger = [s for s in images if size < s <= source.width]
+        base = images[min(larger)] if larger else source
+        images[size] = base if base.size == (size, size) else base.resize((size, size), Image.LANCZOS)
+    return images
+
+
+def write_png(image, path):
+    image.save(path, format="PNG", optimize=True)
+
+
+def write_icns(images):
+    largest = max(ICNS_SIZES)
+    images[largest].save(ICNS_PATH, format="ICNS",
+                         append_images=[images[s] for s in ICNS_SIZES if s != largest])
+
+
+def write_ico(images):
+    largest = max(ICO_SIZES)
+    images[largest].save(ICO_PATH, format="ICO", sizes=[(s, s) for s in ICO_SIZES],
+                         append_images=[images[s] for s in ICO_SIZES if s != largest])
+
+
+def generate_icons(source_image_path, force=False):
     if not os.path.exists(source_image_path):
         print(f"Error: Source image '{source_image_path}' not found.")
         return
 
-    base_dir = "z-image/Assets.xcassets/AppIcon.appiconset"
-    if not os.path.exists(base_dir):
-        os.makedirs(base_dir)
+    with open(source_image_path, "rb") as f:
+        data = f.read()
+    digest = source_digest(data)
+    if not force and is_up_to_date(digest):
+        print("✅ Icons are up to date (source unchanged), nothing to do.")
+        return
+
+    os.makedirs(BASE_DIR, exist_ok=True)
 
-    # Define the required sizes for macOS
-    # (Size in points, Scale)
-    sizes = [
-        (16, 1), (16, 2),
-        (32, 1), (32, 2),
-        (128, 1), (128, 2),
-        (256, 1), (256, 2),
-        (512, 1), (512, 2),
-        (1024, 1), (1024, 2),
+    # 只解码一次源图，所有尺寸都由内存中的图像缩放得到
+    with Image.open(source_image_path) as im:
+        source = im.convert("RGBA")
+        source.load()
+    if source.width != source.height:
+        side = max(source.size)
+        square = Image.new("RGBA", (side, side), (0, 0, 0, 0))
+        square.paste(source, ((side - source.width) // 2, (side - source.height) // 2))
+        source = square
 
-    ]
+    pixel_sizes = [p * s for p, s in SIZES] + ICNS_SIZES + ICO_SIZES
+    images = build_sizes(source, pixel_sizes)
 
     images_json = []
+    jobs = []
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as pool:
+        # Pillow 在编码时释放 GIL，PNG / ICNS / ICO 可以并行写出
+        for point_size, scale in SIZES:
+            filename = mac_filename(point_size, scale)
+            jobs.append(pool.submit(write_png, images[point_size * scale], os.path.join(BASE_DIR, filename)))
+            images_json.append({
+                "size": f"{point_size}x{point_size}",
+                "idiom": "mac",
+                "filename": filename,
+                "scale": f"{scale}x"
+            })
+        jobs.append(pool.submit(write_icns, images))
+        jobs.append(pool.submit(write_ico, images))
+        for job in jobs:
+            job.result()
 
-    # Process macOS icons
-    for point_size, scale in sizes:
-        pixel_size = point_size * scale
-        filename = f"icon_{point_size}x{point_size}_{scale}x.png"
-        filepath = os.path.join(base_dir, filename)
-        
-        # Use sips to resize (standard macOS tool)
-        cmd = ["sips", "-z", str(pixel_size), str(pixel_size), source_image_path, "--out", filepath]
-        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
-        
-        images_json.append({
-            "size": f"{point_size}x{point_size}",
-            "idiom": "mac",
-            "filename": filename,
-            "scale": f"{scale}x"
-        })
-
-    # Add a 1024x1024 icon for App Store (universal) - Note: 512pt @ 2x covers this, but sometimes a separate marketing icon is kept.
-    # However, for macOS 'mac' idiom, 512x512@2x IS the 1024x1024 icon. 
-    # The warning "Unknown idiom value 'ios'" suggests we should NOT add an ios entry.
-    # We will skip adding the explicit 'ios' 1024 entry as it's redundant/invalid for this target.
-    
+    # For the macOS 'mac' idiom, 512x512@2x IS the 1024x1024 icon, so no separate
+    # 'ios' marketing entry is added (Xcode warns "Unknown idiom value 'ios'").
     contents = {
         "images": images_json,
         "info": {
@@ -56,14 +138,21 @@ def generate_icons(source_image_path):
         }
     }
 
-    with open(os.path.join(base_dir, "Contents.json"), "w") as f:
+    with open(os.path.join(BASE_DIR, "Contents.json"), "w") as f:
         json.dump(contents, f, indent=2)
 
-    print("✅ Icons generated successfully in " + base_dir)
+    # 最后写入 stamp：中途失败时下次会完整重建
+    with open(STAMP_PATH, "w") as f:
+        f.write(digest)
+
+    print("✅ Icons generated successfully in " + BASE_DIR)
+    print("✅ " + ICNS_PATH)
+    print("✅ " + os.path.normpath(ICO_PATH))
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python3 generate_icon.py <path_to_source_image>")
+    args = [a for a in sys.argv[1:] if a != "--force"]
+    if len(args) < 1:
+        print("Usage: python3 generate_icon.py <path_to_source_image> [--force]")
         sys.exit(1)
-    
-    generate_icons(sys.argv[1])
+
+    generate_icons(args[0], force="--force" in sys.argv[1:])
@@ -0,0 +1,87 @@
+# -*- mode: python ; coding: utf-8 -*-
+# 目录版 (onedir) 打包：启动时无需解压整个运行时，适合追求启动速度的发布。
+# 用法: pyinstaller --noconfirm ZImage_Generator_onedir.spec  (输出 dist/ZImage_Generator/)
+import re
+
+# 只用到 QtCore / QtGui / QtWidgets，其余 Qt 模块全部排除
+QT_EXCLUDES = [
+    'PySide6.' + m for m in (
+        'QtNetwork', 'QtQml', 'QtQuick', 'QtQuickWidgets', 'QtQuickControls2', 'QtWebEngineCore',
+        'QtWebEngineWidgets', 'QtWebEngineQuick', 'QtWebChannel', 'QtWebSockets', 'QtHttpServer',
+        'QtMultimedia', 'QtMultimediaWidgets', 'QtSpatialAudio', 'QtTextToSpeech',
+        'Qt3DCore', 'Qt3DRender', 'Qt3DInput', 'Qt3DLogic', 'Qt3DAnimation', 'Qt3DExtras',
+        'QtCharts', 'QtDataVisualization', 'QtGraphs', 'QtPdf', 'QtPdfWidgets', 'QtSql', 'QtTest',
+        'QtBluetooth', 'QtNfc', 'QtPositioning', 'QtLocation', 'QtSensors', 'QtSerialPort', 'QtSerialBus',
+        'QtDesigner', 'QtUiTools', 'QtHelp', 'QtOpenGL', 'QtOpenGLWidgets', 'QtSvg', 'QtSvgWidgets',
+        'QtXml', 'QtPrintSupport', 'QtConcurrent', 'QtDBus', 'QtRemoteObjects', 'QtScxml',
+        'QtStateMachine', 'QtAxContainer',
+    )
+]
+PY_EXCLUDES = ['tkinter', 'lib2to3', 'pydoc_data', 'test', 'idlelib', 'PIL.ImageTk', 'PIL.ImageQt']
+
+# 保留的 Qt 插件目录；imageformats 只保留用到的格式
+KEEP_PLUGIN_DIRS = {'platforms', 'platformthemes', 'platforminputcontexts', 'styles', 'iconengines',
+                    'xcbglintegrations'}
+KEEP_IMAGE_FORMATS = ('qjpeg', 'qico', 'qgif', 'qwebp')
+DROP_FILES = ('opengl32sw.dll',) # 软件 OpenGL 渲染器，纯 Widgets 界面用不到
+
+
+def keep_entry(entry):
+    dest = '/' + entry[0].replace('\\', '/')
+    name = dest.rsplit('/', 1)[-1]
+    if '/translations/' in dest or name.lower() in DROP_FILES:
+        return False
+    m = re.search(r'/plugins/([^/]+)/[^/]+$', dest)
+    if m:
+        category = m.group(1)
+        if category == 'imageformats':
+            stem = name.lower()[3:] if name.lower().startswith('lib') else name.lower()
+            return stem.startswith(KEEP_IMAGE_FORMATS)
+        return category in KEEP_PLUGIN_DIRS or category.startswith('wayland')
+    return True
+
+
+a = Analysis(
+    ['zimage_ui.py'],
+    pathex=[],
+    binaries=[],
+    datas=[('logo.ico', '.'), ('logo.png', '.'), ('user_avatar.png', '.')],
+    hiddenimports=[],
+    hookspath=[],
+    hooksconfig={},
+    runtime_hooks=[],
+    excludes=QT_EXCLUDES + PY_EXCLUDES,
+    noarchive=False,
+    optimize=2,
+)
+a.binaries = [e for e in a.binaries if keep_entry(e)]
+a.datas = [e for e in a.datas if keep_entry(e)]
+pyz = PYZ(a.pure)
+
+exe = EXE(
+    pyz,
+    a.scripts,
+    [],
+    exclude_binaries=True,
+    name='ZImage_Generator',
+    debug=False,
+    bootloader_ignore_signals=False,
+    strip=False,
+    upx=False, # UPX 会让每次启动都付出解压代价
+    console=False,
+    disable_windowed_traceback=False,
+    argv_emulation=False,
+    target_arch=None,
+    codesign_identity=None,
+    entitlements_file=None,
+    icon=['logo.ico'],
+)
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=False,
+    upx_exclude=[],
+    name='ZImage_Generator',
+)
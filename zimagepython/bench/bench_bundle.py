@@ -0,0 +1,132 @@
+"""
+打包产物对比 (Bundle Size & Cold-Start Check)
+
+分别用 ZImage_Generator.spec (单文件 + UPX) 与 ZImage_Generator_onedir.spec (目录版) 打包，
+比较产物体积与启动耗时。可在 Linux 上运行（需要 PyInstaller，启动使用 Qt offscreen 平台）：
+
+    python bench/bench_bundle.py --runs 5
+    python bench/bench_bundle.py --skip-build      # 复用上次的打包结果
+
+启动耗时由应用以 --startup-probe 运行时写入 logs/startup.jsonl（从进程启动到首次绘制）。
+以 root 运行时每次启动前会清空页缓存以测量真正的冷启动。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+WORK_DIR = os.path.join(APP_DIR, "bench_results", "bundle")
+EXE_NAME = "ZImage_Generator" + (".exe" if sys.platform == "win32" else "")
+VARIANTS = {
+    "onefile": ("ZImage_Generator.spec", lambda dist: os.path.join(dist, EXE_NAME)),
+    "onedir": ("ZImage_Generator_onedir.spec", lambda dist: os.path.join(dist, "ZImage_Generator", EXE_NAME)),
+}
+
+
+def build(variant):
+    spec, exe_path = VARIANTS[variant]
+    dist = os.path.join(WORK_DIR, variant, "dist")
+    work = os.path.join(WORK_DIR, variant, "build")
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "PyInstaller", "--noconfirm", "--clean",
+                    "--distpath", dist, "--workpath", work, spec], cwd=APP_DIR, check=True)
+    return exe_path(dist), round(time.perf_counter() - start, 1)
+
+
+def bundle_size(exe):
+    if os.path.basename(os.path.dirname(exe)) == "ZImage_Generator":
+        root = os.path.dirname(exe)
+        total, files = 0, 0
+        for dirpath, _, names in os.walk(root):
+            for name in names:
+                total += os.path.getsize(os.path.join(dirpath, name))
+                files += 1
+        return {"bytes": total, "files": files}
+    return {"bytes": os.path.getsize(exe), "files": 1}
+
+
+def drop_caches():
+    """Drop the Linux page cache so the next launch reads everything from disk (root only)."""
+    if sys.platform != "linux" or os.geteuid() != 0:
+        return False
+    try:
+        subprocess.run(["sync"], check=True)
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3")
+        return True
+    except OSError:
+        return False
+
+
+def launch(exe, cold):
+    log = os.path.join(os.path.dirname(exe), "logs", "startup.jsonl")
+    if os.path.exists(log):
+        os.remove(log)
+    dropped = drop_caches() if cold else False
+    env = dict(os.environ, QT_QPA_PLATFORM="offscreen", ZIMAGE_LAUNCH_TS=repr(time.time()))
+    start = time.perf_counter()
+    subprocess.run([exe, "--startup-probe"], env=env, cwd=os.path.dirname(exe), timeout=180,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wall_ms = round((time.perf_counter() - start) * 1000, 1)
+    record = {}
+    if os.path.exists(log):
+        with open(log, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        if lines:
+            record = json.loads(lines[-1])
+    return {"cold": dropped, "process_wall_ms": wall_ms, **record}
+
+
+def median(values):
+    values = sorted(v for v in values if v is not None)
+    return values[len(values) // 2] if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare onefile and onedir bundles")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--skip-build", action="store_true")
+    parser.add_argument("--variants", default="onefile,onedir")
+    parser.add_argument("--out", default=os.path.join(WORK_DIR, "bundle_report.json"))
+    args = parser.parse_args()
+
+    try:
+        import PyInstaller  # noqa: F401
+    except ImportError:
+        print("PyInstaller is required: pip install pyinstaller")
+        sys.exit(2)
+
+    report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "platform": sys.platform, "variants": {}}
+    for variant in args.variants.split(","):
+        if args.skip_build:
+            exe, build_s = VARIANTS[variant][1](os.path.join(WORK_DIR, variant, "dist")), None
+        else:
+            exe, build_s = build(variant)
+        if not os.path.exists(exe):
+            print(f"[{variant}] executable not found: {exe}")
+            continue
+        runs = [launch(exe, cold=True)] + [launch(exe, cold=False) for _ in range(args.runs - 1)]
+        report["variants"][variant] = {
+            "executable": exe,
+            "build_s": build_s,
+            "size": bundle_size(exe),
+            "first_start_ms": runs[0].get("since_launch_ms"),
+            "warm_start_median_ms": median(r.get("since_launch_ms") for r in runs[1:]),
+            "runs": runs,
+        }
+
+    os.makedirs(os.path.dirname(args.out), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    for variant, r in report["variants"].items():
+        print(f"{variant:<8} size={r['size']['bytes'] / 1e6:8.1f} MB ({r['size']['files']} files)  "
+              f"first start={r['first_start_ms']} ms  warm median={r['warm_start_median_ms']} ms")
+    print(f"Report written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+内存占用基准 (Gallery Memory Benchmark)
+
+在隔离目录中以 Qt offscreen 方式启动主窗口，对本地模拟服务连续生成 N 张图片
+（走真实的 ImageGeneratorThread -> on_generation_finished 流程），记录进程 RSS 的增长。
+可用 --rev 与旧版本对比，例如比较图片缓存上线前后的内存：
+
+    python bench/bench_memory.py --generations 500 --size 2048x2048 --rev HEAD~1
+"""
+import argparse
+import datetime
+import gc
+import importlib.util
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+
+def rss_bytes():
+    """Current resident set size (Linux /proc, psutil if available, else peak RSS)."""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        import resource
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def stepping_datetime():
+    """Stand-in for the app's `datetime` module: every now() is one second later, so the
+    second-resolution output file names stay unique however fast the mock server answers."""
+    ticks = (datetime.datetime(2030, 1, 1) + datetime.timedelta(seconds=i) for i in itertools.count())
+    return types.SimpleNamespace(datetime=types.SimpleNamespace(now=lambda *args: next(ticks)),
+                                 timedelta=datetime.timedelta)
+
+
+def child(script, generations, size, sample_every):
+    """Run inside the sandbox: drive `generations` generations through the real window."""
+    from PySide6.QtWidgets import QApplication
+    from PySide6.QtCore import QEventLoop
+    from mock_modelscope import MockConfig, MockModelScope
+
+    spec = importlib.util.spec_from_file_location("zimage_ui", script)
+    app_module = importlib.util.module_from_spec(spec)
+    sys.modules["zimage_ui"] = app_module
+    spec.loader.exec_module(app_module)
+
+    server = MockModelScope(MockConfig(submit_latency=0, queue_time=0, gen_time=0)).start()
+    app_module.API_BASE_URL = server.base_url
+    app_module.POLL_INTERVAL = 0.01
+    app_module.datetime = stepping_datetime()
+
+    app = QApplication([script])
+    window = app_module.MainWindow()
+    window.show()
+    app.processEvents()
+
+    samples = [{"generations": 0, "rss_mb": round(rss_bytes() / 1e6, 1)}]
+    errors = []
+    start = time.perf_counter()
+    for i in range(1, generations + 1):
+        loop = QEventLoop()
+        thread = app_module.ImageGeneratorThread("bench-key", "mock/model", f"memory prompt {i}", size)
+        thread.finished.connect(window.on_generation_finished)
+        thread.finished.connect(loop.quit)
+        thread.error.connect(errors.append)
+        thread.error.connect(loop.quit)
+        # 与 start_generation 相同：只保留最近一个线程的引用 (旧版本使用 window.thread)
+        if hasattr(window, "generation_thread"):
+            window.generation_thread = thread
+        else:
+            window.thread = thread
+        thread.start()
+        loop.exec()
+        thread.wait()
+        app.processEvents()
+        if i % sample_every == 0 or i == generations:
+            samples.append({"generations": i, "rss_mb": round(rss_bytes() / 1e6, 1)})
+            # 逐条输出：子进程因内存不足被杀死时，父进程仍能报告已测得的部分
+            print("MEMORY_SAMPLE " + json.dumps(samples[-1]), flush=True)
+    gc.collect()
+    app.processEvents()
+    result = {
+        "generations": generations,
+        "errors": len(errors),
+        "elapsed_s": round(time.perf_counter() - start, 1),
+        "final_rss_mb": round(rss_bytes() / 1e6, 1),
+        "samples": samples,
+    }
+    cache = getattr(app_module, "IMAGE_CACHE", None)
+    if cache is not None:
+        result["image_cache"] = {"budget_mb": round(cache.budget / 1e6, 1), "used_mb": round(cache.used / 1e6, 1),
+                                 "entries": len(cache.entries), **cache.stats}
+    server.stop()
+    print("MEMORY_RESULT " + json.dumps(result), flush=True)
+
+
+def script_at_rev(rev):
+    rel = os.path.relpath(os.path.join(APP_DIR, "zimage_ui.py"),
+                          subprocess.check_output(["git", "rev-parse", "--show-toplevel"], cwd=APP_DIR,
+                                                  text=True).strip())
+    return subprocess.check_output(["git", "show", f"{rev}:{rel.replace(os.sep, '/')}"], cwd=APP_DIR)
+
+
+def measure(label, content, args):
+    sandbox = tempfile.mkdtemp(prefix="zimage_memory_")
+    try:
+        script = os.path.join(sandbox, "zimage_ui.py")
+        with open(script, "wb") as f:
+            f.write(content)
+        env = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", script,
+                               "--generations", str(args.generations), "--size", args.size,
+                               "--sample-every", str(args.sample_every)],
+                              env=env, capture_output=True, text=True, cwd=sandbox)
+        samples = []
+        for line in proc.stdout.splitlines():
+            if line.startswith("MEMORY_RESULT "):
+                return {"label": label, **json.loads(line[len("MEMORY_RESULT "):])}
+            if line.startswith("MEMORY_SAMPLE "):
+                samples.append(json.loads(line[len("MEMORY_SAMPLE "):]))
+        print(f"[{label}] run failed (exit code {proc.returncode}):\n{proc.stderr[-2000:]}")
+        if not samples:
+            return None
+        # 未完成 (通常是 OOM 被杀死)：报告最后一次采样
+        return {"label": label, "generations": samples[-1]["generations"], "errors": 0, "elapsed_s": None,
+                "final_rss_mb": samples[-1]["rss_mb"], "samples": [{"generations": 0, "rss_mb": None}] + samples,
+                "incomplete": True, "exit_code": proc.returncode}
+    finally:
+        shutil.rmtree(sandbox, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ZImage gallery memory benchmark")
+    parser.add_argument("--generations", type=int, default=500)
+    parser.add_argument("--size", default="2048x2048", help="模拟服务返回的图片尺寸")
+    parser.add_argument("--sample-every", type=int, default=50)
+    parser.add_argument("--rev", default=None, help="同时测量某个 git 版本的 zimage_ui.py 作为对照")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.generations, args.size, args.sample_every)
+        return
+
+    with open(os.path.join(APP_DIR, "zimage_ui.py"), "rb") as f:
+        runs = [("current", f.read())]
+    if args.rev:
+        runs.append((args.rev, script_at_rev(args.rev)))
+    results = [r for r in (measure(label, content, args) for label, content in runs) if r]
+
+    for r in results:
+        if r.get("incomplete"):
+            print(f"== {r['label']}: stopped after {r['generations']} of {args.generations} generations "
+                  f"(exit code {r['exit_code']}), RSS {r['final_rss_mb']} MB at the last sample")
+        else:
+            growth = r["final_rss_mb"] - r["samples"][0]["rss_mb"]
+            print(f"== {r['label']}: {r['generations']} generations ({r['errors']} errors) in {r['elapsed_s']}s, "
+                  f"RSS {r['samples'][0]['rss_mb']} -> {r['final_rss_mb']} MB (+{growth:.1f} MB)")
+        for s in r["samples"]:
+            if s["rss_mb"] is not None:
+                print(f"    {s['generations']:>6}  {s['rss_mb']:>9.1f} MB")
+        if "image_cache" in r:
+            print(f"    image cache: {r['image_cache']}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
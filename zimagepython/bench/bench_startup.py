@@ -0,0 +1,183 @@
+"""
+启动耗时基准 (Startup Benchmark)
+
+在隔离的临时目录中启动 zimage_ui.py（Qt offscreen 平台），输出 `-X importtime` 导入耗时排行，
+以及从进程启动到窗口首次显示的时间。可用 --rev 与历史版本对比：
+
+    python bench/bench_startup.py --rev HEAD~1 --history 300 --no-avatar --offline
+
+--no-avatar 删除 user_avatar.png，--offline 让外网请求挂起直到超时（模拟断网首次启动）。
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+RESOURCES = ["logo.ico", "logo.png", "user_avatar.png"]
+BLACKHOLE_PROXY = "http://10.255.255.1:9" # 不可路由地址：连接会一直挂起直到超时
+
+
+def probe(script):
+    """Run `script` as __main__, report timings once the first event-loop turn after show() completes."""
+    t_start = time.perf_counter()
+    launch_ts = float(os.environ.get("ZIMAGE_LAUNCH_TS", "0") or 0)
+    import PySide6.QtWidgets as QtWidgets
+    from PySide6.QtCore import QTimer
+    marks = {}
+
+    class ProbeApp(QtWidgets.QApplication):
+        def __init__(self, *args):
+            marks["app_ms"] = (time.perf_counter() - t_start) * 1000
+            super().__init__(*args)
+
+        def exec(self):
+            marks["exec_ms"] = (time.perf_counter() - t_start) * 1000
+
+            def report():
+                marks["shown_ms"] = (time.perf_counter() - t_start) * 1000
+                if launch_ts:
+                    marks["since_launch_ms"] = (time.time() - launch_ts) * 1000
+                print("STARTUP_PROBE " + json.dumps({k: round(v, 1) for k, v in marks.items()}), flush=True)
+                self.quit()
+
+            QTimer.singleShot(0, report)
+            return super().exec()
+
+    QtWidgets.QApplication = ProbeApp
+    sys.argv = [script]
+    import runpy
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit:
+        pass
+
+
+def prepare_sandbox(source_script, history, no_avatar):
+    """Copy the app script and resources into a temp dir with an optional synthetic history."""
+    root = tempfile.mkdtemp(prefix="zimage_startup_")
+    shutil.copy(source_script, os.path.join(root, "zimage_ui.py"))
+    for name in RESOURCES:
+        if no_avatar and name == "user_avatar.png":
+            continue
+        src = os.path.join(APP_DIR, name)
+        if os.path.exists(src):
+            shutil.copy(src, root)
+    if history:
+        sys.path.insert(0, BENCH_DIR)
+        from mock_modelscope import make_jpeg
+        out_dir = os.path.join(root, "zimage")
+        os.makedirs(out_dir, exist_ok=True)
+        data = make_jpeg(1024, 1024)
+        for i in range(history):
+            stem = os.path.join(out_dir, f"img_startup_{i:05d}")
+            with open(stem + ".jpg", "wb") as f:
+                f.write(data)
+            with open(stem + ".json", "w", encoding="utf-8") as f:
+                json.dump({"prompt": f"prompt {i}", "model": "mock/model", "resolution": "1024x1024"}, f)
+    return root
+
+
+def child_env(offline):
+    env = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+    if offline:
+        env.update(HTTP_PROXY=BLACKHOLE_PROXY, HTTPS_PROXY=BLACKHOLE_PROXY, NO_PROXY="")
+    return env
+
+
+def import_breakdown(sandbox, env, top):
+    """Top imports by cumulative time from `python -X importtime`."""
+    code = f"import sys; sys.path.insert(0, {sandbox!r}); import zimage_ui"
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env,
+                          capture_output=True, text=True, cwd=sandbox)
+    rows = []
+    for line in proc.stderr.splitlines():
+        m = re.match(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)", line)
+        # 缩进表示嵌套层级：只统计顶层与 zimage_ui 的直接导入
+        if m and (len(m.group(3)) - 1) // 2 <= 1:
+            rows.append({"module": m.group(4), "self_us": int(m.group(1)), "cumulative_us": int(m.group(2))})
+    rows.sort(key=lambda r: r["cumulative_us"], reverse=True)
+    total = next((r["cumulative_us"] for r in rows if r["module"] == "zimage_ui"), None)
+    return {"zimage_ui_cumulative_ms": round(total / 1000, 1) if total else None, "top": rows[:top]}
+
+
+def measure(label, source_script, args):
+    sandbox = prepare_sandbox(source_script, args.history, args.no_avatar)
+    env = child_env(args.offline)
+    try:
+        breakdown = import_breakdown(sandbox, env, args.top)
+        runs = []
+        for _ in range(args.runs):
+            run_env = dict(env, ZIMAGE_LAUNCH_TS=repr(time.time()))
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--probe",
+                                   os.path.join(sandbox, "zimage_ui.py")],
+                                  env=run_env, capture_output=True, text=True, cwd=sandbox, timeout=120)
+            m = re.search(r"STARTUP_PROBE (\{.*\})", proc.stdout)
+            if not m:
+                print(f"[{label}] probe failed:\n{proc.stderr[-2000:]}")
+                continue
+            runs.append(json.loads(m.group(1)))
+        result = {"label": label, "imports": breakdown, "runs": runs}
+        if runs:
+            for key in runs[0]:
+                vals = sorted(r[key] for r in runs if key in r)
+                result[key + "_median"] = vals[len(vals) // 2]
+        return result
+    finally:
+        shutil.rmtree(sandbox, ignore_errors=True)
+
+
+def script_at_rev(rev):
+    rel = os.path.relpath(os.path.join(APP_DIR, "zimage_ui.py"),
+                          subprocess.check_output(["git", "rev-parse", "--show-toplevel"], cwd=APP_DIR,
+                                                  text=True).strip())
+    content = subprocess.check_output(["git", "show", f"{rev}:{rel.replace(os.sep, '/')}"], cwd=APP_DIR)
+    fd, path = tempfile.mkstemp(suffix="_zimage_ui.py")
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    return path
+
+
+def main():
+    if len(sys.argv) >= 3 and sys.argv[1] == "--probe":
+        probe(sys.argv[2])
+        return
+    parser = argparse.ArgumentParser(description="ZImage startup benchmark")
+    parser.add_argument("--script", default=os.path.join(APP_DIR, "zimage_ui.py"))
+    parser.add_argument("--rev", default=None, help="同时测量某个 git 版本的 zimage_ui.py 作为对照")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--history", type=int, default=0, help="预置的历史图片数量")
+    parser.add_argument("--no-avatar", action="store_true")
+    parser.add_argument("--offline", action="store_true")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    results = [measure("current", args.script, args)]
+    if args.rev:
+        old = script_at_rev(args.rev)
+        try:
+            results.append(measure(args.rev, old, args))
+        finally:
+            os.remove(old)
+
+    for r in results:
+        print(f"== {r['label']}: import zimage_ui {r['imports']['zimage_ui_cumulative_ms']} ms, "
+              f"window shown (median) {r.get('shown_ms_median')} ms, "
+              f"since launch {r.get('since_launch_ms_median')} ms")
+        for row in r["imports"]["top"]:
+            print(f"    {row['cumulative_us'] / 1000:>9.1f} ms  {row['module']}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,533 @@
+"""
+性能基准 (Benchmark Suite)
+
+在本地模拟服务 (mock_modelscope.py) 上运行各场景，结果写入 JSON，便于版本间比较:
+
+    python bench/benchmark.py                              # 全部场景
+    python bench/benchmark.py --scenarios sse,markdown     # 指定场景
+    python bench/benchmark.py --compare bench_results/old.json
+
+场景: generation (不同并发下的吞吐与延迟)、chat (流式对话)、sse (SSE 解析吞吐)、
+markdown (render_markdown 开销)、history (1k/10k/50k 历史记录加载)、
+derivatives (派生图片：单线程 vs 进程池)、progressive (限速链路上首个下载预览 vs 完整下载的耗时)、
+facets (画廊分面索引的建立、筛选与计数)、prompts (提示词历史的加载、逐键补全延迟与增量提交)、
+warmup (冷连接与预热连接上首个请求的耗时)。
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import zimage_ui  # noqa: E402
+from mock_modelscope import MockConfig, MockModelScope, make_jpeg  # noqa: E402
+
+RESULTS_DIR = os.path.join(APP_DIR, "bench_results")
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def latency_stats(values_ms):
+    if not values_ms:
+        return {}
+    return {
+        "p50_ms": round(zimage_ui.percentile(values_ms, 50), 2),
+        "p95_ms": round(zimage_ui.percentile(values_ms, 95), 2),
+        "max_ms": round(max(values_ms), 2),
+    }
+
+
+def bench_generation(args, server):
+    """End-to-end generate_image() against the mock server at several concurrency levels."""
+    results = {}
+    out_dir = tempfile.mkdtemp(prefix="zimage_bench_gen_")
+    try:
+        for concurrency in args.concurrency:
+            def job(i):
+                span = zimage_ui.GenerationSpan("mock/model", args.size)
+                start = time.perf_counter()
+                try:
+                    zimage_ui.generate_image("bench-key", "mock/model", f"bench prompt {i}", args.size, span,
+                                             output_dir=out_dir, n=args.images_per_task)
+                    ok = True
+                except Exception:
+                    ok = False
+                return ok, (time.perf_counter() - start) * 1000, span.record
+
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                outcomes, wall = timed(lambda: list(pool.map(job, range(args.jobs))))
+            latencies = [ms for ok, ms, _ in outcomes if ok]
+            spans = [rec for ok, _, rec in outcomes if ok]
+            entry = {
+                "jobs": args.jobs,
+                "images_per_task": args.images_per_task,
+                "errors": sum(1 for ok, _, _ in outcomes if not ok),
+                "wall_s": round(wall, 3),
+                "throughput_per_sec": round(len(latencies) / wall, 2) if wall else 0,
+                "images_per_sec": round(len(latencies) * args.images_per_task / wall, 2) if wall else 0,
+                **latency_stats(latencies),
+            }
+            for field in ("submit_ms", "download_ms", "decode_ms", "save_ms"):
+                vals = [r[field] for r in spans if field in r]
+                if vals:
+                    entry[field + "_p50"] = round(zimage_ui.percentile(vals, 50), 2)
+            results[f"c{concurrency}"] = entry
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return results
+
+
+def bench_chat(args, server):
+    """Streaming chat against the mock server: TTFT and tokens/sec as seen by the client."""
+    records = []
+    for _ in range(args.chat_runs):
+        stats = zimage_ui.ChatStreamStats("mock/chat")
+        try:
+            zimage_ui.stream_chat_completion("bench-key", "mock/chat", [{"role": "user", "content": "hi"}],
+                                             stats, lambda d: None)
+            records.append(stats.to_record("ok"))
+        except Exception as e:
+            records.append(stats.to_record("error", e))
+    ok = [r for r in records if r["status"] == "ok"]
+    return {
+        "runs": len(records),
+        "errors": len(records) - len(ok),
+        "ttft": latency_stats([r["ttft_ms"] for r in ok if r["ttft_ms"] is not None]),
+        "tokens_per_sec_p50": round(zimage_ui.percentile([r["tokens_per_sec"] for r in ok], 50), 1) if ok else 0,
+    }
+
+
+def bench_sse(args, server):
+    """Raw parse_sse_line throughput over synthetic delta lines."""
+    line = ('data: ' + json.dumps({"choices": [{"index": 0, "delta": {"content": "甲维斯在此"}}]},
+                                  ensure_ascii=False)).encode("utf-8")
+    lines = [line, b""] * args.sse_lines
+    parsed, elapsed = timed(lambda: sum(1 for raw in lines if isinstance(zimage_ui.parse_sse_line(raw), dict)))
+    total_bytes = len(line) * args.sse_lines
+    return {
+        "lines": parsed,
+        "elapsed_s": round(elapsed, 4),
+        "lines_per_sec": round(parsed / elapsed) if elapsed else 0,
+        "mb_per_sec": round(total_bytes / elapsed / 1e6, 2) if elapsed else 0,
+    }
+
+
+def bench_markdown(args, server):
+    """render_markdown cost for typical replies, plus the per-delta re-render pattern used while streaming."""
+    samples = {
+        "short": "好的，**甲维斯**在此。",
+        "code": "示例：\n```python\nprint('hello')\n```\n行内 `code` 与 [链接](https://example.com)。\n" * 10,
+        "long": ("这是一段很长的回答，包含 **粗体**、_斜体_ 和 `代码`。\n" * 200),
+    }
+    results = {}
+    for name, text in samples.items():
+        n = args.markdown_iters
+        _, elapsed = timed(lambda: [zimage_ui.render_markdown(text) for _ in range(n)])
+        results[name] = {"chars": len(text), "us_per_call": round(elapsed / n * 1e6, 2)}
+    # 流式时每个 delta 都重新渲染累计文本：总成本随回复长度平方增长
+    deltas = ["这是", "**流式**", "的", "回复", "。\n"] * (args.stream_deltas // 5)
+    acc = ""
+    start = time.perf_counter()
+    for d in deltas:
+        acc += d
+        zimage_ui.render_markdown(acc)
+    results["stream_rerender"] = {"deltas": len(deltas), "total_ms": round((time.perf_counter() - start) * 1000, 2)}
+    return results
+
+
+def make_history_dir(root, count):
+    """Populate `root` with `count` tiny images and sidecars with spread-out mtimes."""
+    data = make_jpeg(16, 16)
+    now = time.time()
+    for i in range(count):
+        stem = os.path.join(root, f"img_bench_{i:06d}")
+        with open(stem + ".jpg", "wb") as f:
+            f.write(data)
+        with open(stem + ".json", "w", encoding="utf-8") as f:
+            json.dump({"prompt": f"bench prompt {i}", "model": "mock/model", "resolution": "1024x1024"}, f)
+        os.utime(stem + ".jpg", (now - i, now - i))
+
+
+def bench_history(args, server):
+    """scan_history() time over synthetic output directories of increasing size."""
+    results = {}
+    for count in args.history_sizes:
+        root = tempfile.mkdtemp(prefix=f"zimage_bench_hist_{count}_")
+        try:
+            make_history_dir(root, count)
+            records, elapsed = timed(zimage_ui.scan_history, root)
+            results[str(count)] = {"records": len(records), "scan_s": round(elapsed, 3),
+                                   "us_per_image": round(elapsed / max(1, count) * 1e6, 1)}
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def bench_derivatives(args, server):
+    """Derivative throughput: build_derivative inline on one thread vs DerivativePipeline's process pool."""
+    kinds = [k for k in args.derivative_kinds.split(",") if k]
+    root = tempfile.mkdtemp(prefix="zimage_bench_derived_")
+    try:
+        data = make_jpeg(*(int(v) for v in args.size.split("x")))
+        paths = []
+        for i in range(args.derivative_images):
+            path = os.path.join(root, f"img_derived_{i:04d}.jpg")
+            with open(path, "wb") as f:
+                f.write(data)
+            paths.append(path)
+        results = {"images": len(paths), "kinds": kinds}
+
+        def clear():
+            shutil.rmtree(os.path.join(root, ".derived"), ignore_errors=True)
+
+        start = time.perf_counter()
+        for path in paths:
+            for kind in kinds:
+                zimage_ui.build_derivative(kind, path, zimage_ui.derived_path(path, kind, root))
+        inline_s = time.perf_counter() - start
+        results["inline"] = {"elapsed_s": round(inline_s, 3), "jobs_per_sec": round(len(paths) * len(kinds) / inline_s, 2)}
+
+        clear()
+        pipeline = zimage_ui.DerivativePipeline(kinds)
+        start = time.perf_counter()
+        pipeline.submit(paths)
+        while True:
+            stats = pipeline.stats()
+            if stats["done"] + stats["failed"] >= len(paths) * len(kinds):
+                break
+            time.sleep(0.01)
+        pool_s = time.perf_counter() - start
+        pipeline.shutdown()
+        results["pool"] = {"workers": pipeline.workers, "elapsed_s": round(pool_s, 3), "failed": stats["failed"],
+                           "jobs_per_sec": round(len(paths) * len(kinds) / pool_s, 2)}
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_facets(args, server):
+    """GalleryIndex build, query and facet-count cost over synthetic records of increasing size."""
+    models = ["Qwen/Qwen-Image", "Tongyi-MAI/Z-Image-Turbo", "mock/model"]
+    sizes = [it["size"] for _, items in zimage_ui.RESOLUTION_CATEGORIES for it in items] + ["1000x700"]
+    now = time.time()
+    results = {}
+    for count in args.history_sizes:
+        records = [{"path": f"/bench/img_{i:06d}.jpg", "model": models[i % len(models)],
+                    "resolution": sizes[i % len(sizes)], "mtime": now - i * 300} for i in range(count)]
+        index = zimage_ui.GalleryIndex()
+        _, build_s = timed(lambda: [index.add(r) for r in records])
+        filters = {"model": models[0], "tier": "超清 (Ultra)", "ratio": None}
+        iters = 20
+        _, query_s = timed(lambda: [index.query(filters) for _ in range(iters)])
+        _, counts_s = timed(lambda: [index.counts(filters) for _ in range(iters)])
+        _, days_s = timed(lambda: [index.day_counts(index.query(filters)) for _ in range(iters)])
+        results[str(count)] = {"build_ms": round(build_s * 1000, 1), "query_ms": round(query_s / iters * 1000, 3),
+                               "counts_ms": round(counts_s / iters * 1000, 3),
+                               "day_counts_ms": round(days_s / iters * 1000, 3)}
+    return results
+
+
+def bench_progressive(args, server):
+    """Time to the first download preview vs the full download on a throttled link, baseline and progressive JPEG."""
+    results = {}
+    out_dir = tempfile.mkdtemp(prefix="zimage_bench_progressive_")
+    original_base = zimage_ui.API_BASE_URL
+    try:
+        for progressive in (False, True):
+            slow = MockModelScope(MockConfig(submit_latency=0, queue_time=0, gen_time=0,
+                                             image_size=args.progressive_size, throttle_kbps=args.throttle_kbps,
+                                             progressive=progressive)).start()
+            zimage_ui.API_BASE_URL = slow.base_url
+            try:
+                first_ms, download_ms, previews = [], [], []
+                for i in range(args.progressive_runs):
+                    span = zimage_ui.GenerationSpan("mock/model", args.progressive_size)
+                    fractions = []
+                    zimage_ui.generate_image("bench-key", "mock/model", f"progressive prompt {i}",
+                                             args.progressive_size, span, output_dir=out_dir,
+                                             on_preview=lambda index, image, fraction: fractions.append(fraction))
+                    if "first_preview_ms" in span.record:
+                        first_ms.append(span.record["first_preview_ms"])
+                    download_ms.append(span.record["download_ms"])
+                    previews.append(len(fractions))
+                results["progressive" if progressive else "baseline"] = {
+                    "bytes": span.record["download_bytes"],
+                    "previews_per_image": round(sum(previews) / len(previews), 1),
+                    "first_preview": latency_stats(first_ms),
+                    "download": latency_stats(download_ms),
+                }
+            finally:
+                slow.stop()
+        return results
+    finally:
+        zimage_ui.API_BASE_URL = original_base
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def synthetic_prompts(count):
+    """Distinct prompts built from a small vocabulary, like a long personal prompt history."""
+    import random
+    rng = random.Random(count)
+    subjects = ["a cat", "an old lighthouse", "a cyberpunk street", "a mountain lake", "a portrait of a knight",
+                "一只橘猫", "雪山下的湖泊", "赛博朋克城市夜景", "古风少女", "a bowl of ramen"]
+    styles = ["oil painting", "watercolor", "studio lighting", "35mm film", "pixel art", "水墨画", "电影感",
+              "highly detailed", "soft pastel colors", "isometric"]
+    extras = ["at sunset", "in the rain", "on a foggy morning", "under neon lights", "8k", "trending on artstation",
+              "wide angle", "黄昏", "逆光", "close-up"]
+    prompts = set()
+    while len(prompts) < count:
+        words = [rng.choice(subjects)] + rng.sample(styles, 2) + rng.sample(extras, 2)
+        prompts.add(", ".join(words) + f" #{rng.randrange(count)}")
+    return sorted(prompts)
+
+
+def bench_prompts(args, server):
+    """Prompt history: loading the log, per-keystroke autocomplete latency and incremental submits."""
+    import random
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix="zimage_bench_prompts_")
+    try:
+        for count in args.prompt_history_sizes:
+            prompts = synthetic_prompts(count)
+            path = os.path.join(work_dir, f"prompts_{count}.jsonl")
+            now = time.time()
+            with open(path, "w", encoding="utf-8") as f:
+                for i, text in enumerate(prompts):
+                    f.write(json.dumps({"text": text, "kind": "image", "count": 1 + i % 5,
+                                        "ts": round(now - i * 60)}, ensure_ascii=False) + "\n")
+            history = zimage_ui.PromptHistory(path)
+            _, load_s = timed(history.load)
+            rng = random.Random(0)
+            keystrokes = []
+            for text in rng.sample(prompts, 50):
+                # 模拟逐字输入前 24 个字符，外加从提示词中间开始的子串查询
+                keystrokes += [text[:k] for k in range(zimage_ui.PROMPT_MIN_QUERY, 25)]
+                keystrokes += [text[10:10 + k] for k in range(3, 12)]
+
+            def type_all():
+                latencies, hits = [], 0
+                for query in keystrokes:
+                    start = time.perf_counter()
+                    hits += bool(history.lookup(query, "image"))
+                    latencies.append((time.perf_counter() - start) * 1000)
+                return latencies, hits
+
+            # n-gram 索引建立之前（启动后不久）的查询走逐条比对
+            unindexed, _ = type_all()
+            _, index_s = timed(history.index_grams, len(prompts))
+            latencies, hits = type_all()
+            submits = []
+            for i in range(200):
+                start = time.perf_counter()
+                history.add(f"freshly typed prompt {i}, watercolor", "image", time.time())
+                submits.append((time.perf_counter() - start) * 1000)
+            results[str(count)] = {"load_ms": round(load_s * 1000, 1), "index_ms": round(index_s * 1000, 1),
+                                   "keystrokes": len(keystrokes), "hit_rate": round(hits / len(keystrokes), 3),
+                                   "lookup_unindexed": latency_stats(unindexed), "lookup": latency_stats(latencies),
+                                   "submit": latency_stats(submits)}
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def bench_warmup(args, server):
+    """First request on a fresh (cold) connection vs one pre-opened by ConnectionWarmer.
+
+    The mock server delays every new connection by --handshake-ms (standing in for the TLS
+    handshake and server warm-up) and is addressed as "localhost" so DNS is resolved too.
+    """
+    slow = MockModelScope(MockConfig(submit_latency=0, queue_time=0, gen_time=0, chat_tokens=20,
+                                     token_interval=0, chat_latency=0, handshake_ms=args.handshake_ms)).start()
+    original = (zimage_ui.API_BASE_URL, zimage_ui.CONNECTION_METRICS_LOG)
+    work_dir = tempfile.mkdtemp(prefix="zimage_bench_warmup_")
+    zimage_ui.API_BASE_URL = slow.base_url.replace("127.0.0.1", "localhost")
+    zimage_ui.CONNECTION_METRICS_LOG = os.path.join(work_dir, "connections.jsonl")
+    warmer = zimage_ui.CONNECTION_WARMER
+    results = {}
+    try:
+        for mode in ("cold", "warm"):
+            submits, ttfts, connections, warm_ms = [], [], [], []
+            for i in range(args.warmup_runs):
+                for request in ("image", "chat"):
+                    # 每次都从空连接池与空 DNS 缓存开始，相当于刚启动或空闲连接已被关闭
+                    zimage_ui.http_session().close()
+                    zimage_ui.DNS_CACHE.clear()
+                    warmer.last_used = 0.0
+                    if mode == "warm":
+                        thread, elapsed = timed(lambda: warmer.warm("bench").join())
+                        warm_ms.append(elapsed * 1000)
+                    if request == "image":
+                        span = zimage_ui.GenerationSpan("mock/model", "64x64")
+                        zimage_ui.generate_image("bench-key", "mock/model", f"warmup prompt {i}", "64x64", span,
+                                                 output_dir=work_dir)
+                        submits.append(span.record["submit_ms"])
+                        connections.append(span.record["connection"])
+                    else:
+                        stats = zimage_ui.ChatStreamStats("mock/chat")
+                        zimage_ui.stream_chat_completion("bench-key", "mock/chat", [{"role": "user", "content": "hi"}],
+                                                         stats, lambda d: None)
+                        record = stats.to_record("ok")
+                        ttfts.append(record["ttft_ms"])
+                        connections.append(record["connection"])
+            results[mode] = {"submit": latency_stats(submits), "chat_ttft": latency_stats(ttfts),
+                             "warm_connections": connections.count("warm"), "requests": len(connections)}
+            if warm_ms:
+                results[mode]["warmup"] = latency_stats(warm_ms)
+        results["saved_submit_p50_ms"] = round(results["cold"]["submit"]["p50_ms"] - results["warm"]["submit"]["p50_ms"], 1)
+        results["saved_ttft_p50_ms"] = round(results["cold"]["chat_ttft"]["p50_ms"] - results["warm"]["chat_ttft"]["p50_ms"], 1)
+        results["server_connections"] = slow.counters["connections"]
+        return results
+    finally:
+        slow.stop()
+        zimage_ui.http_session().close()
+        zimage_ui.API_BASE_URL, zimage_ui.CONNECTION_METRICS_LOG = original
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+SCENARIOS = {
+    "generation": bench_generation,
+    "chat": bench_chat,
+    "sse": bench_sse,
+    "markdown": bench_markdown,
+    "history": bench_history,
+    "derivatives": bench_derivatives,
+    "progressive": bench_progressive,
+    "facets": bench_facets,
+    "prompts": bench_prompts,
+    "warmup": bench_warmup,
+}
+
+
+def flatten(obj, prefix=""):
+    out = {}
+    for k, v in obj.items():
+        key = f"{prefix}.{k}" if prefix else k
+        if isinstance(v, dict):
+            out.update(flatten(v, key))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[key] = v
+    return out
+
+
+def compare(current, baseline, tolerance):
+    """List metrics that regressed by more than `tolerance` (fraction) versus the baseline run."""
+    cur = flatten(current["scenarios"])
+    base = flatten(baseline.get("scenarios", {}))
+    regressions = []
+    for key, old in base.items():
+        new = cur.get(key)
+        if new is None or not old:
+            continue
+        name = key.rsplit(".", 1)[-1]
+        if name.endswith(("_ms", "_s", "us_per_call", "us_per_image")) or "_ms_" in name:
+            change = (new - old) / old
+        elif "per_sec" in name:
+            change = (old - new) / old
+        else:
+            continue
+        if change > tolerance:
+            regressions.append({"metric": key, "baseline": old, "current": new, "change": round(change, 3)})
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ZImage benchmark suite")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--out", default=None, help="结果 JSON 路径 (默认 bench_results/bench_<时间>.json)")
+    parser.add_argument("--compare", default=None, help="与之前的结果 JSON 比较并报告退化")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    parser.add_argument("--concurrency", default="1,4,8")
+    parser.add_argument("--jobs", type=int, default=16)
+    parser.add_argument("--size", default="1024x1024")
+    parser.add_argument("--images-per-task", type=int, default=1, help="每个任务请求的图片数量 (n)")
+    parser.add_argument("--queue-time", type=float, default=0.1)
+    parser.add_argument("--gen-time", type=float, default=0.3)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--chat-runs", type=int, default=5)
+    parser.add_argument("--sse-lines", type=int, default=100000)
+    parser.add_argument("--markdown-iters", type=int, default=2000)
+    parser.add_argument("--stream-deltas", type=int, default=2000)
+    parser.add_argument("--history-sizes", default="1000,10000,50000")
+    parser.add_argument("--derivative-images", type=int, default=40)
+    parser.add_argument("--derivative-kinds", default="thumb,preview_1024,webp")
+    parser.add_argument("--progressive-size", default="4096x4096")
+    parser.add_argument("--progressive-runs", type=int, default=3)
+    parser.add_argument("--throttle-kbps", type=float, default=256, help="progressive 场景的下载限速 (KB/s)")
+    parser.add_argument("--prompt-history-sizes", default="10000,100000")
+    parser.add_argument("--warmup-runs", type=int, default=10)
+    parser.add_argument("--handshake-ms", type=float, default=150, help="warmup 场景中每个新连接的模拟握手延迟")
+    args = parser.parse_args()
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c]
+    args.history_sizes = [int(c) for c in args.history_sizes.split(",") if c]
+    args.prompt_history_sizes = [int(c) for c in args.prompt_history_sizes.split(",") if c]
+
+    server = MockModelScope(MockConfig(queue_time=args.queue_time, gen_time=args.gen_time,
+                                       failure_rate=args.failure_rate)).start()
+    zimage_ui.API_BASE_URL = server.base_url
+    zimage_ui.POLL_INTERVAL = 0.05
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        },
+        "scenarios": {},
+    }
+    try:
+        for name in args.scenarios.split(","):
+            if name not in SCENARIOS:
+                print(f"Unknown scenario: {name}")
+                continue
+            print(f"[bench] {name} ...", flush=True)
+            report["scenarios"][name], elapsed = timed(SCENARIOS[name], args, server)
+            print(f"[bench] {name} done in {elapsed:.1f}s")
+    finally:
+        server.stop()
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            report["regressions"] = compare(report, json.load(f), args.tolerance)
+
+    out = args.out or os.path.join(RESULTS_DIR, f"bench_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps(report["scenarios"], indent=2, ensure_ascii=False))
+    print(f"Results written to {out}")
+    if report.get("regressions"):
+        print(f"{len(report['regressions'])} regression(s) over {args.tolerance:.0%}:")
+        for r in report["regressions"]:
+            print(f"  {r['metric']}: {r['baseline']} -> {r['current']} ({r['change']:+.1%})")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    import multiprocessing
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,280 @@
+"""
+本地 ModelScope 模拟服务 (Mock ModelScope API)
+
+实现 `v1/images/generations` (异步模式)、`v1/tasks/{id}` 与流式 `v1/chat/completions`，
+延迟、失败率、图片尺寸均可配置，供 benchmark.py 与手动调试使用。
+
+    python bench/mock_modelscope.py --port 8790 --queue-time 0.5 --gen-time 2
+    python bench/mock_modelscope.py --image-size 4096x4096 --throttle-kbps 256 --progressive   (慢速链路)
+    set ZIMAGE_API_BASE=http://127.0.0.1:8790/   (然后正常运行 zimage_ui.py)
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import urlparse
+
+
+class MockConfig:
+    def __init__(self, submit_latency=0.02, queue_time=0.1, gen_time=0.3, failure_rate=0.0,
+                 image_size=None, chat_tokens=200, token_interval=0.005, chat_latency=0.05,
+                 send_usage=True, unique_images=True, throttle_kbps=0, progressive=False, handshake_ms=0):
+        self.submit_latency = submit_latency    # 提交请求的响应延迟 (秒)
+        self.queue_time = queue_time            # 任务处于 PENDING 的时间 (秒)
+        self.gen_time = gen_time                # 任务处于 RUNNING 的时间 (秒)
+        self.failure_rate = failure_rate        # 任务 / 对话失败的概率 (0~1)
+        self.image_size = image_size            # 固定输出尺寸 "WxH"；None 表示使用请求中的 size
+        self.chat_tokens = chat_tokens          # 每次对话回复的分片数量
+        self.token_interval = token_interval    # 分片之间的间隔 (秒)
+        self.chat_latency = chat_latency        # 首个分片前的延迟 (秒)
+        self.send_usage = send_usage            # 是否在最后一个分片中返回 usage
+        self.unique_images = unique_images      # 每个文件内容不同 (客户端按内容哈希去重)
+        self.throttle_kbps = throttle_kbps      # 图片下载限速 (KB/s)；0 表示不限速
+        self.progressive = progressive          # 输出渐进式 JPEG
+        self.handshake_ms = handshake_ms        # 每个新连接的额外延迟 (毫秒)，模拟 TLS 握手与服务端预热
+
+
+_image_cache = {}
+_image_cache_lock = threading.Lock()
+
+
+def make_jpeg(width, height, progressive=False):
+    """Deterministic gradient JPEG of the given size (cached per size and encoding)."""
+    key = (width, height, progressive)
+    with _image_cache_lock:
+        if key not in _image_cache:
+            from PIL import Image
+            img = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+            buf = BytesIO()
+            img.save(buf, format="JPEG", quality=90, progressive=progressive)
+            _image_cache[key] = buf.getvalue()
+        return _image_cache[key]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 响应头与响应体分两次写出；不关闭 Nagle 时复用的连接上每个请求会多等一次延迟 ACK (~40ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.mock.counters["connections"] += 1
+        if self.mock.config.handshake_ms:
+            time.sleep(self.mock.config.handshake_ms / 1000)
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b"{}"
+        try:
+            return json.loads(raw.decode("utf-8"))
+        except ValueError:
+            return {}
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path == "/v1/images/generations":
+            self.handle_generation()
+        elif path == "/v1/chat/completions":
+            self.handle_chat()
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_HEAD(self):
+        # 连接预热 (ConnectionWarmer) 使用 HEAD /
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path.startswith("/v1/tasks/"):
+            self.handle_task(path.rsplit("/", 1)[-1])
+        elif path.startswith("/files/"):
+            self.handle_file(path.rsplit("/", 1)[-1])
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def handle_generation(self):
+        cfg = self.mock.config
+        payload = self.read_json()
+        time.sleep(cfg.submit_latency)
+        if self.headers.get("X-ModelScope-Async-Mode", "").lower() != "true":
+            self.send_json(400, {"error": "only async mode is supported"})
+            return
+        size = cfg.image_size or str(payload.get("size") or "1024x1024")
+        try:
+            width, height = (int(v) for v in size.lower().split("x"))
+        except ValueError:
+            self.send_json(400, {"error": f"invalid size {size}"})
+            return
+        task_id = uuid.uuid4().hex
+        self.mock.tasks[task_id] = {
+            "created": time.monotonic(),
+            "failed": random.random() < cfg.failure_rate,
+            "size": (width, height),
+            "n": max(1, int(payload.get("n") or 1)),
+        }
+        self.mock.counters["submitted"] += 1
+        self.send_json(200, {"task_id": task_id, "request_id": uuid.uuid4().hex})
+
+    def handle_task(self, task_id):
+        cfg = self.mock.config
+        task = self.mock.tasks.get(task_id)
+        self.mock.counters["polls"] += 1
+        if task is None:
+            self.send_json(404, {"error": "task not found"})
+            return
+        elapsed = time.monotonic() - task["created"]
+        if elapsed < cfg.queue_time:
+            self.send_json(200, {"task_id": task_id, "task_status": "PENDING"})
+        elif elapsed < cfg.queue_time + cfg.gen_time:
+            self.send_json(200, {"task_id": task_id, "task_status": "RUNNING"})
+        elif task["failed"]:
+            self.send_json(200, {"task_id": task_id, "task_status": "FAILED", "errors": {"message": "mock failure"}})
+        else:
+            width, height = task["size"]
+            base = f"http://{self.headers.get('Host')}"
+            images = [f"{base}/files/{task_id}_{i}_{width}x{height}.jpg" for i in range(task["n"])]
+            self.send_json(200, {"task_id": task_id, "task_status": "SUCCEED", "output_images": images})
+
+    def handle_file(self, name):
+        try:
+            width, height = (int(v) for v in name.rsplit("_", 1)[-1].split(".")[0].split("x"))
+        except ValueError:
+            self.send_json(404, {"error": "not found"})
+            return
+        data = make_jpeg(width, height, self.mock.config.progressive)
+        if self.mock.config.unique_images:
+            # JPEG 解码器忽略 EOI 之后的数据：追加文件名即可让每张图片的哈希不同，无需重新编码
+            data += name.encode("ascii", "ignore")
+        self.mock.counters["downloads"] += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        rate = self.mock.config.throttle_kbps * 1024
+        if not rate:
+            self.wfile.write(data)
+            return
+        # 限速：每 50ms 写出一份配额，模拟慢速链路上逐步到达的字节
+        chunk = max(1, int(rate * 0.05))
+        for offset in range(0, len(data), chunk):
+            self.wfile.write(data[offset:offset + chunk])
+            self.wfile.flush()
+            time.sleep(0.05)
+
+    def handle_chat(self):
+        cfg = self.mock.config
+        payload = self.read_json()
+        time.sleep(cfg.chat_latency)
+        if random.random() < cfg.failure_rate:
+            self.send_json(500, {"error": "mock failure"})
+            return
+        model = payload.get("model", "mock")
+        words = ["甲维斯", "在此", "，", "这是", "一段", "**模拟**", "的", "`流式`", "回复", "。\n"]
+        if not payload.get("stream"):
+            text = "".join(words[i % len(words)] for i in range(cfg.chat_tokens))
+            self.send_json(200, {"choices": [{"message": {"role": "assistant", "content": text}}],
+                                 "usage": {"prompt_tokens": 20, "completion_tokens": cfg.chat_tokens,
+                                           "total_tokens": 20 + cfg.chat_tokens}})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i in range(cfg.chat_tokens):
+            chunk = {"model": model, "choices": [{"index": 0, "delta": {"content": words[i % len(words)]}}]}
+            self.write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            if cfg.token_interval:
+                time.sleep(cfg.token_interval)
+        if cfg.send_usage:
+            usage = {"model": model, "choices": [],
+                     "usage": {"prompt_tokens": 20, "completion_tokens": cfg.chat_tokens,
+                               "total_tokens": 20 + cfg.chat_tokens}}
+            self.write_chunk(f"data: {json.dumps(usage)}\n\n".encode("utf-8"))
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+
+class MockModelScope:
+    """Threaded mock server; use start()/stop() from scripts or serve_forever() from the CLI."""
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or MockConfig()
+        self.httpd = ThreadingHTTPServer((host, port), MockHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.tasks = {}
+        self.counters = {"submitted": 0, "polls": 0, "downloads": 0, "connections": 0}
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the ModelScope inference API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--submit-latency", type=float, default=0.02)
+    parser.add_argument("--queue-time", type=float, default=0.1)
+    parser.add_argument("--gen-time", type=float, default=0.3)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--image-size", default=None, help="固定输出尺寸，例如 2048x2048")
+    parser.add_argument("--chat-tokens", type=int, default=200)
+    parser.add_argument("--token-interval", type=float, default=0.005)
+    parser.add_argument("--chat-latency", type=float, default=0.05)
+    parser.add_argument("--no-usage", action="store_true")
+    parser.add_argument("--throttle-kbps", type=float, default=0, help="图片下载限速 (KB/s)，0 表示不限速")
+    parser.add_argument("--progressive", action="store_true", help="输出渐进式 JPEG")
+    parser.add_argument("--handshake-ms", type=float, default=0, help="每个新连接的额外延迟 (毫秒)")
+    args = parser.parse_args()
+
+    config = MockConfig(args.submit_latency, args.queue_time, args.gen_time, args.failure_rate,
+                        args.image_size, args.chat_tokens, args.token_interval, args.chat_latency,
+                        not args.no_usage, throttle_kbps=args.throttle_kbps, progressive=args.progressive,
+                        handshake_ms=args.handshake_ms)
+    server = MockModelScope(config, args.host, args.port)
+    print(f"Mock ModelScope listening on {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -12,7 +12,7 @@ echo [2/3] Building EXE...
 echo Clean up previous build...
 rmdir /s /q build
 rmdir /s /q dist
-del *.spec
+del ZImage_Generator.spec
 
 echo Start packing...
 pyinstaller --noconsole --onefile --name "ZImage_Generator" --clean --icon logo.ico ^
@@ -0,0 +1,26 @@
+@echo off
+echo ========================================================
+echo    ZImage Generator Onedir Build (目录版快速启动打包)
+echo ========================================================
+
+echo.
+echo [1/3] Checking PyInstaller...
+pip install pyinstaller -U
+
+echo.
+echo [2/3] Building onedir bundle...
+echo Clean up previous build...
+rmdir /s /q build
+rmdir /s /q dist
+
+echo Start packing...
+pyinstaller --noconfirm --clean ZImage_Generator_onedir.spec
+
+echo.
+echo [3/3] Done!
+echo.
+echo The application folder is located in the "dist" folder:
+echo dist\ZImage_Generator\ZImage_Generator.exe
+echo (Distribute the whole dist\ZImage_Generator folder, e.g. as a zip)
+echo.
+pause
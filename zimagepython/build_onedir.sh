@@ -0,0 +1,10 @@
+#!/bin/bash
+# 目录版 (onedir) 打包，Linux / macOS 使用；Windows 请运行 build_onedir.bat
+set -e
+cd "$(dirname "$0")"
+
+echo "[1/2] Building onedir bundle..."
+rm -rf build dist
+python3 -m PyInstaller --noconfirm --clean ZImage_Generator_onedir.spec
+
+echo "[2/2] Done: dist/ZImage_Generator/ZImage_Generator"
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import zimage_ui  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def error_log(tmp_path, monkeypatch):
+    """Keep log_error() output out of the real logs/ directory."""
+    path = str(tmp_path / "errors.jsonl")
+    monkeypatch.setattr(zimage_ui, "ERROR_LOG", path)
+    return path
+
+
+@pytest.fixture
+def jpeg_bytes():
+    """Encoded JPEG bytes of a solid-colour image; distinct colours give distinct bytes."""
+    from io import BytesIO
+    from PIL import Image
+
+    def make(color=(200, 40, 40), size=(32, 32)):
+        buf = BytesIO()
+        Image.new("RGB", size, color).save(buf, format="JPEG")
+        return buf.getvalue()
+    return make
+
+
+@pytest.fixture
+def png_bytes():
+    from io import BytesIO
+    from PIL import Image
+
+    def make(color=(40, 200, 40), size=(32, 32)):
+        buf = BytesIO()
+        Image.new("RGB", size, color).save(buf, format="PNG")
+        return buf.getvalue()
+    return make
@@ -0,0 +1,153 @@
+import threading
+import time
+
+import pytest
+
+import zimage_ui as z
+
+
+@pytest.mark.parametrize("raw, expected", [
+    (b'data: {"choices": [{"delta": {"content": "hi"}}]}', {"choices": [{"delta": {"content": "hi"}}]}),
+    (b"data:{\"a\": 1}  ", {"a": 1}),
+    (b"data: [DONE]", z.SSE_DONE),
+    (b"", None),
+    (b": keep-alive comment", None),
+    (b"event: message", None),
+    (b"data: {not json", None),
+    ('data: {"t": "中文"}'.encode("utf-8"), {"t": "中文"}),
+])
+def test_parse_sse_line(raw, expected):
+    assert z.parse_sse_line(raw) == expected
+
+
+class FakeGenerate:
+    """Stands in for generate_image: counts calls and blocks until released."""
+
+    def __init__(self, tmp_path, error=None):
+        self.tmp_path = tmp_path
+        self.error = error
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, api_key, model, prompt, resolution, span, n=1, **kwargs):
+        self.calls.append(api_key)
+        self.started.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        outputs = []
+        for i in range(n):
+            path = self.tmp_path / f"{api_key}_{len(self.calls)}_{i}.jpg"
+            path.write_bytes(b"image")
+            outputs.append((object(), str(path), {"prompt": prompt, "api": api_key}))
+        return outputs
+
+
+def run_in_threads(coordinator, api_keys, **kwargs):
+    results = [None] * len(api_keys)
+
+    def run(i, key):
+        try:
+            results[i] = coordinator.run(key, "m", "a cat", "32x32", None, **kwargs)
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=run, args=(i, key)) for i, key in enumerate(api_keys)]
+    return results, threads
+
+
+def test_coordinator_coalesces_identical_requests(tmp_path, monkeypatch):
+    fake = FakeGenerate(tmp_path)
+    monkeypatch.setattr(z, "generate_image", fake)
+    coordinator = z.GenerationCoordinator()
+    results, threads = run_in_threads(coordinator, ["key-a"] * 3)
+    threads[0].start()
+    assert fake.started.wait(5)
+    for t in threads[1:]:
+        t.start()
+    time.sleep(0.1) # 让后两个请求进入等待
+    fake.release.set()
+    for t in threads:
+        t.join(5)
+
+    assert fake.calls == ["key-a"]
+    assert sorted(source for _, source in results) == ["coalesced", "coalesced", "remote"]
+    assert all(outputs == results[0][0] for outputs, _ in results)
+    assert not coordinator.inflight
+
+
+def test_coordinator_never_shares_across_api_keys(tmp_path, monkeypatch):
+    fake = FakeGenerate(tmp_path)
+    monkeypatch.setattr(z, "generate_image", fake)
+    coordinator = z.GenerationCoordinator(cache_ttl=3600)
+    results, threads = run_in_threads(coordinator, ["key-a", "key-b"])
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    fake.release.set()
+    for t in threads:
+        t.join(5)
+
+    assert sorted(fake.calls) == ["key-a", "key-b"]
+    assert [source for _, source in results] == ["remote", "remote"]
+    assert results[0][0][0][2]["api"] == "key-a" and results[1][0][0][2]["api"] == "key-b"
+    # 缓存同样按密钥区分
+    outputs, source = coordinator.run("key-b", "m", "a cat", "32x32", None)
+    assert source == "cached" and outputs[0][2]["api"] == "key-b"
+    assert coordinator.run("key-c", "m", "a cat", "32x32", None)[1] == "remote"
+
+
+def test_coordinator_cache_respects_ttl_and_n(tmp_path, monkeypatch):
+    fake = FakeGenerate(tmp_path)
+    fake.release.set()
+    monkeypatch.setattr(z, "generate_image", fake)
+    coordinator = z.GenerationCoordinator(cache_ttl=60)
+    outputs, source = coordinator.run("k", "m", " a cat ", "32x32", None)
+    assert source == "remote"
+    cached, source = coordinator.run("k", "m", "a cat", "32x32", None)
+    assert source == "cached" and cached[0][0] is None and cached[0][1] == outputs[0][1]
+    assert coordinator.run("k", "m", "a cat", "32x32", None, n=2)[1] == "remote" # 缓存不够 n 张
+    coordinator.remember("m", "old", "32x32", outputs[0][1], {}, when=time.time() - 120, api_key="k")
+    assert coordinator.run("k", "m", "old", "32x32", None)[1] == "remote"
+    assert z.GenerationCoordinator().lookup(coordinator.key("k", "m", "a cat", "32x32"), 1) is None
+
+
+def test_coordinator_propagates_errors_to_waiters(tmp_path, monkeypatch):
+    fake = FakeGenerate(tmp_path, error=z.GenerationError("quota exceeded"))
+    monkeypatch.setattr(z, "generate_image", fake)
+    coordinator = z.GenerationCoordinator()
+    results, threads = run_in_threads(coordinator, ["k", "k"])
+    threads[0].start()
+    assert fake.started.wait(5)
+    threads[1].start()
+    time.sleep(0.1)
+    fake.release.set()
+    for t in threads:
+        t.join(5)
+
+    assert len(fake.calls) == 1
+    assert all(isinstance(r, z.GenerationError) for r in results)
+    assert not coordinator.inflight
+
+
+def test_token_bucket_allows_burst_then_waits():
+    bucket = z.TokenBucket(rate_per_minute=600, burst=2) # 每 0.1 秒一个令牌
+    assert bucket.acquire() == 0.0
+    assert bucket.acquire() == 0.0
+    start = time.monotonic()
+    waited = bucket.acquire()
+    elapsed = time.monotonic() - start
+    assert waited > 0
+    assert 0.05 <= elapsed < 1.0
+
+
+def test_token_bucket_refills_up_to_burst():
+    bucket = z.TokenBucket(rate_per_minute=60, burst=3)
+    for _ in range(3):
+        assert bucket.acquire() == 0.0
+    bucket.updated -= 3600 # 长时间空闲也只攒到 burst 个
+    bucket.refill()
+    assert bucket.tokens == 3
+    bucket.tokens, bucket.updated = 0.5, time.monotonic() - 0.5
+    bucket.refill()
+    assert bucket.tokens == pytest.approx(1.0, abs=0.05)
@@ -0,0 +1,99 @@
+import json
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+import zimage_ui as z
+
+DAY = 86400
+NOW = 1_900_000_000
+
+
+def snapshot(*images):
+    """{rel: (mtime, size)} for (name, age in days, size) triples, each with a 100-byte sidecar."""
+    snap = {}
+    for name, age_days, size in images:
+        snap[name] = (NOW - age_days * DAY, size)
+        snap[z.sidecar_path(name)] = (NOW - age_days * DAY, 100)
+    return snap
+
+
+def policy(max_bytes=0, max_age_days=0, max_count=0):
+    return {"max_bytes": max_bytes, "max_age": max_age_days * DAY, "max_count": max_count,
+            "action": "delete", "dry_run": False}
+
+
+def test_plan_retention_by_count_oldest_first(tmp_path):
+    snap = snapshot(("a.jpg", 3, 1000), ("b.jpg", 2, 1000), ("c.jpg", 1, 1000))
+    victims, stats = z.plan_retention(str(tmp_path), snap, set(), policy(max_count=1), now=NOW)
+    assert victims == ["a.jpg", "b.jpg"]
+    assert stats["remaining_images"] == 1
+    assert stats["freed_bytes"] == 2 * 1100 # 附属文件计入大小
+
+
+def test_plan_retention_by_age_and_bytes(tmp_path):
+    snap = snapshot(("a.jpg", 40, 1000), ("b.jpg", 10, 1000), ("c.jpg", 1, 1000))
+    assert z.plan_retention(str(tmp_path), snap, set(), policy(max_age_days=30), now=NOW)[0] == ["a.jpg"]
+    assert z.plan_retention(str(tmp_path), snap, set(), policy(max_bytes=2200), now=NOW)[0] == ["a.jpg"]
+    assert z.plan_retention(str(tmp_path), snap, set(), policy(max_bytes=2199), now=NOW)[0] == ["a.jpg", "b.jpg"]
+    victims, stats = z.plan_retention(str(tmp_path), snap, set(), policy(max_count=5), now=NOW)
+    assert victims == [] and stats["remaining_bytes"] == stats["bytes"]
+
+
+def test_plan_retention_never_picks_favorites(tmp_path):
+    snap = snapshot(("a.jpg", 3, 1000), ("b.jpg", 2, 1000), ("c.jpg", 1, 1000))
+    favorites = {os.path.normpath(os.path.join(str(tmp_path), "a.jpg"))}
+    victims, stats = z.plan_retention(str(tmp_path), snap, favorites, policy(max_count=1), now=NOW)
+    assert victims == ["b.jpg", "c.jpg"]
+    assert stats["pinned"] == 1
+
+
+@pytest.fixture
+def records(tmp_path, jpeg_bytes):
+    result = []
+    for i, name in enumerate(["img_1.jpg", "img_2.jpg", "img_1.jpg"]): # 重名时加序号
+        path = tmp_path / "src" / str(i) / name
+        path.parent.mkdir(parents=True)
+        path.write_bytes(jpeg_bytes((i * 80, 10, 10)))
+        result.append({"path": str(path), "name": name, "prompt": f"prompt {i}", "model": "m", "resolution": "32x32"})
+    return result
+
+
+@pytest.mark.parametrize("fmt", ["zip", "tar"])
+def test_export_archive_writes_images_and_manifest(tmp_path, records, fmt):
+    dest = str(tmp_path / f"out.{fmt}")
+    progress = []
+    missing = {"path": str(tmp_path / "gone.jpg"), "name": "gone.jpg"}
+    result = z.export_archive(records + [missing], dest, fmt=fmt, on_progress=lambda *a: progress.append(a))
+
+    assert result["images"] == 3 and result["missing"] == 1 and not result["cancelled"]
+    assert result["bytes"] == sum(os.path.getsize(r["path"]) for r in records)
+    assert len(progress) == 3
+    assert not os.path.exists(dest + ".part")
+    if fmt == "zip":
+        with zipfile.ZipFile(dest) as archive:
+            names = archive.namelist()
+            manifest = archive.read(z.EXPORT_MANIFEST_NAME).decode("utf-8")
+            first = archive.read("images/img_1.jpg")
+    else:
+        with tarfile.open(dest) as archive:
+            names = archive.getnames()
+            manifest = archive.extractfile(z.EXPORT_MANIFEST_NAME).read().decode("utf-8")
+            first = archive.extractfile("images/img_1.jpg").read()
+    assert sorted(names) == sorted(["images/img_1.jpg", "images/img_2.jpg", "images/img_1_2.jpg",
+                                    z.EXPORT_MANIFEST_NAME])
+    with open(records[0]["path"], "rb") as f:
+        assert first == f.read()
+    rows = [json.loads(line) for line in manifest.splitlines()]
+    assert [r["prompt"] for r in rows] == ["prompt 0", "prompt 1", "prompt 2"]
+    assert rows[2]["file"] == "images/img_1_2.jpg"
+
+
+def test_export_archive_cancelled_leaves_nothing(tmp_path, records):
+    dest = str(tmp_path / "out.zip")
+    calls = []
+    result = z.export_archive(records, dest, cancelled=lambda: calls.append(1) or len(calls) > 1)
+    assert result["cancelled"] and result["images"] == 1
+    assert not os.path.exists(dest) and not os.path.exists(dest + ".part")
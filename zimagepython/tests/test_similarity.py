@@ -0,0 +1,56 @@
+import random
+
+import zimage_ui as z
+
+
+def index_with(tmp_path, values):
+    index = z.SimilarityIndex(str(tmp_path))
+    index.hashes = {f"img_{i:03d}.jpg": (0.0, value) for i, value in enumerate(values)}
+    return index
+
+
+def brute_force_groups(values, max_distance):
+    parent = list(range(len(values)))
+
+    def find(i):
+        while parent[i] != i:
+            i = parent[i]
+        return i
+    for i in range(len(values)):
+        for j in range(i + 1, len(values)):
+            if bin(values[i] ^ values[j]).count("1") <= max_distance:
+                parent[find(j)] = find(i)
+    groups = {}
+    for i in range(len(values)):
+        groups.setdefault(find(i), []).append(f"img_{i:03d}.jpg")
+    return sorted(sorted(g) for g in groups.values() if len(g) > 1)
+
+
+def test_duplicate_groups_links_chains_and_skips_far_hashes(tmp_path):
+    base = 0x0123456789ABCDEF
+    values = [base, base ^ 0b1, base ^ 0b1 ^ (0b1111 << 20), ~base & (2 ** 64 - 1), base ^ (0b11111 << 40)]
+    groups = index_with(tmp_path, values).duplicate_groups(max_distance=4)
+    # 0 与 1 相差 1 位，1 与 2 相差 4 位：三者连成一组；3 与 4 离所有哈希都超过 4 位
+    assert groups == [["img_000.jpg", "img_001.jpg", "img_002.jpg"]]
+    assert index_with(tmp_path, values).duplicate_groups(max_distance=0) == []
+
+
+def test_duplicate_groups_matches_brute_force(tmp_path):
+    rng = random.Random(7)
+    values = []
+    for _ in range(40):
+        center = rng.getrandbits(64)
+        values.append(center)
+        for _ in range(rng.randrange(3)):
+            value = center
+            for bit in rng.sample(range(64), rng.randrange(8)):
+                value ^= 1 << bit
+            values.append(value)
+    for max_distance in (0, 2, 4, 6):
+        groups = index_with(tmp_path, values).duplicate_groups(max_distance)
+        assert sorted(groups) == brute_force_groups(values, max_distance)
+        assert [len(g) for g in groups] == sorted((len(g) for g in groups), reverse=True)
+
+
+def test_duplicate_groups_empty_index(tmp_path):
+    assert index_with(tmp_path, []).duplicate_groups() == []
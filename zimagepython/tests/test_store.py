@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+import zimage_ui as z
+
+
+def read_index(output_dir):
+    with open(os.path.join(output_dir, z.STORE_INDEX_NAME), encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def sha256_file(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+META = {"name": "img_20300101_000000.jpg", "prompt": "a red cat", "model": "m", "resolution": "32x32",
+        "timestamp": "20300101_000000"}
+
+
+def test_store_image_names_object_by_digest_and_writes_sidecar(tmp_path, jpeg_bytes):
+    data = jpeg_bytes()
+    digest = hashlib.sha256(data).hexdigest()
+    path, deduped = z.store_image(data, ".jpg", META, output_dir=str(tmp_path))
+
+    assert not deduped
+    assert path == z.object_path(digest, ".jpg", str(tmp_path))
+    assert sha256_file(path) == digest
+    with open(z.sidecar_path(path), encoding="utf-8") as f:
+        sidecar = json.load(f)
+    assert sidecar["prompt"] == "a red cat"
+    assert sidecar["sha256"] == sidecar["source_sha256"] == digest
+    [entry] = read_index(str(tmp_path))
+    assert entry["name"] == META["name"]
+    assert entry["object"] == f"objects/{digest[:2]}/{digest}.jpg"
+    assert "sha256" not in entry
+    assert os.path.exists(tmp_path / z.LINKS_DIRNAME / "20300101" / META["name"])
+
+
+def test_store_image_dedupes_but_indexes_every_generation(tmp_path, jpeg_bytes):
+    data = jpeg_bytes()
+    first, _ = z.store_image(data, ".jpg", META, output_dir=str(tmp_path))
+    again = {**META, "name": "img_20300102_000000.jpg", "prompt": "again", "timestamp": "20300102_000000"}
+    second, deduped = z.store_image(data, ".jpg", again, output_dir=str(tmp_path))
+
+    assert deduped and second == first
+    assert [e["name"] for e in read_index(str(tmp_path))] == [META["name"], again["name"]]
+    with open(z.sidecar_path(first), encoding="utf-8") as f:
+        assert json.load(f)["prompt"] == "again" # 附属文件记录最近一次生成
+
+
+def test_store_image_embedded_records_both_digests(tmp_path, jpeg_bytes):
+    data = jpeg_bytes()
+    digest = hashlib.sha256(data).hexdigest()
+    path, _ = z.store_image(data, ".jpg", META, output_dir=str(tmp_path), embed=True)
+
+    assert os.path.basename(path) == digest + ".jpg"
+    assert not os.path.exists(z.sidecar_path(path))
+    file_digest = sha256_file(path)
+    assert file_digest != digest
+    assert z.read_embedded_metadata(path)["source_sha256"] == digest
+    [entry] = read_index(str(tmp_path))
+    assert entry["sha256"] == file_digest
+
+    _, deduped = z.store_image(data, ".jpg", {**META, "name": "img_2.jpg"}, output_dir=str(tmp_path), embed=True)
+    assert deduped
+    assert read_index(str(tmp_path))[1]["sha256"] == file_digest
+
+
+def test_migrate_flat_store_moves_images_sidecars_and_derivatives(tmp_path, jpeg_bytes):
+    data = jpeg_bytes()
+    digest = hashlib.sha256(data).hexdigest()
+    (tmp_path / "img_a.jpg").write_bytes(data)
+    (tmp_path / "img_a.json").write_text(json.dumps({"prompt": "flat", "timestamp": "20300101_000000"}))
+    thumb_dir = tmp_path / ".derived" / "thumb"
+    thumb_dir.mkdir(parents=True)
+    (thumb_dir / "img_a.jpg").write_bytes(b"thumb")
+    (tmp_path / "notes.jpg").write_bytes(b"not a generated image")
+
+    assert z.migrate_flat_store(str(tmp_path)) == 1
+
+    obj = z.object_path(digest, ".jpg", str(tmp_path))
+    assert sha256_file(obj) == digest
+    assert not (tmp_path / "img_a.jpg").exists()
+    assert not (tmp_path / "img_a.json").exists()
+    assert (tmp_path / "notes.jpg").exists()
+    with open(z.sidecar_path(obj), encoding="utf-8") as f:
+        sidecar = json.load(f)
+    assert sidecar["prompt"] == "flat" and sidecar["file_path"] == obj
+    assert (thumb_dir / (digest + ".jpg")).read_bytes() == b"thumb"
+    assert len(read_index(str(tmp_path))) == 1
+    assert z.migrate_flat_store(str(tmp_path)) == 0
+
+
+def test_migrate_flat_store_keeps_one_copy_of_identical_images(tmp_path, jpeg_bytes):
+    data = jpeg_bytes()
+    for name in ("img_a.jpg", "img_b.jpg"):
+        (tmp_path / name).write_bytes(data)
+
+    assert z.migrate_flat_store(str(tmp_path)) == 2
+    objects = [f for _, _, files in os.walk(tmp_path / z.STORE_DIRNAME) for f in files if f.endswith(".jpg")]
+    assert len(objects) == 1
+    assert not any(f.startswith("img_") for f in os.listdir(tmp_path))
+
+
+@pytest.mark.parametrize("ext, make", [(".jpg", "jpeg_bytes"), (".png", "png_bytes")])
+def test_embed_metadata_round_trip(tmp_path, request, ext, make):
+    from PIL import Image
+    data = request.getfixturevalue(make)()
+    metadata = {**META, "prompt": 'quotes " & <tags> 中文', "not_embedded": "dropped"}
+    embedded = z.embed_metadata(data, ext, metadata)
+    path = tmp_path / ("out" + ext)
+    path.write_bytes(embedded)
+
+    read = z.read_embedded_metadata(str(path))
+    assert read == {k: v for k, v in metadata.items() if k in z.EMBEDDED_FIELDS}
+    with Image.open(path) as image:
+        image.load() # 像素数据未被改动
+        assert image.size == (32, 32)
+
+
+def test_embed_metadata_unsupported_and_plain_files(tmp_path, jpeg_bytes):
+    assert z.embed_metadata(b"RIFF....WEBP", ".webp", META) is None
+    assert z.embed_metadata(jpeg_bytes(), ".jpg", {**META, "prompt": "x" * 70000}) is None
+    plain = tmp_path / "plain.jpg"
+    plain.write_bytes(jpeg_bytes())
+    assert z.read_embedded_metadata(str(plain)) is None
+
+
+def test_diff_output_snapshots():
+    old = {"a.jpg": (1, 10), "a.json": (1, 2), "b.jpg": (1, 10), "c.png": (1, 10), "c.json": (1, 2)}
+    new = {"a.jpg": (1, 10), "a.json": (2, 3), "c.png": (2, 11), "c.json": (1, 2),
+           "d.webp": (3, 10), "d.json": (3, 2)}
+    added, removed, changed = z.diff_output_snapshots(old, new)
+    assert added == ["d.webp"]
+    assert removed == ["b.jpg"]
+    assert changed == ["a.jpg", "c.png"] # 新增图片的附属文件不算修改
+    assert z.diff_output_snapshots(new, new) == ([], [], [])
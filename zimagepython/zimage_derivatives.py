@@ -0,0 +1,37 @@
+"""Image derivatives (thumbnails, previews, re-encodes) built by zimage_ui's process pool.
+
+The pool's worker processes import only this module, so it must stay free of Qt and of
+zimage_ui's start-up side effects (output directories, logging rules, global indexes).
+"""
+import os
+import time
+
+THUMBNAIL_SIZE = 200
+
+# 派生图片类型：新增一种只需在此登记 (扩展名、PIL 保存格式与参数、可选的最长边)。
+# 由 config.json 的 "derivatives" 选择启用哪些，默认只生成画廊缩略图。
+DERIVATIVE_KINDS = {
+    "thumb": {"ext": ".jpg", "format": "JPEG", "size": THUMBNAIL_SIZE, "options": {"quality": 85}},
+    "preview_1024": {"ext": ".jpg", "format": "JPEG", "size": 1024, "options": {"quality": 88, "progressive": True}},
+    "preview_2048": {"ext": ".jpg", "format": "JPEG", "size": 2048, "options": {"quality": 90, "progressive": True}},
+    "webp": {"ext": ".webp", "format": "WEBP", "options": {"quality": 90, "method": 4}},
+    "jpeg_optimized": {"ext": ".jpg", "format": "JPEG", "options": {"quality": 90, "optimize": True, "progressive": True}},
+}
+
+def build_derivative(kind, src, dst):
+    """Runs in a worker process: write the `kind` derivative of src to dst. Returns (elapsed ms, bytes)."""
+    from PIL import Image
+    t_start = time.perf_counter()
+    spec = DERIVATIVE_KINDS[kind]
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    with Image.open(src) as image:
+        if spec.get("size"):
+            # JPEG 可在解码时直接按 1/2、1/4、1/8 缩小，缩略图不必解码整张原图
+            image.draft("RGB", (spec["size"], spec["size"]))
+        image = image.convert("RGB")
+        if spec.get("size"):
+            image.thumbnail((spec["size"], spec["size"]), Image.LANCZOS)
+        tmp = dst + ".part"
+        image.save(tmp, format=spec["format"], **spec.get("options", {}))
+    os.replace(tmp, dst)
+    return round((time.perf_counter() - t_start) * 1000, 1), os.path.getsize(dst)
@@ -1,21 +1,38 @@
 import sys
 import json
 import time
-import requests
+_MODULE_T0 = time.perf_counter() # 用于记录启动耗时
+import multiprocessing
+if __name__ == "__main__":
+    # 打包后派生图片进程池的子进程从这里进入：在导入 Qt、创建目录与全局对象之前就转为工作进程
+    multiprocessing.freeze_support()
 import os
 import datetime
-import glob
+import uuid
+import threading
+import weakref
+import functools
+import traceback
+from collections import deque, defaultdict
+from contextlib import contextmanager
 from io import BytesIO
-from PIL import Image
 import re
 import html as html_lib
+import bisect
+import heapq
+import math
+from array import array
 from PySide6.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, 
                                QLineEdit, QTextEdit, QPushButton, QComboBox, 
                                QMessageBox, QFormLayout, QScrollArea, QFrame, 
                                QSizePolicy, QFileDialog, QToolButton, QDialog, QLayout,
-                               QWidgetItem, QGraphicsDropShadowEffect)
-from PySide6.QtGui import QPixmap, QImage, QIcon, QAction, QColor, QPalette
-from PySide6.QtCore import QThread, Signal, Qt, QSize, QPoint, QRect, QEvent
+                               QWidgetItem, QGraphicsDropShadowEffect, QCheckBox, QTextBrowser,
+                               QProgressBar, QDateEdit, QCompleter, QTabWidget)
+from PySide6.QtGui import (QPixmap, QImage, QImageReader, QIcon, QAction, QColor, QPalette, QPainter, QPainterPath,
+                           QTextCursor)
+from PySide6.QtCore import (QThread, QObject, Signal, Qt, QSize, QPoint, QRect, QEvent, QTimer, QDate,
+                            QBuffer, QByteArray, QIODevice, QLoggingCategory, QStringListModel)
+from zimage_derivatives import THUMBNAIL_SIZE, DERIVATIVE_KINDS, build_derivative
 
 # 确保输出目录存在
 if getattr(sys, 'frozen', False):
@@ -29,6 +46,9 @@ OUTPUT_DIR = os.path.join(BASE_DIR, "zimage")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 CONFIG_FILE = os.path.join(BASE_DIR, "config.json")
+# ZIMAGE_API_BASE 可指向本地模拟服务 (bench/mock_modelscope.py)
+API_BASE_URL = os.environ.get("ZIMAGE_API_BASE", "https://api-inference.modelscope.cn/").rstrip("/") + "/"
+POLL_INTERVAL = float(os.environ.get("ZIMAGE_POLL_INTERVAL", "2"))
 def resource_path(name):
     if getattr(sys, 'frozen', False):
         base = getattr(sys, '_MEIPASS', BASE_DIR)
@@ -39,8 +59,886 @@ def resource_path(name):
 ICON_PATH = resource_path("logo.ico")
 AI_AVATAR_PATH = resource_path("logo.png")
 USER_AVATAR_PATH = resource_path("user_avatar.png")
+USER_AVATAR_URL = "https://www.gravatar.com/avatar/00000000000000000000000000000000?d=mp&s=96"
+HISTORY_BATCH_SIZE = 40 # 启动时每轮事件循环添加的历史卡片数
+DEFAULT_IMAGE_CACHE_MB = 256 # 缩略图与预览图的内存上限 (config.json: image_cache_mb)
+PREFETCH_RADIUS = 2 # 详情页预先解码前后各 N 张
+DOWNLOAD_CHUNK_SIZE = 16 * 1024
+PREVIEW_MIN_BYTES = 32 * 1024 # 下载中预览：至少收到这么多字节后才尝试解码
+PREVIEW_STEPS = 4 # 已知文件大小时，每收到约 1/N 更新一次预览
+PREVIEW_INTERVAL = 0.2 # 两次预览之间的最小间隔 (秒)
+PREVIEW_PATH_PREFIX = "preview:" # 占位卡片在图片缓存中的键前缀 (不是磁盘路径)
 SYSTEM_PROMPT_CN = "回答要简短，不要长篇大论，直接给答案。你的设定是钢铁侠的助手甲维斯。"
 
+LOG_DIR = os.path.join(BASE_DIR, "logs")
+GENERATION_METRICS_LOG = os.path.join(LOG_DIR, "generation_metrics.jsonl")
+CHAT_METRICS_LOG = os.path.join(LOG_DIR, "chat_metrics.jsonl")
+CHAT_STATS_FILE = os.path.join(LOG_DIR, "chat_stats.json")
+STALL_LOG = os.path.join(LOG_DIR, "ui_stalls.jsonl")
+STARTUP_LOG = os.path.join(LOG_DIR, "startup.jsonl")
+PROFILE_DIR = os.path.join(LOG_DIR, "profile")
+DERIVATIVE_METRICS_LOG = os.path.join(LOG_DIR, "derivatives.jsonl")
+RETENTION_LOG = os.path.join(LOG_DIR, "retention.jsonl")
+CONNECTION_METRICS_LOG = os.path.join(LOG_DIR, "connections.jsonl")
+ERROR_LOG = os.path.join(LOG_DIR, "errors.jsonl")
+
+def cli_option(name, default=None):
+    """Value following `name` in sys.argv, e.g. cli_option("--profile-seconds")."""
+    if name in sys.argv:
+        i = sys.argv.index(name)
+        if i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+    return default
+
+# 性能诊断模式：设置 ZIMAGE_PROFILE=1 或使用 --profile 启动
+PROFILE_ENABLED = os.environ.get("ZIMAGE_PROFILE") == "1" or "--profile" in sys.argv
+STALL_THRESHOLD_MS = float(os.environ.get("ZIMAGE_STALL_MS", "100"))
+PROFILE_SAMPLE_EVERY = max(1, int(os.environ.get("ZIMAGE_PROFILE_SAMPLE", "1")))
+
+# --- Metrics (耗时统计) ---
+_metrics_loggers = {}
+
+def get_metrics_logger(path):
+    """Logger that appends one JSON record per line to `path`, rotating at 2 MB (3 backups)."""
+    logger = _metrics_loggers.get(path)
+    if logger is None:
+        import logging
+        from logging.handlers import RotatingFileHandler
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        logger = logging.getLogger("zimage.metrics." + os.path.basename(path))
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        if not logger.handlers:
+            handler = RotatingFileHandler(path, maxBytes=2 * 1024 * 1024, backupCount=3, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+        _metrics_loggers[path] = logger
+    return logger
+
+def write_metrics(path, record):
+    try:
+        get_metrics_logger(path).info(json.dumps(record, ensure_ascii=False))
+    except Exception as e:
+        print(f"Error writing metrics: {e}")
+
+def log_error(message):
+    """Print an error and append it to ERROR_LOG, so builds without a console (console=False) keep it too."""
+    print(message)
+    write_metrics(ERROR_LOG, {"ts": datetime.datetime.now().isoformat(timespec="seconds"),
+                              "thread": threading.current_thread().name, "error": message})
+
+def read_metrics(path):
+    """Read all records from a metrics log, including rotated backups (oldest first)."""
+    records = []
+    for p in [f"{path}.{i}" for i in range(3, 0, -1)] + [path]:
+        if not os.path.exists(p):
+            continue
+        with open(p, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of a non-empty list."""
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    k = (len(ordered) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+class GenerationSpan:
+    """Phase timings (ms) for one generation job, written to GENERATION_METRICS_LOG when finished."""
+    FIELDS = ["handshake_ms", "submit_ms", "queue_wait_ms", "remote_gen_ms", "polls", "first_preview_ms", "download_ms",
+              "download_bytes", "decode_ms", "save_ms", "images", "rate_wait_ms", "signal_ms", "thumbnail_ms", "card_ms", "time_to_card_ms", "total_ms"]
+
+    def __init__(self, model, resolution):
+        self.t0 = time.perf_counter()
+        self.marks = {}
+        self.done = False
+        self.record = {
+            "job_id": uuid.uuid4().hex[:12],
+            "ts": datetime.datetime.now().isoformat(timespec="seconds"),
+            "model": model,
+            "resolution": resolution,
+            "status": "pending",
+            "polls": 0,
+        }
+
+    def mark(self, name):
+        self.marks[name] = time.perf_counter()
+
+    def since(self, name):
+        return round((time.perf_counter() - self.marks.get(name, self.t0)) * 1000, 1)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            key = name + "_ms"
+            self.record[key] = round(self.record.get(key, 0) + (time.perf_counter() - start) * 1000, 1)
+
+    def set(self, key, value):
+        self.record[key] = value
+
+    def finish(self, status="ok", error=None):
+        if self.done:
+            return
+        self.done = True
+        self.record["status"] = status
+        if error:
+            self.record["error"] = str(error)[:500]
+        self.record["total_ms"] = self.since(None)
+        write_metrics(GENERATION_METRICS_LOG, self.record)
+
+def summarize_generation_metrics(path=GENERATION_METRICS_LOG):
+    """p50/p95 of every span field, grouped by (model, resolution)."""
+    groups = {}
+    for r in read_metrics(path):
+        key = (r.get("model", "?"), r.get("resolution", "?"))
+        groups.setdefault(key, []).append(r)
+    summary = []
+    for (model, resolution), rows in sorted(groups.items()):
+        # 缓存命中与合并的请求没有远端阶段，单独计数，不参与耗时分位数
+        ok_rows = [r for r in rows if r.get("status") == "ok" and r.get("source", "remote") == "remote"]
+        entry = {"model": model, "resolution": resolution, "count": len(ok_rows),
+                 "errors": len([r for r in rows if r.get("status") != "ok"]),
+                 "cached": len([r for r in rows if r.get("source") == "cached"]),
+                 "coalesced": len([r for r in rows if r.get("source") == "coalesced"])}
+        for field in GenerationSpan.FIELDS:
+            vals = [r[field] for r in ok_rows if isinstance(r.get(field), (int, float))]
+            if vals:
+                entry[field] = {"p50": round(percentile(vals, 50), 1), "p95": round(percentile(vals, 95), 1)}
+        # 连接预热的效果：复用连接 (warm) 与新建连接 (cold) 时的提交耗时
+        for connection in ("warm", "cold"):
+            vals = [r["submit_ms"] for r in ok_rows
+                    if r.get("connection") == connection and isinstance(r.get("submit_ms"), (int, float))]
+            if vals:
+                entry["submit_ms_" + connection] = {"count": len(vals), "p50": round(percentile(vals, 50), 1),
+                                                    "p95": round(percentile(vals, 95), 1)}
+        summary.append(entry)
+    return summary
+
+class ChatStreamStats:
+    """Connect time, time-to-first-token, inter-token gaps and usage for one chat request."""
+    LIVE_INTERVAL = 0.25 # 实时读数的最小刷新间隔 (秒)
+
+    def __init__(self, model):
+        self.model = model
+        self.t0 = time.perf_counter()
+        self.connected = None
+        self.connection = {} # {"connection": "warm" | "cold", "handshake_ms"}
+        self.first_token = None
+        self.last_token = None
+        self.last_live = 0.0
+        self.gaps = []
+        self.chunks = 0
+        self.usage = None
+
+    def on_connected(self, connection=None):
+        self.connected = time.perf_counter()
+        self.connection = connection or {}
+
+    def on_token(self):
+        now = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = now
+        else:
+            self.gaps.append((now - self.last_token) * 1000)
+        self.last_token = now
+        self.chunks += 1
+
+    def live_due(self):
+        now = time.perf_counter()
+        if now - self.last_live >= self.LIVE_INTERVAL:
+            self.last_live = now
+            return True
+        return False
+
+    def tokens_per_sec(self):
+        tokens = (self.usage or {}).get("completion_tokens") or self.chunks
+        if self.first_token is None or self.last_token is None or self.last_token <= self.first_token:
+            return 0.0
+        return tokens / (self.last_token - self.first_token)
+
+    def snapshot(self, live=True):
+        ms = lambda t: round((t - self.t0) * 1000, 1) if t is not None else None
+        return {"model": self.model, "live": live, "ttft_ms": ms(self.first_token),
+                "chunks": self.chunks, "tokens_per_sec": round(self.tokens_per_sec(), 1)}
+
+    def to_record(self, status="ok", error=None):
+        ms = lambda t: round((t - self.t0) * 1000, 1) if t is not None else None
+        usage = self.usage or {}
+        record = {
+            "ts": datetime.datetime.now().isoformat(timespec="seconds"),
+            "model": self.model,
+            "status": status,
+            "connect_ms": ms(self.connected),
+            "connection": self.connection.get("connection"),
+            "handshake_ms": self.connection.get("handshake_ms"),
+            "ttft_ms": ms(self.first_token),
+            "duration_ms": ms(time.perf_counter()),
+            "chunks": self.chunks,
+            "gap_p50_ms": round(percentile(self.gaps, 50), 1) if self.gaps else None,
+            "gap_p95_ms": round(percentile(self.gaps, 95), 1) if self.gaps else None,
+            "gap_max_ms": round(max(self.gaps), 1) if self.gaps else None,
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "completion_tokens": usage.get("completion_tokens") or self.chunks,
+            "total_tokens": usage.get("total_tokens"),
+            "tokens_source": "usage" if usage.get("completion_tokens") else "chunks",
+            "tokens_per_sec": round(self.tokens_per_sec(), 1),
+        }
+        if error:
+            record["error"] = str(error)[:500]
+        return record
+
+_chat_stats_lock = threading.Lock()
+
+def record_chat_metrics(record):
+    """Append a chat record to CHAT_METRICS_LOG and fold it into the per-model totals in CHAT_STATS_FILE."""
+    write_metrics(CHAT_METRICS_LOG, record)
+    with _chat_stats_lock:
+        try:
+            with open(CHAT_STATS_FILE, "r", encoding="utf-8") as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            stats = {}
+        m = stats.setdefault(record["model"], {"requests": 0, "errors": 0, "ttft_ms_sum": 0.0, "ttft_count": 0,
+                                               "duration_ms_sum": 0.0, "prompt_tokens": 0, "completion_tokens": 0})
+        m["requests"] += 1
+        if record.get("status") != "ok":
+            m["errors"] += 1
+        if record.get("ttft_ms") is not None:
+            m["ttft_ms_sum"] += record["ttft_ms"]
+            m["ttft_count"] += 1
+        m["duration_ms_sum"] += record.get("duration_ms") or 0
+        m["prompt_tokens"] += record.get("prompt_tokens") or 0
+        m["completion_tokens"] += record.get("completion_tokens") or 0
+        m["last_used"] = record["ts"]
+        try:
+            os.makedirs(LOG_DIR, exist_ok=True)
+            with open(CHAT_STATS_FILE, "w", encoding="utf-8") as f:
+                json.dump(stats, f, indent=4, ensure_ascii=False)
+        except Exception as e:
+            log_error(f"Error saving chat stats: {e}")
+
+def bundle_layout():
+    """'source', 'onefile' or 'onedir' (PyInstaller onedir keeps _MEIPASS next to the executable)."""
+    if not getattr(sys, 'frozen', False):
+        return "source"
+    meipass = os.path.abspath(getattr(sys, '_MEIPASS', ""))
+    return "onedir" if meipass.startswith(os.path.dirname(os.path.abspath(sys.executable))) else "onefile"
+
+def record_startup_time():
+    """Log time from module import (and from launch, if ZIMAGE_LAUNCH_TS is set) to the first painted frame."""
+    record = {
+        "ts": datetime.datetime.now().isoformat(timespec="seconds"),
+        "layout": bundle_layout(),
+        "module_to_paint_ms": round((time.perf_counter() - _MODULE_T0) * 1000, 1),
+    }
+    launch_ts = os.environ.get("ZIMAGE_LAUNCH_TS")
+    if launch_ts:
+        try:
+            record["since_launch_ms"] = round((time.time() - float(launch_ts)) * 1000, 1)
+        except ValueError:
+            pass
+    write_metrics(STARTUP_LOG, record)
+    return record
+
+def print_metrics_summary():
+    summary = summarize_generation_metrics()
+    if not summary:
+        print(f"No generation metrics in {GENERATION_METRICS_LOG}")
+    for entry in summary:
+        print(f"{entry['model']}  {entry['resolution']}  ok={entry['count']} errors={entry['errors']} "
+              f"cached={entry['cached']} coalesced={entry['coalesced']}")
+        for field in GenerationSpan.FIELDS:
+            if field in entry:
+                print(f"    {field:<16} p50={entry[field]['p50']:>10}  p95={entry[field]['p95']:>10}")
+        warm, cold = entry.get("submit_ms_warm"), entry.get("submit_ms_cold")
+        for name, stats in (("submit warm", warm), ("submit cold", cold)):
+            if stats:
+                print(f"    {name:<16} p50={stats['p50']:>10}  p95={stats['p95']:>10}  n={stats['count']}")
+        if warm and cold:
+            print(f"    warm connection saves ~{cold['p50'] - warm['p50']:.1f} ms per submit (p50)")
+    warmups = read_metrics(CONNECTION_METRICS_LOG)
+    if warmups:
+        ok = [r for r in warmups if r.get("status") == "ok"]
+        line = f"connection warm-ups  runs={len(warmups)} errors={len(warmups) - len(ok)}"
+        handshakes = [r["handshake_ms"] for r in ok if isinstance(r.get("handshake_ms"), (int, float))]
+        if handshakes:
+            line += f"  handshake p50={percentile(handshakes, 50):.1f}ms p95={percentile(handshakes, 95):.1f}ms"
+        print(line)
+    startups = {}
+    for r in read_metrics(STARTUP_LOG):
+        startups.setdefault(r.get("layout", "?"), []).append(r)
+    for layout, rows in sorted(startups.items()):
+        print(f"startup ({layout})  runs={len(rows)}")
+        for field in ("module_to_paint_ms", "since_launch_ms"):
+            vals = [r[field] for r in rows if isinstance(r.get(field), (int, float))]
+            if vals:
+                print(f"    {field:<20} p50={percentile(vals, 50):>10.1f}  p95={percentile(vals, 95):>10.1f}")
+    derived = {}
+    for r in read_metrics(DERIVATIVE_METRICS_LOG):
+        derived.setdefault(r.get("kind", "?"), []).append(r)
+    for kind, rows in sorted(derived.items()):
+        ok = [r["ms"] for r in rows if r.get("status") == "ok"]
+        line = f"derivative {kind}  jobs={len(rows)} errors={len(rows) - len(ok)}"
+        if ok:
+            line += f"  p50={percentile(ok, 50):.1f}ms  p95={percentile(ok, 95):.1f}ms"
+        print(line)
+    try:
+        with open(CHAT_STATS_FILE, "r", encoding="utf-8") as f:
+            chat_stats = json.load(f)
+    except (OSError, ValueError):
+        chat_stats = {}
+    chat_records = read_metrics(CHAT_METRICS_LOG)
+    for model, m in sorted(chat_stats.items()):
+        rows = [r for r in chat_records if r.get("model") == model and r.get("status") == "ok"]
+        avg_ttft = m["ttft_ms_sum"] / m["ttft_count"] if m["ttft_count"] else 0
+        print(f"{model}  requests={m['requests']} errors={m['errors']} avg_ttft_ms={avg_ttft:.0f} "
+              f"prompt_tokens={m['prompt_tokens']} completion_tokens={m['completion_tokens']}")
+        for field in ("connect_ms", "ttft_ms", "gap_p95_ms", "tokens_per_sec"):
+            vals = [r[field] for r in rows if isinstance(r.get(field), (int, float))]
+            if vals:
+                print(f"    {field:<16} p50={percentile(vals, 50):>10.1f}  p95={percentile(vals, 95):>10.1f}")
+        for connection in ("warm", "cold"):
+            vals = [r["connect_ms"] for r in rows
+                    if r.get("connection") == connection and isinstance(r.get("connect_ms"), (int, float))]
+            if vals:
+                print(f"    connect {connection:<8} p50={percentile(vals, 50):>10.1f}  p95={percentile(vals, 95):>10.1f}  "
+                      f"n={len(vals)}")
+    errors = read_metrics(ERROR_LOG)
+    if errors:
+        print(f"errors  logged={len(errors)}  (last {min(len(errors), 5)} below, full list in {ERROR_LOG})")
+        for r in errors[-5:]:
+            print(f"    {r.get('ts')}  [{r.get('thread')}]  {r.get('error')}")
+
+# --- Profiling (性能诊断) ---
+_current_slot = [None] # 当前在 GUI 线程上运行的槽函数名，供卡顿检测记录
+
+class SlotProfiler:
+    """Per-slot call timing with sampled cProfile and tracemalloc, aggregated until write_report()."""
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        import tracemalloc
+        self.tracemalloc = tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+        self.stats = {}
+        self.profiles = {}
+        self.active = threading.local()
+
+    def run(self, label, fn, args, kwargs):
+        import cProfile
+        on_main = threading.current_thread() is threading.main_thread()
+        prev_slot = _current_slot[0]
+        if on_main:
+            _current_slot[0] = label
+        st = self.stats.setdefault(label, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "alloc_peak_kb": 0.0})
+        st["calls"] += 1
+        profiler = None
+        # cProfile 不能嵌套：外层槽已在采样时，内层只计时
+        if (st["calls"] - 1) % PROFILE_SAMPLE_EVERY == 0 and not getattr(self.active, "on", False):
+            profiler = self.profiles.setdefault(label, cProfile.Profile())
+            self.active.on = True
+            mem_before = self.tracemalloc.get_traced_memory()[0]
+            self.tracemalloc.reset_peak()
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            if profiler is not None:
+                profiler.disable()
+                self.active.on = False
+                peak = self.tracemalloc.get_traced_memory()[1]
+                st["alloc_peak_kb"] = max(st["alloc_peak_kb"], round((peak - mem_before) / 1024, 1))
+            st["total_ms"] = round(st["total_ms"] + elapsed, 2)
+            st["max_ms"] = round(max(st["max_ms"], elapsed), 2)
+            if on_main:
+                _current_slot[0] = prev_slot
+
+    def write_report(self, out_dir):
+        import pstats
+        os.makedirs(out_dir, exist_ok=True)
+        for label, profiler in self.profiles.items():
+            safe = re.sub(r"[^\w.-]", "_", label)
+            profiler.dump_stats(os.path.join(out_dir, f"{safe}.prof"))
+            with open(os.path.join(out_dir, f"{safe}.txt"), "w", encoding="utf-8") as f:
+                pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(30)
+        snapshot = self.tracemalloc.take_snapshot()
+        with open(os.path.join(out_dir, "tracemalloc_top.txt"), "w", encoding="utf-8") as f:
+            for stat in snapshot.statistics("lineno")[:30]:
+                f.write(f"{stat}\n")
+        return self.stats
+
+def profiled_slot(name=None):
+    """Mark a hot GUI slot. Returns the function unchanged unless profiling is enabled."""
+    def decorate(fn):
+        if not PROFILE_ENABLED:
+            return fn
+        label = name or fn.__qualname__
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return SlotProfiler.instance().run(label, fn, args, kwargs)
+        return wrapper
+    return decorate
+
+class StallDetector(QObject):
+    """Heartbeat on the GUI event loop; a watchdog thread captures the GUI stack when a beat is overdue."""
+
+    def __init__(self, parent=None, interval_ms=20, threshold_ms=STALL_THRESHOLD_MS):
+        super().__init__(parent)
+        self.interval = interval_ms / 1000.0
+        self.threshold = threshold_ms / 1000.0
+        self.main_ident = threading.get_ident()
+        self.last_beat = time.perf_counter()
+        self.latencies = deque(maxlen=200000)
+        self.pending = None # 看门狗捕获到、等待心跳恢复后补全时长的卡顿
+        self.stall_count = 0
+        self.lock = threading.Lock()
+        self.running = False
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.on_beat)
+
+    def start(self):
+        self.running = True
+        self.last_beat = time.perf_counter()
+        self.timer.start(int(self.interval * 1000))
+        threading.Thread(target=self.watchdog, name="stall-watchdog", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.timer.stop()
+
+    def on_beat(self):
+        now = time.perf_counter()
+        with self.lock:
+            gap = now - self.last_beat
+            self.last_beat = now
+            pending, self.pending = self.pending, None
+        late_ms = max(0.0, (gap - self.interval) * 1000)
+        self.latencies.append(late_ms)
+        if gap >= self.threshold:
+            self.stall_count += 1
+            record = pending or {"slot": None, "stack": None}
+            record.update({"ts": datetime.datetime.now().isoformat(timespec="seconds"),
+                           "stall_ms": round(gap * 1000, 1)})
+            write_metrics(STALL_LOG, record)
+
+    def watchdog(self):
+        while self.running:
+            time.sleep(self.threshold / 4)
+            with self.lock:
+                overdue = time.perf_counter() - self.last_beat >= self.threshold
+                if not overdue or self.pending is not None:
+                    continue
+                frame = sys._current_frames().get(self.main_ident)
+                self.pending = {
+                    "slot": _current_slot[0],
+                    "stack": traceback.format_stack(frame)[-25:] if frame is not None else None,
+                }
+
+    def summary(self):
+        lat = list(self.latencies)
+        if not lat:
+            return {"beats": 0, "stalls": self.stall_count}
+        return {"beats": len(lat), "stalls": self.stall_count,
+                "latency_p50_ms": round(percentile(lat, 50), 2), "latency_p95_ms": round(percentile(lat, 95), 2),
+                "latency_p99_ms": round(percentile(lat, 99), 2), "latency_max_ms": round(max(lat), 2)}
+
+def install_profiling(app):
+    """Start the stall detector and write the profile report when the app quits."""
+    detector = StallDetector(app)
+    detector.start()
+
+    def write_report():
+        detector.stop()
+        out_dir = os.path.join(PROFILE_DIR, datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
+        slots = SlotProfiler.instance().write_report(out_dir)
+        report = {"event_loop": detector.summary(), "stall_threshold_ms": STALL_THRESHOLD_MS, "slots": slots}
+        with open(os.path.join(out_dir, "report.json"), "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4, ensure_ascii=False)
+        print(f"Profile report written to {out_dir}")
+
+    app.aboutToQuit.connect(write_report)
+    return detector
+
+@profiled_slot()
+def render_markdown(text):
+    s = text
+    s = html_lib.escape(s)
+    s = re.sub(r"```([\s\S]*?)```", lambda m: f"<pre style='background:#f6f8fa;border:1px solid #e1e4e8;border-radius:6px;padding:8px;white-space:pre-wrap;'>{m.group(1)}</pre>", s)
+    s = re.sub(r"`([^`]+)`", r"<code style='background:#f6f8fa;border:1px solid #e1e4e8;border-radius:4px;padding:2px 4px;'>\1</code>", s)
+    s = re.sub(r"\*\*([^*]+)\*\*", r"<b>\1</b>", s)
+    s = re.sub(r"_([^_]+)_", r"<i>\1</i>", s)
+    s = re.sub(r"\\\(([^)]*)\\\)", r"<i>\1</i>", s)
+    s = re.sub(r"\[([^\]]+)\]\((https?://[^)]+)\)", r"<a href='\2' style='color:#2d8cf0;text-decoration:none;'>\1</a>", s)
+    s = s.replace("\n", "<br/>")
+    return s
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp")
+FORMAT_EXTS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+
+# 图片按内容哈希分片存放：OUTPUT_DIR/objects/ab/<sha256>.jpg (+ 同名 .json)。哈希取自下载的原始字节
+# (source_sha256)；嵌入元数据的文件另有自身的 sha256，记录在 index.jsonl 中。
+# index.jsonl 记录易读的文件名 (img_时间.jpg) 与对象的对应关系，by-date/ 下尽量建立同名链接。
+STORE_DIRNAME = "objects"
+STORE_INDEX_NAME = "index.jsonl"
+LINKS_DIRNAME = "by-date"
+_store_lock = threading.Lock()
+
+def atomic_write(path, data):
+    """Write bytes to path via a temp file in the same directory plus rename: readers never see a partial file."""
+    tmp = f"{path}.{uuid.uuid4().hex[:8]}.part"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def atomic_write_json(path, obj):
+    atomic_write(path, json.dumps(obj, ensure_ascii=False, indent=4).encode("utf-8"))
+
+def sidecar_path(img_path):
+    return img_path.rsplit('.', 1)[0] + ".json"
+
+def store_root(path):
+    """Output directory an image belongs to (the parent of objects/ for stored images)."""
+    shard_dir = os.path.dirname(path)
+    if os.path.basename(os.path.dirname(shard_dir)) == STORE_DIRNAME:
+        return os.path.dirname(os.path.dirname(shard_dir))
+    return shard_dir
+
+def object_path(digest, ext, output_dir=None):
+    return os.path.join(output_dir or OUTPUT_DIR, STORE_DIRNAME, digest[:2], digest + ext)
+
+def store_image(data, ext, metadata, output_dir=None, embed=False):
+    """Store downloaded image bytes under their SHA-256 and write the sidecar, both atomically.
+
+    metadata["name"] is the human-friendly file name recorded in the index. With embed the
+    metadata goes inside the image instead of a sidecar (when the format allows). Returns
+    (file_path, deduped); identical downloads already in the store are not written again,
+    but every generation is still recorded in the index.
+
+    The object is named by source_sha256, the hash of the downloaded bytes. Without embed
+    that is also the hash of the file (sha256). With embed the file holds the download
+    plus a metadata block, so sha256 differs from the name and is recorded separately;
+    source_sha256 is embedded in the file. On a dedupe hit the sidecar is rewritten to
+    describe the latest generation, while an embedded file keeps the metadata of the
+    generation that first stored it (the index entry carries the latest).
+    """
+    import hashlib
+    output_dir = output_dir or OUTPUT_DIR
+    digest = hashlib.sha256(data).hexdigest()
+    embedded = embed_metadata(data, ext, {**metadata, "source_sha256": digest}) if embed else None
+    file_path = object_path(digest, ext, output_dir)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    deduped = os.path.exists(file_path)
+    if embedded is None:
+        file_digest = digest
+    elif deduped:
+        with open(file_path, "rb") as f:
+            file_digest = hashlib.sha256(f.read()).hexdigest()
+    else:
+        file_digest = hashlib.sha256(embedded).hexdigest()
+    if not deduped:
+        atomic_write(file_path, data if embedded is None else embedded)
+    metadata = {**metadata, "filename": os.path.basename(file_path), "file_path": file_path,
+                "sha256": file_digest, "source_sha256": digest}
+    if embedded is None:
+        atomic_write_json(sidecar_path(file_path), metadata) # 重复的图片：附属文件记录最近一次生成
+    # 每次生成都记入 index.jsonl 与 by-date/，即使对象已经存在
+    record_store_entry(output_dir, metadata)
+    return file_path, deduped
+
+def record_store_entry(output_dir, metadata):
+    """Append the friendly name -> object mapping to index.jsonl and link it under by-date/ (best effort)."""
+    name = metadata.get("name") or metadata["filename"]
+    rel = os.path.relpath(metadata["file_path"], output_dir)
+    entry = {"name": name, "object": rel.replace(os.sep, "/"), "timestamp": metadata.get("timestamp"),
+             "model": metadata.get("model"), "prompt": metadata.get("prompt")}
+    if metadata.get("sha256") and metadata["sha256"] != metadata.get("source_sha256", metadata["sha256"]):
+        entry["sha256"] = metadata["sha256"] # 嵌入元数据的文件：文件本身的哈希，与对象名不同
+
+    with _store_lock:
+        with open(os.path.join(output_dir, STORE_INDEX_NAME), "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    day = (metadata.get("timestamp") or "")[:8] or "unknown"
+    link = os.path.join(output_dir, LINKS_DIRNAME, day, name)
+    try:
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        if not os.path.lexists(link):
+            try:
+                os.link(metadata["file_path"], link) # 硬链接不占额外空间，删除对象后仍可访问
+            except OSError:
+                os.symlink(os.path.relpath(metadata["file_path"], os.path.dirname(link)), link)
+    except OSError:
+        pass # 不支持链接的文件系统上只保留 index.jsonl
+
+def store_links(output_dir):
+    """{object path relative to output_dir: [by-date link paths]} for every generation in index.jsonl.
+
+    The same object appears once per generation that produced it (dedupe hits included).
+    """
+    links = defaultdict(list)
+    try:
+        with open(os.path.join(output_dir, STORE_INDEX_NAME), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    day = (entry.get("timestamp") or "")[:8] or "unknown"
+                    links[entry["object"].replace("/", os.sep)].append(
+                        os.path.join(output_dir, LINKS_DIRNAME, day, entry["name"]))
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    continue
+    except OSError:
+        pass
+    return links
+
+def migrate_flat_store(output_dir=None):
+    """Move legacy flat img_*.jpg files (and their sidecars and derivatives) into the sharded store."""
+    import hashlib
+    output_dir = output_dir or OUTPUT_DIR
+    migrated = 0
+    try:
+        names = [e.name for e in os.scandir(output_dir)
+                 if e.is_file() and e.name.startswith("img_") and e.name.lower().endswith(IMAGE_EXTS)]
+    except OSError:
+        return 0
+    for name in names:
+        src = os.path.join(output_dir, name)
+        try:
+            with open(src, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            ext = os.path.splitext(name)[1].lower()
+            dst = object_path(digest, ".jpg" if ext == ".jpeg" else ext, output_dir)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            metadata = {}
+            if os.path.exists(sidecar_path(src)):
+                with open(sidecar_path(src), "r", encoding="utf-8") as f:
+                    metadata = json.load(f)
+            metadata.setdefault("name", name)
+            if os.path.exists(dst):
+                os.remove(src) # 内容相同的图片只保留一份
+            else:
+                os.replace(src, dst)
+                metadata = {**metadata, "filename": os.path.basename(dst), "file_path": dst, "sha256": digest}
+                atomic_write_json(sidecar_path(dst), metadata)
+                record_store_entry(output_dir, metadata)
+                stem, new_stem = os.path.splitext(name)[0], digest
+                for kind, spec in DERIVATIVE_KINDS.items():
+                    old = os.path.join(output_dir, ".derived", kind, stem + spec["ext"])
+                    if os.path.exists(old):
+                        os.replace(old, os.path.join(output_dir, ".derived", kind, new_stem + spec["ext"]))
+            if os.path.exists(sidecar_path(src)):
+                os.remove(sidecar_path(src))
+            migrated += 1
+        except Exception as e:
+            log_error(f"Error migrating {src}: {e}")
+    return migrated
+
+# 元数据嵌入图片文件 (config.json: embed_metadata)：JPEG 写入 XMP (APP1)，PNG 写入 iTXt 块，
+# 读取时只解析文件头，不解码像素。其他格式或过长的元数据仍使用 .json 附属文件。
+EMBEDDED_FIELDS = ("name", "prompt", "model", "resolution", "timestamp", "group_id", "group_index", "group_size",
+                   "source_sha256")
+XMP_HEADER = b"http://ns.adobe.com/xap/1.0/\x00"
+XMP_NS = "urn:zimage:meta:1.0/"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_KEYWORD = b"ZImage"
+
+def build_xmp(metadata):
+    payload = html_lib.escape(json.dumps(metadata, ensure_ascii=False), quote=True)
+    prompt = html_lib.escape(metadata.get("prompt", ""), quote=False)
+    return (
+        '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        f'<rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:zimage="{XMP_NS}" '
+        f'zimage:metadata="{payload}">'
+        f'<dc:description><rdf:Alt><rdf:li xml:lang="x-default">{prompt}</rdf:li></rdf:Alt></dc:description>'
+        '</rdf:Description></rdf:RDF></x:xmpmeta><?xpacket end="w"?>'
+    ).encode("utf-8")
+
+def parse_xmp(xmp):
+    m = re.search(r'zimage:metadata="([^"]*)"', xmp.decode("utf-8", "replace"))
+    return json.loads(html_lib.unescape(m.group(1))) if m else None
+
+def png_chunk(kind, data):
+    import struct, zlib
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+def itxt_chunk(keyword, text):
+    # keyword \0 未压缩 \0 语言标签 \0 翻译关键字 \0 文本 (UTF-8)
+    return png_chunk(b"iTXt", keyword + b"\x00\x00\x00\x00\x00" + text.encode("utf-8"))
+
+def embed_metadata(data, ext, metadata):
+    """Encoded image bytes with metadata embedded (no pixel re-encoding), or None when unsupported."""
+    import struct
+    metadata = {k: metadata[k] for k in EMBEDDED_FIELDS if metadata.get(k) is not None}
+    if ext in (".jpg", ".jpeg") and data[:2] == b"\xff\xd8":
+        segment = XMP_HEADER + build_xmp(metadata)
+        if len(segment) + 2 > 0xFFFF:
+            return None
+        pos = 2
+        while data[pos:pos + 2] == b"\xff\xe0": # 插在 JFIF (APP0) 之后
+            pos += 2 + struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        return data[:pos] + b"\xff\xe1" + struct.pack(">H", len(segment) + 2) + segment + data[pos:]
+    if ext == ".png" and data[:8] == PNG_SIGNATURE:
+        ihdr_end = 8 + 12 + struct.unpack(">I", data[8:12])[0]
+        chunks = itxt_chunk(PNG_KEYWORD, json.dumps(metadata, ensure_ascii=False))
+        if metadata.get("prompt"):
+            chunks += itxt_chunk(b"Description", metadata["prompt"])
+        return data[:ihdr_end] + chunks + data[ihdr_end:]
+    return None
+
+def read_embedded_metadata(path):
+    """Metadata embedded by embed_metadata(), reading only the file header (stops at the image data)."""
+    import struct
+    try:
+        with open(path, "rb") as f:
+            head = f.read(8)
+            if head[:2] == b"\xff\xd8":
+                f.seek(2)
+                while True:
+                    marker = f.read(4)
+                    if len(marker) < 4 or marker[0] != 0xFF or marker[1] in (0xDA, 0xD9): # SOS / EOI
+                        return None
+                    length = struct.unpack(">H", marker[2:])[0] - 2
+                    if marker[1] == 0xE1:
+                        segment = f.read(length)
+                        if segment.startswith(XMP_HEADER):
+                            return parse_xmp(segment[len(XMP_HEADER):])
+                    else:
+                        f.seek(length, 1)
+            elif head == PNG_SIGNATURE:
+                while True:
+                    header = f.read(8)
+                    if len(header) < 8 or header[4:] in (b"IDAT", b"IEND"):
+                        return None
+                    length = struct.unpack(">I", header[:4])[0]
+                    if header[4:] == b"iTXt":
+                        chunk = f.read(length)
+                        keyword, _, rest = chunk.partition(b"\x00")
+                        if keyword == PNG_KEYWORD:
+                            # 跳过压缩标志、压缩方法、语言标签与翻译关键字
+                            text = rest[2:].split(b"\x00", 2)[2]
+                            return json.loads(text.decode("utf-8"))
+                        f.seek(4, 1)
+                    else:
+                        f.seek(length + 4, 1)
+    except (OSError, ValueError, IndexError, struct.error) as e:
+        log_error(f"Error reading embedded metadata from {path}: {e}")
+    return None
+
+def snapshot_output_dir(output_dir=None):
+    """{relative path: (mtime, size)} for images and sidecars in output_dir and its objects/ shards."""
+    output_dir = output_dir or OUTPUT_DIR
+    entries = {}
+
+    def scan(directory, prefix):
+        try:
+            it = os.scandir(directory)
+        except OSError:
+            return
+        with it:
+            for entry in it:
+                lower = entry.name.lower()
+                if not (lower.endswith(IMAGE_EXTS) or lower.endswith(".json")):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries[prefix + entry.name] = (st.st_mtime, st.st_size)
+
+    scan(output_dir, "")
+    for shard in store_shards(output_dir):
+        scan(shard, os.path.relpath(shard, output_dir) + os.sep)
+    return entries
+
+def store_shards(output_dir=None):
+    store = os.path.join(output_dir or OUTPUT_DIR, STORE_DIRNAME)
+    try:
+        with os.scandir(store) as it:
+            return [e.path for e in it if e.is_dir()]
+    except OSError:
+        return []
+
+def read_history_record(img_path, mtime=None, has_sidecar=None):
+    """History record for one image: path, prompt, model, resolution, mtime (metadata from its sidecar or the file header)."""
+    record = {"path": img_path, "name": os.path.basename(img_path), "prompt": "Unknown (未知)", "model": "Unknown",
+              "resolution": "Unknown", "mtime": mtime}
+    json_path = sidecar_path(img_path)
+    if has_sidecar is None:
+        has_sidecar = os.path.exists(json_path)
+    metadata = None
+    if has_sidecar:
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+        except Exception as e:
+            log_error(f"Error reading JSON for {img_path}: {e}")
+    else:
+        # 没有附属文件时读取嵌入在图片文件头中的元数据
+        metadata = read_embedded_metadata(img_path)
+    if metadata:
+        for key in ("prompt", "model", "resolution", "name"):
+            record[key] = metadata.get(key, record[key])
+    return record
+
+def scan_history(output_dir=None, snapshot=None):
+    """List history records in output_dir, newest first."""
+    output_dir = output_dir or OUTPUT_DIR
+    if snapshot is None:
+        snapshot = snapshot_output_dir(output_dir)
+    images = [(name, st) for name, st in snapshot.items() if name.lower().endswith(IMAGE_EXTS)]
+    # Sort by modification time (newest first)
+    images.sort(key=lambda item: item[1][0], reverse=True)
+    return [read_history_record(os.path.join(output_dir, name), st[0], sidecar_path(name) in snapshot)
+            for name, st in images]
+
+def diff_output_snapshots(old, new):
+    """(added, removed, changed) image filenames between two snapshots; a sidecar edit marks its image changed."""
+    added = [n for n in new if n not in old and n.lower().endswith(IMAGE_EXTS)]
+    removed = [n for n in old if n not in new and n.lower().endswith(IMAGE_EXTS)]
+    images_by_stem = {n.rsplit('.', 1)[0]: n for n in new if n.lower().endswith(IMAGE_EXTS)}
+    added_set = set(added)
+    changed = set()
+    for name in set(old) | set(new):
+        if old.get(name) == new.get(name):
+            continue
+        if name.lower().endswith(IMAGE_EXTS):
+            if name in old and name in new:
+                changed.add(name)
+        else:
+            image = images_by_stem.get(name.rsplit('.', 1)[0])
+            if image and image not in added_set:
+                changed.add(image)
+    return added, removed, sorted(changed)
+
 # --- FlowLayout Implementation ---
 class FlowLayout(QLayout):
     def __init__(self, parent=None, margin=-1, hSpacing=-1, vSpacing=-1):
@@ -51,6 +949,9 @@ class FlowLayout(QLayout):
         self.m_hSpace = hSpacing
         self.m_vSpace = vSpacing
         self.itemList = []
+        # 设置 order_key 后，插入位置与相邻条目顺序不符时置 out_of_order，调用方据此决定是否需要 sortWidgets
+        self.order_key = None
+        self.out_of_order = False
 
     def __del__(self):
         item = self.takeAt(0)
@@ -59,11 +960,40 @@ class FlowLayout(QLayout):
 
     def addItem(self, item):
         self.itemList.append(item)
+        self.check_order(len(self.itemList) - 1, 1)
 
     def insertWidget(self, index, widget):
         item = QWidgetItem(widget)
         self.itemList.insert(index, item)
         self.addChildWidget(widget)
+        self.check_order(index, 1)
+        self.invalidate()
+
+    def insertWidgets(self, index, widgets):
+        for offset, widget in enumerate(widgets):
+            self.itemList.insert(index + offset, QWidgetItem(widget))
+            self.addChildWidget(widget)
+        self.check_order(index, len(widgets))
+        self.invalidate()
+
+    def check_order(self, index, count):
+        """Flag out_of_order when items[index:index + count] break order_key against their neighbours."""
+        if self.order_key is None or self.out_of_order or not count:
+            return
+        start, end = max(index - 1, 0), min(index + count + 1, len(self.itemList))
+        keys = [self.order_key(item.widget()) for item in self.itemList[start:end]]
+        self.out_of_order = any(a > b for a, b in zip(keys, keys[1:]))
+
+    def removeWidgets(self, widgets):
+        """Remove many widgets in one pass (QLayout.removeWidget is O(n) per call)."""
+        targets = set(widgets)
+        self.itemList = [item for item in self.itemList if item.widget() not in targets]
+        self.invalidate()
+
+    def sortWidgets(self, key):
+        """Reorder the existing items by key(widget) without recreating any widget."""
+        self.itemList.sort(key=lambda item: key(item.widget()))
+        self.out_of_order = False
         self.invalidate()
 
     def horizontalSpacing(self):
@@ -122,9 +1052,19 @@ class FlowLayout(QLayout):
         spacing = self.spacing()
 
         for item in self.itemList:
+            if item.isEmpty():
+                continue # 隐藏的控件 (被画廊筛选掉的卡片) 不占位置
             wid = item.widget()
             spaceX = spacing + wid.style().layoutSpacing(QSizePolicy.PushButton, QSizePolicy.PushButton, Qt.Horizontal)
             spaceY = spacing + wid.style().layoutSpacing(QSizePolicy.PushButton, QSizePolicy.PushButton, Qt.Vertical)
+            if wid.property("fullRow"):
+                # 整行控件 (日期标题)：另起一行，宽度与布局相同
+                if lineHeight > 0:
+                    y = y + lineHeight + spaceY
+                if not testOnly:
+                    item.setGeometry(QRect(rect.x(), y, rect.width(), item.sizeHint().height()))
+                x, y, lineHeight = rect.x(), y + item.sizeHint().height() + spaceY, 0
+                continue
             nextX = x + item.sizeHint().width() + spaceX
             if nextX - spaceX > rect.right() and lineHeight > 0:
                 x = rect.x()
@@ -149,450 +1089,3717 @@ class FlowLayout(QLayout):
         else:
             return parent.spacing()
 
-# --- Detail Dialog ---
-class DetailDialog(QDialog):
-    def __init__(self, image_source, file_path, prompt, model, resolution, parent=None):
-        """
-        image_source: Can be PIL Image or file path string
-        """
-        super().__init__(parent)
-        self.setWindowTitle("Image Details (图片详情)")
-        self.resize(1000, 800)
-        self.setModal(True)
-        self.is_fullscreen = False
-        
-        layout = QVBoxLayout(self)
-        layout.setContentsMargins(0, 0, 0, 0) # Remove margins for better fullscreen experience
-        layout.setSpacing(0) # Remove spacing between sections
-        
-        # Top Bar (for Close/Fullscreen when in fullscreen mode, though we use bottom buttons mostly)
-        # We'll stick to bottom buttons for simplicity, but maybe add a small close button overlay later if needed.
-        # For now, standard dialog frame handles closing in normal mode.
-        
-        # Image Display (Scrollable for large images)
-        self.scroll_area = QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_area.setAlignment(Qt.AlignCenter)
-        self.scroll_area.setStyleSheet("background-color: #2c3e50; border: none;") # Dark background for better viewing
-        self.scroll_area.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-        self.scroll_area.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
-        
-        self.image_label = QLabel()
-        self.image_label.setAlignment(Qt.AlignCenter)
-        
-        # Load Image
-        pixmap = None
-        if isinstance(image_source, str): # File Path
-            pixmap = QPixmap(image_source)
-        else: # PIL Image
-             if image_source.mode != "RGB":
-                 image_source = image_source.convert("RGB")
-             data = image_source.tobytes("raw", "RGB")
-             qimage = QImage(data, image_source.width, image_source.height, QImage.Format_RGB888)
-             pixmap = QPixmap.fromImage(qimage)
-
-        if pixmap:
-             self.original_pixmap = pixmap
-             
-             # Handle High DPI: Ensure 1:1 pixel mapping to avoid blurriness
-             dpr = self.devicePixelRatio()
-             pixmap.setDevicePixelRatio(dpr)
-             
-             self.image_label.setPixmap(pixmap)
-             # Allow scaling? For now just show original or scaled to fit if too big?
-             # Current logic just puts it in scroll area. 
-             # Let's make it scale to fit window width if larger, or just original size.
-             # Actually, user asked for "Full Screen", often implying "Fit to Screen".
-             # But let's keep original behavior of ScrollArea for detail inspection, 
-             # but maybe add "Fit to Window" later. 
-             # For now, let's stick to ScrollArea as it allows zooming/panning implicitly by scrollbars.
-        else:
-             self.image_label.setText("Image Load Failed")
+# --- Image Cache (图片内存缓存) ---
+def pil_to_qimage(image):
+    """Convert a PIL image to a QImage that owns its pixel data."""
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    data = image.tobytes("raw", "RGB")
+    return QImage(data, image.width, image.height, image.width * 3, QImage.Format_RGB888).copy()
 
-        self.scroll_area.setWidget(self.image_label)
-        layout.addWidget(self.scroll_area)
-        
-        # Info Area
-        self.info_frame = QFrame()
-        self.info_frame.setStyleSheet("background-color: #f7f9fc; border-top: none;")
-        info_layout = QFormLayout(self.info_frame)
-        info_layout.setContentsMargins(20, 12, 20, 20)
-        info_layout.setVerticalSpacing(12)
-        info_layout.setLabelAlignment(Qt.AlignRight | Qt.AlignVCenter)
-        info_layout.setFormAlignment(Qt.AlignLeft | Qt.AlignTop)
-        
-        prompt_edit = QTextEdit()
-        prompt_edit.setPlainText(prompt)
-        prompt_edit.setReadOnly(True)
-        prompt_edit.setMaximumHeight(80)
-        prompt_edit.setStyleSheet("background-color: white; border: 1px solid #ccc; color: #333;")
-        
-        info_layout.addRow("<b>提示词 (Prompt):</b>", prompt_edit)
-
-        model_label = QLabel(model)
-        model_label.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-        model_label.setStyleSheet("color: #2c3e50; padding: 2px 0;")
-        info_layout.addRow("<b>模型 (Model):</b>", model_label)
-
-        res_label = QLabel(resolution)
-        res_label.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-        res_label.setStyleSheet("color: #2c3e50; padding: 2px 0;")
-        info_layout.addRow("<b>分辨率 (Resolution):</b>", res_label)
-
-        path_label = QLabel(file_path)
-        path_label.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-        path_label.setStyleSheet("color: #2c3e50; padding: 2px 0;")
-        info_layout.addRow("<b>文件路径 (File Path):</b>", path_label)
-        
-        self.info_frame.setVisible(False) # Default hidden
-        layout.addWidget(self.info_frame)
-        
-        # Control Bar (Buttons)
-        control_bar = QFrame()
-        control_bar.setStyleSheet("""
-            QFrame {
-                background-color: #2c3e50; 
-                border-top: 1px solid #243445;
-            }
-            QPushButton {
-                background-color: #34495e;
-                color: white;
-                border: 1px solid #4e6d8d;
-                border-radius: 6px;
-                padding: 8px 16px;
-            }
-            QPushButton:hover {
-                background-color: #4e6d8d;
-                border-color: #5d81a8;
-            }
-            QPushButton:checked {
-                background-color: #2980b9;
-                border-color: #3498db;
-            }
-        """)
-        btn_layout = QHBoxLayout(control_bar)
-        btn_layout.setContentsMargins(10, 10, 10, 10)
-        
-        # Toggle Info Button
-        self.info_btn = QPushButton("显示信息 (Show Info) ▲")
-        self.info_btn.setCheckable(True)
-        self.info_btn.clicked.connect(self.toggle_info)
-        btn_layout.addWidget(self.info_btn)
-        
-        # Fullscreen Button
-        self.fullscreen_btn = QPushButton("全屏 (Fullscreen)")
-        self.fullscreen_btn.setCheckable(True)
-        self.fullscreen_btn.clicked.connect(self.toggle_fullscreen)
-        btn_layout.addWidget(self.fullscreen_btn)
+def make_thumbnail(image, size=THUMBNAIL_SIZE):
+    """Downscale a PIL image to a thumbnail QImage (aspect ratio kept)."""
+    thumb = image.copy()
+    thumb.thumbnail((size, size))
+    return pil_to_qimage(thumb)
 
-        btn_layout.addStretch()
-        
-        open_file_btn = QPushButton("打开文件 (Open File)")
-        open_file_btn.clicked.connect(lambda: os.startfile(file_path) if sys.platform == "win32" else None)
-        btn_layout.addWidget(open_file_btn)
-        
-        open_folder_btn = QPushButton("打开目录 (Open Folder)")
-        open_folder_btn.clicked.connect(lambda: os.startfile(os.path.dirname(file_path)) if sys.platform == "win32" else None)
-        btn_layout.addWidget(open_folder_btn)
-        
-        close_btn = QPushButton("关闭 (Close)")
-        close_btn.setStyleSheet("background-color: #c0392b; border-color: #e74c3c;") # Red for close
-        close_btn.clicked.connect(self.close) # Use close instead of accept to ensure proper teardown
-        btn_layout.addWidget(close_btn)
-        
-        layout.addWidget(control_bar)
-        
-        # Install Event Filter for Double Click
-        self.image_label.installEventFilter(self)
+def read_qimage(path, max_size=None):
+    """Decode an image file into a QImage; with max_size the decoder scales down while reading."""
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)
+    if max_size:
+        size = reader.size()
+        if size.isValid() and (size.width() > max_size or size.height() > max_size):
+            reader.setScaledSize(size.scaled(max_size, max_size, Qt.KeepAspectRatio))
+    image = reader.read()
+    if image.isNull():
+        log_error(f"Error reading image {path}: {reader.errorString()}")
+    return image
 
-    def eventFilter(self, source, event):
-        if source == self.image_label and event.type() == QEvent.MouseButtonDblClick:
-             if event.button() == Qt.LeftButton:
-                 # Toggle Fullscreen
-                 is_full = self.isFullScreen()
-                 self.toggle_fullscreen(not is_full)
-                 self.fullscreen_btn.setChecked(not is_full)
-                 return True
-        return super().eventFilter(source, event)
+def decode_preview(data, max_size=THUMBNAIL_SIZE):
+    """Coarse QImage from the first bytes of a JPEG/PNG that is still downloading.
 
-    def toggle_info(self, checked):
-        self.info_frame.setVisible(checked)
-        if checked:
-            self.info_btn.setText("隐藏信息 (Hide Info) ▼")
-        else:
-            self.info_btn.setText("显示信息 (Show Info) ▲")
+    The decoder fills the missing part with gray: baseline JPEGs reveal rows top-down,
+    progressive JPEGs a blurry full frame. Scaled decoding keeps each call to a few ms.
+    Returns None when not even the header has arrived yet.
+    """
+    buffer = QBuffer()
+    buffer.setData(QByteArray(data))
+    buffer.open(QIODevice.ReadOnly)
+    reader = QImageReader(buffer)
+    size = reader.size()
+    if not size.isValid():
+        return None
+    if size.width() > max_size or size.height() > max_size:
+        reader.setScaledSize(size.scaled(max_size, max_size, Qt.KeepAspectRatio))
+    image = reader.read()
+    return None if image.isNull() else image
 
-    def toggle_fullscreen(self, checked):
-        if checked:
-            self.showFullScreen()
-            self.fullscreen_btn.setText("退出全屏 (Exit Fullscreen)")
-        else:
-            self.showNormal()
-            self.fullscreen_btn.setText("全屏 (Fullscreen)")
-            
-    def keyPressEvent(self, event):
-        # Allow Esc to exit fullscreen first, then close dialog
-        if event.key() == Qt.Key_Escape:
-            if self.isFullScreen():
+# 不完整的 JPEG 每次解码都会触发 libjpeg 的 "premature end of data segment" 警告；读取失败仍由 errorString 报告
+QLoggingCategory.setFilterRules("qt.gui.imageio.jpeg.warning=false")
+
+class ImageCache(QObject):
+    """Byte-bounded LRU cache of decoded QImages keyed by (path, kind).
+
+    kind is "thumb" (gallery thumbnails) or "full" (detail previews). Widgets keep
+    only the path and draw from the cache; misses are decoded on a loader thread
+    and announced through `loaded` so the owner can repaint.
+    """
+    loaded = Signal(str, str) # path, kind
+
+    def __init__(self, budget_bytes):
+        super().__init__()
+        from collections import OrderedDict
+        self.budget = budget_bytes
+        self.entries = OrderedDict()
+        self.used = 0
+        self.lock = threading.Lock()
+        self.loader = None
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def set_budget(self, budget_bytes):
+        with self.lock:
+            self.budget = budget_bytes
+            self._evict()
+
+    def get(self, path, kind="thumb"):
+        with self.lock:
+            image = self.entries.get((path, kind))
+            if image is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end((path, kind))
+            self.stats["hits"] += 1
+            return image
+
+    def put(self, path, kind, image):
+        if image is None or image.isNull():
+            return
+        cost = image.sizeInBytes()
+        with self.lock:
+            old = self.entries.pop((path, kind), None)
+            if old is not None:
+                self.used -= old.sizeInBytes()
+            if cost > self.budget:
+                return
+            self.entries[(path, kind)] = image
+            self.used += cost
+            self._evict()
+
+    def _evict(self):
+        while self.used > self.budget and self.entries:
+            _, image = self.entries.popitem(last=False)
+            self.used -= image.sizeInBytes()
+            self.stats["evictions"] += 1
+
+    def invalidate(self, path):
+        with self.lock:
+            for kind in ("thumb", "full"):
+                image = self.entries.pop((path, kind), None)
+                if image is not None:
+                    self.used -= image.sizeInBytes()
+
+    def load(self, path, kind="full"):
+        """Synchronous get-or-decode (used when the image is needed right now)."""
+        image = self.get(path, kind)
+        if image is None:
+            image = read_thumbnail(path) if kind == "thumb" else read_qimage(path)
+            self.put(path, kind, image)
+        return image
+
+    def request(self, path, kind="thumb"):
+        """Cached image, or None after queueing a background decode."""
+        image = self.get(path, kind)
+        if image is None:
+            if self.loader is None:
+                self.loader = ImageLoaderThread(self)
+                self.loader.loaded.connect(self.loaded)
+                self.loader.start()
+            self.loader.enqueue(path, kind)
+        return image
+
+    def shutdown(self):
+        """Stop the loader thread (on application exit); it must not outlive the QApplication."""
+        if self.loader is not None:
+            self.loader.stop()
+            self.loader = None
+
+class ImageLoaderThread(QThread):
+    """Decodes queued images into the cache, most recent request first (visible cards win)."""
+    loaded = Signal(str, str)
+    MAX_PENDING = 256
+
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+        self.pending = deque()
+        self.stopping = False
+        self.cond = threading.Condition()
+
+    def enqueue(self, path, kind):
+        key = (path, kind)
+        with self.cond:
+            if key in self.pending:
+                self.pending.remove(key)
+            self.pending.append(key)
+            # 滚动过快时丢弃最早的请求，那些卡片已不在视口内
+            while len(self.pending) > self.MAX_PENDING:
+                self.pending.popleft()
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.pending.clear()
+            self.cond.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopping:
+                    self.cond.wait()
+                if self.stopping:
+                    return
+                path, kind = self.pending.pop()
+            if self.cache.get(path, kind) is None and os.path.exists(path):
+                self.cache.put(path, kind, read_thumbnail(path) if kind == "thumb" else read_qimage(path))
+            self.loaded.emit(path, kind)
+
+IMAGE_CACHE = ImageCache(DEFAULT_IMAGE_CACHE_MB * 1024 * 1024)
+
+class PrefetchThread(QThread):
+    """Decodes full-size previews for the detail dialog in priority order.
+
+    Each schedule() call carries a token; queued work from an older token is dropped
+    (the user has moved on). A decode that finishes after the token changed is still
+    cached (the LRU evicts it if unused). The decoded image travels with `loaded`, so
+    images larger than the cache budget need no second read on the GUI thread.
+    """
+    loaded = Signal(str, int, QImage) # path, token, decoded image (null when unreadable)
+
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+        self.queue = deque()
+        self.token = 0
+        self.stopping = False
+        self.cond = threading.Condition()
+
+    def schedule(self, paths, token):
+        with self.cond:
+            self.token = token
+            self.queue = deque(paths)
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.queue.clear()
+            self.cond.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopping:
+                    self.cond.wait()
+                if self.stopping:
+                    return
+                path = self.queue.popleft()
+                token = self.token
+            image = self.cache.get(path, "full")
+            if image is None:
+                image = read_qimage(path) if os.path.exists(path) else QImage()
+                self.cache.put(path, "full", image)
+            self.loaded.emit(path, token, image)
+
+# --- Post-processing (派生图片) ---
+# 派生图片类型 (DERIVATIVE_KINDS) 与 build_derivative 在 zimage_derivatives.py 中：进程池的工作进程只导入它。
+DEFAULT_DERIVATIVES = ["thumb"]
+
+def derived_path(src, kind, output_dir=None):
+    """Location of the `kind` derivative of src: <output dir>/.derived/<kind>/<name><ext>."""
+    stem = os.path.splitext(os.path.basename(src))[0]
+    return os.path.join(output_dir or store_root(src), ".derived", kind, stem + DERIVATIVE_KINDS[kind]["ext"])
+
+def derivative_is_fresh(src, dst):
+    try:
+        return os.path.getmtime(dst) >= os.path.getmtime(src)
+    except OSError:
+        return False
+
+def read_thumbnail(path):
+    """Thumbnail QImage for path, from the pre-built derivative when it is up to date."""
+    thumb = derived_path(path, "thumb")
+    if derivative_is_fresh(path, thumb):
+        image = read_qimage(thumb, THUMBNAIL_SIZE)
+        if not image.isNull():
+            return image
+    return read_qimage(path, THUMBNAIL_SIZE)
+
+class DerivativePipeline(QObject):
+    """Builds image derivatives in a process pool, off the generation and GUI paths.
+
+    submit() only appends to a queue. A feeder thread skips up-to-date derivatives and
+    keeps at most MAX_IN_FLIGHT jobs in the pool, so a large backfill neither blocks the
+    caller nor piles every job into memory. `progress` reports backlog and throughput.
+    """
+    progress = Signal(dict)
+    THROUGHPUT_WINDOW = 30.0 # 吞吐量按最近 30 秒计算
+
+    def __init__(self, kinds=None, workers=None, parent=None):
+        super().__init__(parent)
+        import queue
+        self.kinds = [k for k in (kinds or DEFAULT_DERIVATIVES) if k in DERIVATIVE_KINDS]
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        self.max_in_flight = self.workers * 4
+        self.queue = queue.Queue()
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.feeder = None
+        self.closed = False
+        self.queued = 0
+        self.in_flight = 0
+        self.done = 0
+        self.failed = 0
+        self.completions = deque()
+
+    def submit(self, paths):
+        if not self.kinds or self.closed:
+            return
+        if self.feeder is None:
+            self.feeder = threading.Thread(target=self.feed, name="derivative-feeder", daemon=True)
+            self.feeder.start()
+        with self.lock:
+            self.queued += len(paths)
+        for path in paths:
+            self.queue.put(path)
+        self.report()
+
+    def feed(self):
+        from concurrent.futures import ProcessPoolExecutor
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            jobs = [(kind, derived_path(path, kind)) for kind in self.kinds]
+            jobs = [(kind, dst) for kind, dst in jobs if os.path.exists(path) and not derivative_is_fresh(path, dst)]
+            with self.lock:
+                self.queued -= 1
+                self.in_flight += len(jobs)
+            for kind, dst in jobs:
+                self.slots.acquire()
+                if self.closed:
+                    return
+                if self.executor is None:
+                    # spawn：不在已启动 Qt 线程的进程上 fork
+                    self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                        mp_context=multiprocessing.get_context("spawn"))
+                future = self.executor.submit(build_derivative, kind, path, dst) # 工作进程只导入 zimage_derivatives
+                future.add_done_callback(lambda f, k=kind, p=path: self.on_job_done(k, p, f))
+            if not jobs:
+                self.report()
+
+    def on_job_done(self, kind, path, future):
+        self.slots.release()
+        record = {"kind": kind, "source": os.path.basename(path)}
+        try:
+            ms, size = future.result()
+            record.update({"status": "ok", "ms": ms, "bytes": size})
+        except Exception as e:
+            record.update({"status": "error", "error": str(e)[:300]})
+            log_error(f"Error building {kind} for {path}: {e}")
+        now = time.monotonic()
+        with self.lock:
+            self.in_flight -= 1
+            if record["status"] == "ok":
+                self.done += 1
+            else:
+                self.failed += 1
+            self.completions.append(now)
+            while self.completions and now - self.completions[0] > self.THROUGHPUT_WINDOW:
+                self.completions.popleft()
+        write_metrics(DERIVATIVE_METRICS_LOG, record)
+        self.report()
+
+    def stats(self):
+        with self.lock:
+            window = self.completions
+            elapsed = (window[-1] - window[0]) if len(window) > 1 else 0
+            return {
+                "backlog": self.queued + self.in_flight,
+                "in_flight": self.in_flight,
+                "done": self.done,
+                "failed": self.failed,
+                "per_sec": round((len(window) - 1) / elapsed, 2) if elapsed else 0.0,
+            }
+
+    def report(self):
+        # 在工作线程中发射：跨线程信号由 Qt 排队投递到界面线程
+        self.progress.emit(self.stats())
+
+    def shutdown(self):
+        self.closed = True
+        self.queue.put(None)
+        try:
+            self.slots.release() # 唤醒可能在等待空位的 feeder
+        except ValueError:
+            pass
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+# --- Perceptual hash (相似图片) ---
+PHASH_INDEX_NAME = "phash.jsonl"
+SIMILAR_MAX_DISTANCE = 12 # "相似图片" 的最大汉明距离 (64 位 dHash)
+DUPLICATE_MAX_DISTANCE = 4 # 近似重复报告的默认阈值
+
+def compute_dhash(path):
+    """64-bit difference hash of the image at path, computed from its thumbnail when that is up to date."""
+    from PIL import Image
+    thumb = derived_path(path, "thumb")
+    source = thumb if derivative_is_fresh(path, thumb) else path
+    with Image.open(source) as image:
+        image.draft("L", (64, 64))
+        pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+if hasattr(int, "bit_count"):
+    def hamming(a, b):
+        return (a ^ b).bit_count()
+else: # Python < 3.10
+    def hamming(a, b):
+        return bin(a ^ b).count("1")
+
+@functools.lru_cache(maxsize=None)
+def numpy_popcount():
+    """(numpy, 8-bit popcount table), or (None, None) without NumPy. Imported on first use: it is optional and slow to import."""
+    try:
+        import numpy as np
+    except ImportError:
+        return None, None
+    return np, np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+class BKTree:
+    """Metric tree over 64-bit hashes; used for similarity search when NumPy is not installed."""
+
+    def __init__(self):
+        self.root = None # [hash, [paths], {distance: child}]
+
+    def add(self, value, path):
+        if self.root is None:
+            self.root = [value, [path], {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(value, node[0])
+            if d == 0:
+                node[1].append(path)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [path], {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = hamming(value, node[0])
+            if d <= radius:
+                results.extend((d, p) for p in node[1])
+            # 三角不等式：只有与本节点距离在 [d - radius, d + radius] 内的子树可能命中
+            stack.extend(child for k, child in node[2].items() if d - radius <= k <= d + radius)
+        return results
+
+class SimilarityIndex:
+    """dHash of every gallery image, persisted in <output dir>/phash.jsonl next to index.jsonl.
+
+    Each image is hashed once (from its thumbnail) on a background thread; a hash is
+    recomputed only when the file's mtime changes. nearest() scans every hash with NumPy
+    when available (XOR plus a byte popcount table, milliseconds for 100k images) and
+    falls back to a BK-tree otherwise.
+    """
+
+    def __init__(self, output_dir=None):
+        import queue
+        self.output_dir = output_dir or OUTPUT_DIR
+        self.index_path = os.path.join(self.output_dir, PHASH_INDEX_NAME)
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.hashes = {} # path -> (mtime, hash)
+        self.worker = None
+        self.matrix = None # (paths, uint64 数组)，内容变化后按需重建
+        self.tree = None
+
+    def submit(self, paths):
+        """Queue paths for hashing on the background thread (unchanged ones are skipped there)."""
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.work, name="phash-index", daemon=True)
+            self.worker.start()
+        for path in paths:
+            self.queue.put(path)
+
+    def work(self):
+        import queue
+        self.load()
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < 256:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            self.update(batch)
+
+    def load(self):
+        entries = {}
+        lines = 0
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                        entries[os.path.join(self.output_dir, entry["path"])] = (entry["mtime"], int(entry["dhash"], 16))
+                    except (ValueError, KeyError):
+                        continue
+        except OSError:
+            return
+        entries = {p: v for p, v in entries.items() if os.path.exists(p)}
+        with self.lock:
+            entries.update(self.hashes)
+            self.hashes = entries
+            self.matrix = self.tree = None
+        if lines > 2 * len(entries) + 100:
+            # 重新计算或已删除的图片留下的旧行过多时压缩索引文件
+            self.compact()
+
+    def compact(self):
+        with self.lock:
+            items = list(self.hashes.items())
+        lines = [self.index_line(path, mtime, value) for path, (mtime, value) in items]
+        try:
+            atomic_write(self.index_path, "".join(line + "\n" for line in lines).encode("utf-8"))
+        except OSError as e:
+            log_error(f"Error compacting {self.index_path}: {e}")
+
+    def index_line(self, path, mtime, value):
+        return json.dumps({"path": os.path.relpath(path, self.output_dir), "mtime": mtime, "dhash": f"{value:016x}"})
+
+    def update(self, paths):
+        """Hash the paths that are new or changed since they were last hashed, and persist them."""
+        lines = []
+        for path in paths:
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            known = self.hashes.get(path)
+            if known is not None and known[0] == mtime:
+                continue
+            try:
+                value = compute_dhash(path)
+            except Exception as e:
+                log_error(f"Error hashing {path}: {e}")
+                continue
+            with self.lock:
+                self.hashes[path] = (mtime, value)
+                self.matrix = None
+                if self.tree is not None and known is None:
+                    self.tree.add(value, path)
+                else:
+                    self.tree = None
+            lines.append(self.index_line(path, mtime, value))
+        if lines:
+            try:
+                with open(self.index_path, "a", encoding="utf-8") as f:
+                    f.write("".join(line + "\n" for line in lines))
+            except OSError as e:
+                log_error(f"Error writing {self.index_path}: {e}")
+
+    def remove(self, paths):
+        with self.lock:
+            for path in paths:
+                self.hashes.pop(path, None)
+            self.matrix = self.tree = None
+
+    def hash_of(self, path):
+        entry = self.hashes.get(path)
+        return entry[1] if entry else None
+
+    def nearest(self, path, limit=24, max_distance=SIMILAR_MAX_DISTANCE):
+        """[(distance, path)] of the images most similar to path, nearest first, excluding path itself."""
+        value = self.hash_of(path)
+        if value is None:
+            return []
+        np, popcount = numpy_popcount()
+        with self.lock:
+            if np is not None:
+                if self.matrix is None:
+                    paths = list(self.hashes)
+                    self.matrix = (paths, np.array([self.hashes[p][1] for p in paths], dtype=np.uint64))
+                paths, values = self.matrix
+            elif self.tree is None:
+                self.tree = BKTree()
+                for p, (_, v) in self.hashes.items():
+                    self.tree.add(v, p)
+            tree = self.tree
+        if np is not None:
+            distances = popcount[(values ^ np.uint64(value)).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+            hits = np.nonzero(distances <= max_distance)[0]
+            hits = hits[np.argsort(distances[hits], kind="stable")]
+            results = [(int(distances[i]), paths[i]) for i in hits]
+        else:
+            results = sorted(tree.search(value, max_distance))
+        return [(d, p) for d, p in results if p != path][:limit]
+
+    def duplicate_groups(self, max_distance=DUPLICATE_MAX_DISTANCE):
+        """Groups of near-identical images (linked by pairs within max_distance), largest first.
+
+        Multi-index hashing: the 64 bits are split into `bands` bands, and two hashes within
+        max_distance differ by at most max_distance // bands bits in at least one band. Only
+        pairs whose bands are that close are compared, so each image checks a handful of
+        candidates instead of the whole gallery. The band count minimises the expected
+        number of bucket lookups plus candidate comparisons.
+        """
+        import itertools
+        from math import factorial
+        with self.lock:
+            items = [(value, path) for path, (_, value) in self.hashes.items()]
+        n = max(len(items), 1)
+        def cost(b):
+            w = 64 // b
+            probes = b * sum(factorial(w) // (factorial(r) * factorial(w - r)) for r in range(max_distance // b + 1))
+            return probes * (1 + n / 2 ** (64 // b))
+        bands = min(range(1, 9), key=cost)
+        width = 64 // bands
+        mask = (1 << width) - 1
+        flips = [sum(1 << bit for bit in bits) for r in range(max_distance // bands + 1)
+                 for bits in itertools.combinations(range(width), r)]
+        buckets = [{} for _ in range(bands)]
+        for i, (value, _) in enumerate(items):
+            for band in range(bands):
+                buckets[band].setdefault((value >> (band * width)) & mask, []).append(i)
+
+        parent = list(range(len(items)))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i, (value, _) in enumerate(items):
+            seen = set()
+            for band in range(bands):
+                key = (value >> (band * width)) & mask
+                for flip in flips:
+                    for j in buckets[band].get(key ^ flip, ()):
+                        if j > i and j not in seen:
+                            seen.add(j)
+                            if hamming(value, items[j][0]) <= max_distance:
+                                parent[find(j)] = find(i)
+        groups = {}
+        for i, (_, path) in enumerate(items):
+            groups.setdefault(find(i), []).append(path)
+        return sorted((sorted(g) for g in groups.values() if len(g) > 1), key=len, reverse=True)
+
+SIMILARITY_INDEX = SimilarityIndex()
+
+def print_duplicate_report(max_distance=DUPLICATE_MAX_DISTANCE):
+    """--duplicates: hash the whole history (reusing phash.jsonl) and print near-duplicate groups."""
+    SIMILARITY_INDEX.load()
+    SIMILARITY_INDEX.update([r["path"] for r in scan_history(OUTPUT_DIR)])
+    t_start = time.perf_counter()
+    groups = SIMILARITY_INDEX.duplicate_groups(max_distance)
+    elapsed = (time.perf_counter() - t_start) * 1000
+    print(f"{len(SIMILARITY_INDEX.hashes)} images, {len(groups)} near-duplicate groups "
+          f"(distance <= {max_distance}, {elapsed:.0f} ms)")
+    for n, group in enumerate(groups, 1):
+        print(f"group {n}: {len(group)} images")
+        for path in group:
+            print(f"    {path}")
+
+# --- Retention (存储保留策略) ---
+# config.json: retention_max_mb / retention_max_age_days / retention_max_count (0 表示不限制)，
+# retention_action ("delete" 或 "archive")，retention_dry_run (只记录计划，不删除)。收藏的图片永不清理。
+FAVORITES_NAME = "favorites.json"
+ARCHIVE_DIRNAME = "archive"
+DEFAULT_RETENTION_INTERVAL_MINUTES = 60
+
+class FavoriteStore:
+    """Pinned images, exempt from the retention policy; kept in <output dir>/favorites.json as relative paths."""
+
+    def __init__(self, output_dir=None):
+        self.output_dir = output_dir or OUTPUT_DIR
+        self.path = os.path.join(self.output_dir, FAVORITES_NAME)
+        self.lock = threading.Lock()
+        self.paths = None
+
+    def load(self):
+        if self.paths is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    rels = json.load(f)
+            except (OSError, ValueError):
+                rels = []
+            self.paths = {os.path.normpath(os.path.join(self.output_dir, rel)) for rel in rels}
+        return self.paths
+
+    def contains(self, path):
+        with self.lock:
+            return os.path.normpath(path) in self.load()
+
+    def snapshot(self):
+        with self.lock:
+            return set(self.load())
+
+    def set(self, path, favorite):
+        with self.lock:
+            paths = self.load()
+            if favorite:
+                paths.add(os.path.normpath(path))
+            else:
+                paths.discard(os.path.normpath(path))
+            rels = sorted(os.path.relpath(p, self.output_dir).replace(os.sep, "/") for p in paths)
+            try:
+                atomic_write_json(self.path, rels)
+            except OSError as e:
+                log_error(f"Error saving favorites: {e}")
+
+FAVORITES = FavoriteStore()
+
+def retention_policy(config):
+    """Retention settings from config, or None when no limit is configured."""
+    policy = {
+        "max_bytes": float(config.get("retention_max_mb", 0) or 0) * 1024 * 1024,
+        "max_age": float(config.get("retention_max_age_days", 0) or 0) * 86400,
+        "max_count": int(config.get("retention_max_count", 0) or 0),
+        "action": "archive" if config.get("retention_action") == "archive" else "delete",
+        "dry_run": bool(config.get("retention_dry_run", False)),
+    }
+    if not (policy["max_bytes"] or policy["max_age"] or policy["max_count"]):
+        return None
+    return policy
+
+def plan_retention(output_dir, snapshot, favorites, policy, now=None):
+    """Images to retire under policy, oldest first, as (victims, stats).
+
+    snapshot is snapshot_output_dir(output_dir); an image's size includes its sidecar.
+    Favourites count towards the totals but are never chosen, so a gallery of pinned
+    images can stay over the limits.
+    """
+    now = now or time.time()
+    images = []
+    for rel, (mtime, size) in snapshot.items():
+        if rel.lower().endswith(IMAGE_EXTS):
+            sidecar = snapshot.get(sidecar_path(rel))
+            images.append((mtime, rel, size + (sidecar[1] if sidecar else 0)))
+    images.sort()
+    count = len(images)
+    total = sum(size for _, _, size in images)
+    stats = {"images": count, "bytes": total, "pinned": 0}
+    victims = []
+    for mtime, rel, size in images:
+        if os.path.normpath(os.path.join(output_dir, rel)) in favorites:
+            stats["pinned"] += 1
+            continue
+        expired = policy["max_age"] and now - mtime > policy["max_age"]
+        over_count = policy["max_count"] and count > policy["max_count"]
+        over_bytes = policy["max_bytes"] and total > policy["max_bytes"]
+        if not (expired or over_count or over_bytes):
+            break # 其余图片更新：不会过期，数量与容量也已达标
+        victims.append(rel)
+        count -= 1
+        total -= size
+    stats.update({"victims": len(victims), "freed_bytes": stats["bytes"] - total,
+                  "remaining_images": count, "remaining_bytes": total})
+    return victims, stats
+
+def retire_image(output_dir, rel, action="delete", links=None):
+    """Delete (or move to archive/<YYYYMM>/) one image with its sidecar, derivatives and by-date links.
+
+    links is store_links(output_dir); without it only the link named in the sidecar is removed.
+    Returns the archived path relative to output_dir, or None when the image was deleted;
+    pass the results to rewrite_store_index() to update index.jsonl.
+    """
+    path = os.path.join(output_dir, rel)
+    metadata = None
+    if os.path.exists(sidecar_path(path)):
+        try:
+            with open(sidecar_path(path), "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            pass
+    else:
+        metadata = read_embedded_metadata(path)
+    metadata = metadata or {}
+    candidates = list((links or {}).get(os.path.normpath(rel), ()))
+    if metadata.get("name"):
+        day = (metadata.get("timestamp") or "")[:8] or "unknown"
+        candidates.append(os.path.join(output_dir, LINKS_DIRNAME, day, metadata["name"]))
+    # by-date 下的硬链接会让图片数据继续占用空间，必须一起删除 (重复生成的图片可能有多个链接)
+    for link in set(candidates):
+        try:
+            if os.path.lexists(link) and (not os.path.exists(link) or os.path.samefile(link, path)):
+                os.remove(link)
+        except OSError:
+            pass
+    for kind in DERIVATIVE_KINDS:
+        try:
+            os.remove(derived_path(path, kind, output_dir))
+        except OSError:
+            pass
+    if action == "archive":
+        month = time.strftime("%Y%m", time.localtime(os.path.getmtime(path)))
+        archive_dir = os.path.join(output_dir, ARCHIVE_DIRNAME, month)
+        os.makedirs(archive_dir, exist_ok=True)
+        archived = os.path.join(archive_dir, os.path.basename(path))
+        os.replace(path, archived)
+        if os.path.exists(sidecar_path(path)):
+            # 附属文件随图片移动，file_path 指向归档后的位置
+            atomic_write_json(sidecar_path(archived), {**metadata, "file_path": archived})
+            os.remove(sidecar_path(path))
+        return os.path.relpath(archived, output_dir)
+    if os.path.exists(sidecar_path(path)):
+        os.remove(sidecar_path(path))
+    os.remove(path)
+    return None
+
+def rewrite_store_index(output_dir, retired):
+    """Drop (deleted) or repoint (archived) the index.jsonl entries of retired objects.
+
+    retired maps an object path relative to output_dir to its archived relative path,
+    or to None when it was deleted. The index is rewritten atomically.
+    """
+    if not retired:
+        return 0
+    retired = {os.path.normpath(k).replace(os.sep, "/"): v and v.replace(os.sep, "/") for k, v in retired.items()}
+    index_path = os.path.join(output_dir, STORE_INDEX_NAME)
+    kept, dropped = [], 0
+    with _store_lock:
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError:
+            return 0
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                obj = entry.get("object")
+            except ValueError:
+                dropped += 1 # 损坏的行一并清理
+                continue
+            if obj in retired:
+                if retired[obj] is None:
+                    dropped += 1
+                    continue
+                entry["object"] = retired[obj]
+                line = json.dumps(entry, ensure_ascii=False) + "\n"
+            kept.append(line)
+        atomic_write(index_path, "".join(kept).encode("utf-8"))
+    return dropped
+
+def print_retention_report():
+    """--retention-dry-run: print what the configured policy would remove, without touching any file."""
+    policy = retention_policy(load_config_file())
+    if policy is None:
+        print("No retention policy configured (retention_max_mb / retention_max_age_days / retention_max_count)")
+        return
+    victims, stats = plan_retention(OUTPUT_DIR, snapshot_output_dir(OUTPUT_DIR), FAVORITES.snapshot(), policy)
+    print(f"{stats['images']} images, {stats['bytes'] / 1e6:.1f} MB, {stats['pinned']} pinned favourites")
+    print(f"would {policy['action']} {stats['victims']} images, freeing {stats['freed_bytes'] / 1e6:.1f} MB "
+          f"-> {stats['remaining_images']} images, {stats['remaining_bytes'] / 1e6:.1f} MB")
+    for rel in victims:
+        print(f"    {rel}")
+
+# --- Export (批量导出) ---
+EXPORT_CHUNK_SIZE = 1024 * 1024 # 按 1 MB 分块流式复制，图片不整体读入内存
+EXPORT_MANIFEST_NAME = "manifest.jsonl"
+
+def filter_records(records, model=None, start=None, end=None, query=None):
+    """Records matching every given filter: exact model, mtime within [start, end) (epoch seconds), query in prompt or name."""
+    query = (query or "").strip().lower()
+    matched = []
+    for r in records:
+        if model and r.get("model") != model:
+            continue
+        mtime = r.get("mtime") or 0
+        if (start is not None and mtime < start) or (end is not None and mtime >= end):
+            continue
+        if query and query not in (r.get("prompt") or "").lower() and query not in (r.get("name") or "").lower():
+            continue
+        matched.append(r)
+    return matched
+
+def export_archive(records, dest, fmt="zip", on_progress=None, cancelled=None):
+    """Stream the records' images into a zip or tar archive at dest, plus a manifest.jsonl of their metadata.
+
+    Images are copied in EXPORT_CHUNK_SIZE pieces without compression (they are already
+    compressed), so the export runs at disk speed. The archive is written to dest + ".part"
+    and renamed when complete; a cancelled export leaves nothing behind. on_progress(done,
+    total, bytes) is called after every image; cancelled() is polled between images.
+    Returns {"images", "bytes", "missing", "cancelled"}.
+    """
+    import shutil
+    import tarfile
+    import zipfile
+    tmp = dest + ".part"
+    used_names = set()
+    manifest = []
+    result = {"images": 0, "bytes": 0, "missing": 0, "cancelled": False}
+
+    def arcname(record):
+        name = record.get("name") or os.path.basename(record["path"])
+        stem, ext = os.path.splitext(name)
+        candidate, n = name, 1
+        while candidate in used_names:
+            n += 1
+            candidate = f"{stem}_{n}{ext}"
+        used_names.add(candidate)
+        return "images/" + candidate
+
+    archive = zipfile.ZipFile(tmp, "w", zipfile.ZIP_STORED, allowZip64=True) if fmt == "zip" else tarfile.open(tmp, "w")
+    try:
+        for i, record in enumerate(records):
+            if cancelled is not None and cancelled():
+                result["cancelled"] = True
+                break
+            path = record["path"]
+            try:
+                st = os.stat(path)
+                src = open(path, "rb")
+            except OSError:
+                result["missing"] += 1
+                continue
+            member = arcname(record)
+            with src:
+                if fmt == "zip":
+                    info = zipfile.ZipInfo(member, time.localtime(st.st_mtime)[:6])
+                    info.file_size = st.st_size
+                    with archive.open(info, "w", force_zip64=st.st_size > 0x7FFFFFFF) as dst:
+                        shutil.copyfileobj(src, dst, EXPORT_CHUNK_SIZE)
+                else:
+                    info = tarfile.TarInfo(member)
+                    info.size, info.mtime = st.st_size, st.st_mtime
+                    archive.addfile(info, src)
+            manifest.append(json.dumps({"file": member, "source": path, "name": record.get("name"),
+                                        "prompt": record.get("prompt"), "model": record.get("model"),
+                                        "resolution": record.get("resolution"), "mtime": st.st_mtime,
+                                        "bytes": st.st_size}, ensure_ascii=False))
+            result["images"] += 1
+            result["bytes"] += st.st_size
+            if on_progress is not None:
+                on_progress(i + 1, len(records), result["bytes"])
+        if not result["cancelled"]:
+            data = "".join(line + "\n" for line in manifest).encode("utf-8")
+            if fmt == "zip":
+                archive.writestr(EXPORT_MANIFEST_NAME, data, compress_type=zipfile.ZIP_DEFLATED)
+            else:
+                info = tarfile.TarInfo(EXPORT_MANIFEST_NAME)
+                info.size, info.mtime = len(data), time.time()
+                archive.addfile(info, BytesIO(data))
+    except BaseException:
+        archive.close()
+        os.remove(tmp)
+        raise
+    archive.close()
+    if result["cancelled"]:
+        os.remove(tmp)
+    else:
+        os.replace(tmp, dest)
+    return result
+
+# --- Gallery facets (画廊筛选) ---
+# 分辨率档位表：分辨率下拉框与画廊的档位 / 比例筛选共用
+RESOLUTION_CATEGORIES = [
+    ("标准 (Standard)", [
+        {"ratio": "1:1", "size": "512x512"},
+        {"ratio": "3:4", "size": "768x1024"},
+        {"ratio": "4:3", "size": "640x480"},
+        {"ratio": "16:9", "size": "640x360"},
+        {"ratio": "9:16", "size": "360x640"},
+        {"ratio": "3:2", "size": "720x480"},
+        {"ratio": "2:3", "size": "480x720"},
+        {"ratio": "21:9", "size": "840x360"},
+    ]),
+    ("高清 (HD)", [
+        {"ratio": "1:1", "size": "1024x1024"},
+        {"ratio": "3:4", "size": "1152x1536"},
+        {"ratio": "4:3", "size": "1280x960"},
+        {"ratio": "16:9", "size": "1600x900"},
+        {"ratio": "9:16", "size": "900x1600"},
+        {"ratio": "3:2", "size": "1536x1024"},
+        {"ratio": "2:3", "size": "1024x1536"},
+        {"ratio": "21:9", "size": "1680x720"},
+    ]),
+    ("超清 (Ultra)", [
+        {"ratio": "1:1", "size": "2048x2048"},
+        {"ratio": "3:4", "size": "1536x2048"},
+        {"ratio": "4:3", "size": "2048x1536"},
+        {"ratio": "16:9", "size": "2048x1152"},
+        {"ratio": "9:16", "size": "1152x2048"},
+        {"ratio": "3:2", "size": "2048x1365"},
+        {"ratio": "2:3", "size": "1365x2048"},
+        {"ratio": "21:9", "size": "2048x876"},
+    ]),
+]
+RESOLUTION_FACETS = {it["size"]: (tier, it["ratio"]) for tier, items in RESOLUTION_CATEGORIES for it in items}
+FACET_OTHER = "其他 (Other)"
+
+def ratio_cn(ratio):
+    return "方形" if ratio == "1:1" else ("横屏" if ratio in ("4:3", "16:9", "3:2", "21:9") else "竖屏")
+
+def resolution_facets(resolution):
+    """(tier, aspect ratio) of a "WxH" resolution.
+
+    Sizes from RESOLUTION_CATEGORIES map directly; other sizes get the closest listed
+    ratio (within 5%) and the smallest tier whose long side covers theirs.
+    """
+    size = (resolution or "").split(" ")[0].replace("*", "x")
+    if size in RESOLUTION_FACETS:
+        return RESOLUTION_FACETS[size]
+    try:
+        width, height = (int(v) for v in size.split("x"))
+    except ValueError:
+        return FACET_OTHER, FACET_OTHER
+    if width <= 0 or height <= 0:
+        return FACET_OTHER, FACET_OTHER
+    ratio, error = FACET_OTHER, 0.05
+    for tier, items in RESOLUTION_CATEGORIES:
+        for it in items:
+            w, h = (int(v) for v in it["size"].split("x"))
+            diff = abs(width * h / (height * w) - 1)
+            if diff <= error:
+                ratio, error = it["ratio"], diff
+    for tier, items in RESOLUTION_CATEGORIES:
+        if max(width, height) <= max(int(v) for it in items for v in it["size"].split("x")):
+            return tier, ratio
+    return RESOLUTION_CATEGORIES[-1][0], ratio
+
+class GalleryIndex:
+    """Inverted indexes over the gallery records for faceted filtering.
+
+    Every facet (model, resolution tier, aspect ratio) maps each value to the set of
+    paths that have it, and a per-day index backs the date headers. add()/remove() keep
+    the sets current as images arrive or disappear, so query() and counts() are set
+    operations that never touch widgets or disk.
+    """
+    FACETS = ("model", "tier", "ratio")
+
+    def __init__(self):
+        self.values = {} # path -> {facet: value}
+        self.postings = {facet: {} for facet in self.FACETS}
+        self.days = {} # 日期 -> paths，用于按日期分组的标题与计数
+        self.day_of = {}
+
+    @staticmethod
+    def facet_values(record):
+        tier, ratio = resolution_facets(record.get("resolution"))
+        return {"model": record.get("model") or FACET_OTHER, "tier": tier, "ratio": ratio}
+
+    def add(self, record):
+        """Index (or re-index, after a metadata change) one record."""
+        path = record["path"]
+        self.remove(path)
+        values = self.facet_values(record)
+        self.values[path] = values
+        for facet, value in values.items():
+            self.postings[facet].setdefault(value, set()).add(path)
+        day = gallery_day(record.get("mtime"))
+        self.day_of[path] = day
+        self.days.setdefault(day, set()).add(path)
+
+    def remove(self, path):
+        values = self.values.pop(path, None)
+        if values is None:
+            return
+        for facet, value in values.items():
+            paths = self.postings[facet][value]
+            paths.discard(path)
+            if not paths:
+                del self.postings[facet][value]
+        day = self.day_of.pop(path)
+        self.days[day].discard(path)
+        if not self.days[day]:
+            del self.days[day]
+
+    def matches(self, path, filters):
+        values = self.values.get(path)
+        return values is not None and all(values[f] == v for f, v in filters.items() if v is not None)
+
+    def query(self, filters, exclude=None):
+        """Set of paths matching every active filter ({facet: value or None}), or None when nothing filters."""
+        sets = [self.postings[f].get(v, set()) for f, v in filters.items() if v is not None and f != exclude]
+        if not sets:
+            return None
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def counts(self, filters):
+        """{facet: {value: count}}. Each facet is counted under the other facets' filters, so an
+        option's count is the number of images selecting it would show."""
+        counts = {}
+        for facet in self.FACETS:
+            base = self.query(filters, exclude=facet)
+            if base is None:
+                counts[facet] = {value: len(paths) for value, paths in self.postings[facet].items()}
+                continue
+            # 集合求交在 C 中完成，每次只遍历较小的一方
+            tally = {value: len(paths & base) for value, paths in self.postings[facet].items()}
+            counts[facet] = {value: n for value, n in tally.items() if n}
+        return counts
+
+    def day_counts(self, visible=None):
+        """{day: number of paths} over all paths, or only over `visible` (a query() result)."""
+        if visible is None:
+            return {day: len(paths) for day, paths in self.days.items()}
+        counts = {day: len(paths & visible) for day, paths in self.days.items()}
+        return {day: n for day, n in counts.items() if n}
+
+def gallery_day(mtime):
+    """Local calendar date of an mtime, used for the gallery's date headers (None when unknown)."""
+    return datetime.date.fromtimestamp(mtime) if mtime else None
+
+def day_title(day, today=None):
+    today = today or datetime.date.today()
+    if day is None:
+        return "未知日期 (Unknown date)"
+    if day == today:
+        return f"今天 (Today) · {day.isoformat()}"
+    if day == today - datetime.timedelta(days=1):
+        return f"昨天 (Yesterday) · {day.isoformat()}"
+    return day.isoformat()
+
+# --- Prompt history (提示词历史) ---
+PROMPT_HISTORY_FILE = os.path.join(LOG_DIR, "prompt_history.jsonl")
+PROMPT_SUGGESTIONS = 8 # 自动补全最多显示的条数
+PROMPT_MIN_QUERY = 2 # 输入至少这么多字符后才查询
+PROMPT_NGRAM = 3 # 子串匹配使用的 n-gram 长度
+PROMPT_HALF_LIFE_DAYS = 30.0 # 排序时的新近度衰减：30 天前的提示词权重减半
+PROMPT_INDEX_BATCH = 2000 # 启动后每批建入 n-gram 索引的提示词数，批次之间可以响应查询
+
+def normalize_prompt(text):
+    """Case-folded prompt with whitespace collapsed: the key that identifies a repeated prompt."""
+    return " ".join(text.split()).casefold()
+
+class PromptHistory(QObject):
+    """Every prompt submitted for images or chat, indexed for ranked autocomplete.
+
+    Prompts live in PROMPT_HISTORY_FILE (one {"text", "kind", "count", "ts"} line per
+    submit; repeats are folded on load). A sorted list of normalized prompts answers
+    prefix queries with bisect, and n-gram posting lists narrow substring queries to the
+    prompts sharing the query's rarest n-gram. Matches are ranked by use count, recency,
+    whether they start with the query and whether they were used for the same kind of
+    request. Lookups run on a background thread and only
+    the newest request is answered, so typing never waits on the index.
+    """
+    suggestions = Signal(str, list) # query, [prompt text]
+
+    def __init__(self, path=PROMPT_HISTORY_FILE, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.tasks = []
+        self.pending = None # 最新一次查询 (query, kind)；旧的未处理查询直接丢弃
+        self.worker = None
+        self.needs_import = False
+        self.texts, self.norms, self.counts, self.last_used, self.kinds = [], [], [], [], []
+        self.ids = {} # normalized prompt -> id
+        self.sorted = [] # [(normalized prompt, id)]，按前缀二分查找
+        self.grams = defaultdict(lambda: array("i")) # n-gram -> ids
+        self.grams_upto = 0 # id 小于此值的提示词已建入 n-gram 索引，其余在空闲时分批补建
+        self.by_kind = {} # "image" / "chat" -> set of ids
+        self.weights = [] # weight(id)：次数与新近度部分的得分
+        self.weights_at = time.time()
+
+    def start(self):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.work, name="prompt-history", daemon=True)
+            self.worker.start()
+
+    def post(self, task):
+        self.start()
+        with self.cond:
+            self.tasks.append(task)
+            self.cond.notify()
+
+    def submit(self, text, kind):
+        """Record one submitted prompt ("image" or "chat"); indexed and persisted on the worker."""
+        self.post(("add", text, kind, time.time()))
+
+    def import_records(self, records):
+        """Seed an empty history from the gallery's image metadata (first run only)."""
+        self.post(("import", [(r.get("prompt") or "", r.get("mtime") or 0) for r in records]))
+
+    def request(self, query, kind=None):
+        """Ask for suggestions; the answer arrives through the suggestions signal."""
+        self.start()
+        with self.cond:
+            self.pending = (query, kind)
+            self.cond.notify()
+
+    def work(self):
+        self.load()
+        while True:
+            with self.cond:
+                while not self.tasks and self.pending is None and self.grams_upto >= len(self.texts):
+                    self.cond.wait()
+                tasks, self.tasks = self.tasks, []
+                pending, self.pending = self.pending, None
+            if not tasks and pending is None:
+                self.index_grams(PROMPT_INDEX_BATCH)
+                continue
+            for task in tasks:
+                try:
+                    self.run_task(task)
+                except Exception as e:
+                    log_error(f"Error updating prompt history: {e}")
+            if pending is not None:
+                query, kind = pending
+                self.suggestions.emit(query, self.lookup(query, kind))
+
+    def run_task(self, task):
+        if task[0] == "add":
+            _, text, kind, ts = task
+            if self.add(text, kind, ts):
+                self.append_lines([{"text": text.strip(), "kind": kind, "count": 1, "ts": round(ts)}])
+        elif task[0] == "import" and self.needs_import:
+            self.needs_import = False
+            folded = {}
+            for text, ts in task[1]:
+                norm = normalize_prompt(text)
+                if len(norm) < PROMPT_MIN_QUERY:
+                    continue
+                entry = folded.setdefault(norm, {"text": text.strip(), "kind": "image", "count": 0, "ts": 0})
+                entry["count"] += 1
+                entry["ts"] = max(entry["ts"], round(ts))
+            for entry in folded.values():
+                self.add(entry["text"], "image", entry["ts"], entry["count"], loading=True)
+            with self.lock:
+                self.sorted.sort()
+            self.append_lines(list(folded.values()))
+
+    def load(self):
+        lines = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                        self.add(entry["text"], entry.get("kind", "image"), entry.get("ts", 0), entry.get("count", 1),
+                                 loading=True)
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except FileNotFoundError:
+            self.needs_import = True
+            return
+        except OSError as e:
+            log_error(f"Error reading {self.path}: {e}")
+            return
+        finally:
+            with self.lock:
+                self.sorted.sort()
+        if lines > 2 * len(self.texts) + 100:
+            # 重复提交留下的行过多时合并为每个提示词一行
+            self.compact()
+
+    def compact(self):
+        with self.lock:
+            entries = [{"text": text, "kind": kind, "count": count, "ts": round(ts)}
+                       for text, kind, count, ts in zip(self.texts, self.kinds, self.counts, self.last_used)]
+        try:
+            atomic_write(self.path, "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries).encode("utf-8"))
+        except OSError as e:
+            log_error(f"Error compacting {self.path}: {e}")
+
+    def append_lines(self, entries):
+        if not entries:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries))
+        except OSError as e:
+            log_error(f"Error writing {self.path}: {e}")
+
+    def weight(self, i):
+        """Count and recency part of the ranking, measured at weights_at (refreshed daily)."""
+        age_days = max(0.0, self.weights_at - self.last_used[i]) / 86400
+        return (1 + math.log(self.counts[i])) * (0.25 + 0.5 ** (age_days / PROMPT_HALF_LIFE_DAYS))
+
+    def add(self, text, kind, ts, count=1, loading=False):
+        """Index one prompt use; returns False for prompts too short to suggest."""
+        text = text.strip()
+        norm = normalize_prompt(text)
+        if len(norm) < PROMPT_MIN_QUERY:
+            return False
+        with self.lock:
+            i = self.ids.get(norm)
+            if i is not None:
+                self.counts[i] += count
+                if ts >= self.last_used[i]:
+                    self.by_kind[self.kinds[i]].discard(i)
+                    self.last_used[i], self.texts[i], self.kinds[i] = ts, text, kind
+                    self.by_kind.setdefault(kind, set()).add(i)
+                self.weights[i] = self.weight(i)
+                return True
+            i = len(self.texts)
+            self.ids[norm] = i
+            self.texts.append(text)
+            self.norms.append(norm)
+            self.counts.append(count)
+            self.last_used.append(ts)
+            self.kinds.append(kind)
+            self.by_kind.setdefault(kind, set()).add(i)
+            self.weights.append(self.weight(i))
+            if loading:
+                self.sorted.append((norm, i)) # load() 结束时统一排序，n-gram 索引之后分批建立
+            else:
+                bisect.insort(self.sorted, (norm, i))
+        if not loading and self.grams_upto == i:
+            self.index_grams(1)
+        return True
+
+    def index_grams(self, count):
+        """Add the next `count` not yet indexed prompts to the n-gram posting lists."""
+        with self.lock:
+            grams, norms = self.grams, self.norms
+            end = min(self.grams_upto + count, len(norms))
+            for i in range(self.grams_upto, end):
+                norm = norms[i]
+                for gram in {norm[k:k + PROMPT_NGRAM] for k in range(len(norm) - PROMPT_NGRAM + 1)}:
+                    grams[gram].append(i)
+            self.grams_upto = end
+
+    def lookup(self, query, kind=None, limit=PROMPT_SUGGESTIONS, now=None):
+        """Up to `limit` earlier prompts containing `query`, best first (the query itself excluded)."""
+        q = normalize_prompt(query)
+        if len(q) < PROMPT_MIN_QUERY:
+            return []
+        now = now or time.time()
+        with self.lock:
+            if now - self.weights_at > 86400:
+                self.weights_at = now
+                self.weights = [self.weight(i) for i in range(len(self.texts))]
+            prefix = set()
+            k = bisect.bisect_left(self.sorted, (q,))
+            while k < len(self.sorted) and self.sorted[k][0].startswith(q):
+                prefix.add(self.sorted[k][1])
+                k += 1
+            # 只取查询中最稀有的 n-gram 的倒排表，逐条确认是否包含整个查询；比 n-gram 短的查询
+            # （如两个汉字）与尚未建入索引的提示词（启动后的短时间内）直接逐条比对
+            norms = self.norms
+            others, scan_from = set(), 0
+            if len(q) >= PROMPT_NGRAM:
+                postings = [self.grams.get(q[k:k + PROMPT_NGRAM]) for k in range(len(q) - PROMPT_NGRAM + 1)]
+                if all(p is not None for p in postings):
+                    others = {i for i in min(postings, key=len) if q in norms[i]}
+                scan_from = self.grams_upto
+            others.update(i for i in range(scan_from, len(norms)) if q in norms[i])
+            others -= prefix
+            exact = self.ids.get(q)
+            prefix.discard(exact)
+            others.discard(exact)
+            # 同一组内（是否前缀匹配 × 是否同类）加成相同，只需按预先算好的权重各取前 limit 个
+            same_kind = self.by_kind.get(kind, set())
+            boosts = {}
+            for group, boost in ((prefix, 2.0), (others, 1.0)):
+                for part, factor in ((group & same_kind, 1.5), (group - same_kind, 1.0)):
+                    for i in heapq.nlargest(limit, part, key=self.weights.__getitem__):
+                        boosts[i] = boost * factor
+            best = heapq.nlargest(limit, boosts, key=lambda i: self.weights[i] * boosts[i])
+            return [self.texts[i] for i in best]
+
+PROMPT_HISTORY = PromptHistory()
+
+# --- Detail Dialog ---
+class DetailDialog(QDialog):
+    @profiled_slot("DetailDialog.__init__")
+    def __init__(self, records, index, parent=None):
+        """
+        records: gallery records (path, prompt, model, resolution) in gallery order; index: the one to show first
+        """
+        super().__init__(parent)
+        self.records = records
+        self.all_records = records
+        self.distances = None # "相似图片" 模式下各图片与原图的汉明距离
+        self.index = index
+        self.token = 0
+        self.prefetcher = PrefetchThread(IMAGE_CACHE)
+        self.prefetcher.loaded.connect(self.on_prefetched)
+        self.prefetcher.start()
+        self.setWindowTitle("Image Details (图片详情)")
+        self.resize(1000, 800)
+        self.setModal(True)
+        self.is_fullscreen = False
+        
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0) # Remove margins for better fullscreen experience
+        layout.setSpacing(0) # Remove spacing between sections
+        
+        # Top Bar (for Close/Fullscreen when in fullscreen mode, though we use bottom buttons mostly)
+        # We'll stick to bottom buttons for simplicity, but maybe add a small close button overlay later if needed.
+        # For now, standard dialog frame handles closing in normal mode.
+        
+        # Image Display (Scrollable for large images)
+        self.scroll_area = QScrollArea()
+        self.scroll_area.setWidgetResizable(True)
+        self.scroll_area.setAlignment(Qt.AlignCenter)
+        self.scroll_area.setStyleSheet("background-color: #2c3e50; border: none;") # Dark background for better viewing
+        self.scroll_area.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.scroll_area.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
+        
+        self.image_label = QLabel()
+        self.image_label.setAlignment(Qt.AlignCenter)
+        
+        self.scroll_area.setWidget(self.image_label)
+        layout.addWidget(self.scroll_area)
+        
+        # Info Area
+        self.info_frame = QFrame()
+        self.info_frame.setStyleSheet("background-color: #f7f9fc; border-top: none;")
+        info_layout = QFormLayout(self.info_frame)
+        info_layout.setContentsMargins(20, 12, 20, 20)
+        info_layout.setVerticalSpacing(12)
+        info_layout.setLabelAlignment(Qt.AlignRight | Qt.AlignVCenter)
+        info_layout.setFormAlignment(Qt.AlignLeft | Qt.AlignTop)
+        
+        self.prompt_edit = QTextEdit()
+        self.prompt_edit.setReadOnly(True)
+        self.prompt_edit.setMaximumHeight(80)
+        self.prompt_edit.setStyleSheet("background-color: white; border: 1px solid #ccc; color: #333;")
+        
+        info_layout.addRow("<b>提示词 (Prompt):</b>", self.prompt_edit)
+
+        self.model_label = QLabel()
+        self.model_label.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
+        self.model_label.setStyleSheet("color: #2c3e50; padding: 2px 0;")
+        info_layout.addRow("<b>模型 (Model):</b>", self.model_label)
+
+        self.res_label = QLabel()
+        self.res_label.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
+        self.res_label.setStyleSheet("color: #2c3e50; padding: 2px 0;")
+        info_layout.addRow("<b>分辨率 (Resolution):</b>", self.res_label)
+
+        self.path_label = QLabel()
+        self.path_label.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
+        self.path_label.setStyleSheet("color: #2c3e50; padding: 2px 0;")
+        info_layout.addRow("<b>文件路径 (File Path):</b>", self.path_label)
+        
+        self.info_frame.setVisible(False) # Default hidden
+        layout.addWidget(self.info_frame)
+        
+        # Control Bar (Buttons)
+        control_bar = QFrame()
+        control_bar.setStyleSheet("""
+            QFrame {
+                background-color: #2c3e50; 
+                border-top: 1px solid #243445;
+            }
+            QPushButton {
+                background-color: #34495e;
+                color: white;
+                border: 1px solid #4e6d8d;
+                border-radius: 6px;
+                padding: 8px 16px;
+            }
+            QPushButton:hover {
+                background-color: #4e6d8d;
+                border-color: #5d81a8;
+            }
+            QPushButton:checked {
+                background-color: #2980b9;
+                border-color: #3498db;
+            }
+        """)
+        btn_layout = QHBoxLayout(control_bar)
+        btn_layout.setContentsMargins(10, 10, 10, 10)
+        
+        # Toggle Info Button
+        self.info_btn = QPushButton("显示信息 (Show Info) ▲")
+        self.info_btn.setCheckable(True)
+        self.info_btn.clicked.connect(self.toggle_info)
+        btn_layout.addWidget(self.info_btn)
+        
+        # Fullscreen Button
+        self.fullscreen_btn = QPushButton("全屏 (Fullscreen)")
+        self.fullscreen_btn.setCheckable(True)
+        self.fullscreen_btn.clicked.connect(self.toggle_fullscreen)
+        btn_layout.addWidget(self.fullscreen_btn)
+
+        # 相似图片：按感知哈希切换为浏览与当前图片相近的图片
+        self.similar_btn = QPushButton("相似图片 (Similar)")
+        self.similar_btn.setCheckable(True)
+        self.similar_btn.clicked.connect(self.toggle_similar)
+        btn_layout.addWidget(self.similar_btn)
+
+        # 收藏的图片不会被保留策略清理
+        self.favorite_btn = QPushButton()
+        self.favorite_btn.setCheckable(True)
+        self.favorite_btn.clicked.connect(self.toggle_favorite)
+        btn_layout.addWidget(self.favorite_btn)
+
+        btn_layout.addStretch()
+
+        # 上一张 / 下一张 (也可用键盘左右方向键)
+        self.prev_btn = QPushButton("◀")
+        self.prev_btn.setToolTip("上一张 (Previous, ←)")
+        self.prev_btn.clicked.connect(lambda: self.step(-1))
+        btn_layout.addWidget(self.prev_btn)
+
+        self.position_label = QLabel()
+        self.position_label.setStyleSheet("color: white; padding: 0 8px;")
+        btn_layout.addWidget(self.position_label)
+
+        self.next_btn = QPushButton("▶")
+        self.next_btn.setToolTip("下一张 (Next, →)")
+        self.next_btn.clicked.connect(lambda: self.step(1))
+        btn_layout.addWidget(self.next_btn)
+
+        # 使用快捷键而非 keyPressEvent：滚动区域会吞掉方向键
+        for key, delta in ((Qt.Key_Left, -1), (Qt.Key_Right, 1)):
+            action = QAction(self)
+            action.setShortcut(key)
+            action.triggered.connect(lambda checked=False, d=delta: self.step(d))
+            self.addAction(action)
+
+        btn_layout.addStretch()
+        
+        open_file_btn = QPushButton("打开文件 (Open File)")
+        open_file_btn.clicked.connect(lambda: os.startfile(self.current_path) if sys.platform == "win32" else None)
+        btn_layout.addWidget(open_file_btn)
+        
+        open_folder_btn = QPushButton("打开目录 (Open Folder)")
+        open_folder_btn.clicked.connect(lambda: os.startfile(os.path.dirname(self.current_path)) if sys.platform == "win32" else None)
+        btn_layout.addWidget(open_folder_btn)
+        
+        close_btn = QPushButton("关闭 (Close)")
+        close_btn.setStyleSheet("background-color: #c0392b; border-color: #e74c3c;") # Red for close
+        close_btn.clicked.connect(self.close) # Use close instead of accept to ensure proper teardown
+        btn_layout.addWidget(close_btn)
+        
+        layout.addWidget(control_bar)
+        
+        # Install Event Filter for Double Click
+        self.image_label.installEventFilter(self)
+
+        self.show_index(index)
+
+    @property
+    def current_path(self):
+        return self.records[self.index]["path"]
+
+    def step(self, delta):
+        target = self.index + delta
+        if 0 <= target < len(self.records):
+            self.show_index(target, delta)
+
+    @profiled_slot("DetailDialog.show_index")
+    def show_index(self, index, direction=1):
+        self.index = index
+        record = self.records[index]
+        path = record["path"]
+        self.prompt_edit.setPlainText(record["prompt"])
+        self.model_label.setText(record["model"])
+        self.res_label.setText(record["resolution"])
+        self.path_label.setText(path)
+        position = f"{index + 1} / {len(self.records)}"
+        if self.distances is not None and index > 0:
+            position += f" · 距离 (Distance) {self.distances[index]}"
+        self.position_label.setText(position)
+        self.prev_btn.setEnabled(index > 0)
+        self.next_btn.setEnabled(index < len(self.records) - 1)
+        self.update_favorite_button(FAVORITES.contains(path))
+
+        image = IMAGE_CACHE.get(path, "full")
+        if image is not None:
+            self.set_image(image)
+        else:
+            # 预解码尚未完成：先放大显示缩略图，完整图片解码后替换
+            thumb = IMAGE_CACHE.get(path, "thumb")
+            if thumb is not None:
+                pixmap = QPixmap.fromImage(thumb).scaled(self.scroll_area.viewport().size(), Qt.KeepAspectRatio,
+                                                         Qt.SmoothTransformation)
+                self.image_label.setPixmap(pixmap)
+            else:
+                self.image_label.setPixmap(QPixmap())
+                self.image_label.setText("加载中... (Loading...)")
+
+        # 新令牌使旧的预解码队列失效；先解码当前图片，再按浏览方向交替解码前后相邻的图片
+        self.token += 1
+        order = [path] if image is None else []
+        for distance in range(1, PREFETCH_RADIUS + 1):
+            for neighbour in (index + direction * distance, index - direction * distance):
+                if 0 <= neighbour < len(self.records):
+                    order.append(self.records[neighbour]["path"])
+        self.prefetcher.schedule(order, self.token)
+
+    def update_favorite_button(self, favorite):
+        self.favorite_btn.setChecked(favorite)
+        self.favorite_btn.setText("★ 已收藏 (Favorite)" if favorite else "☆ 收藏 (Favorite)")
+
+    def toggle_favorite(self, checked):
+        FAVORITES.set(self.current_path, checked)
+        self.update_favorite_button(checked)
+
+    def toggle_similar(self, checked):
+        path = self.current_path
+        if checked:
+            matches = SIMILARITY_INDEX.nearest(path)
+            if not matches:
+                self.similar_btn.setChecked(False)
+                indexed = SIMILARITY_INDEX.hash_of(path) is not None
+                self.position_label.setText("没有相似图片 (No similar images)" if indexed
+                                            else "尚未建立索引 (Not indexed yet)")
+                return
+            by_path = {r["path"]: r for r in self.all_records}
+            self.records = [by_path.get(p) or read_history_record(p) for p in [path] + [p for _, p in matches]]
+            self.distances = [0] + [d for d, _ in matches]
+            self.similar_btn.setText("全部图片 (All Images)")
+            self.show_index(0)
+        else:
+            self.records = self.all_records
+            self.distances = None
+            self.similar_btn.setText("相似图片 (Similar)")
+            self.show_index(next((i for i, r in enumerate(self.records) if r["path"] == path), 0))
+
+    def set_image(self, image):
+        if image.isNull():
+            self.image_label.setPixmap(QPixmap())
+            self.image_label.setText("Image Load Failed")
+            return
+        pixmap = QPixmap.fromImage(image)
+        self.original_pixmap = pixmap
+        # Handle High DPI: Ensure 1:1 pixel mapping to avoid blurriness
+        pixmap.setDevicePixelRatio(self.devicePixelRatio())
+        self.image_label.setPixmap(pixmap)
+
+    def on_prefetched(self, path, token, image):
+        if token != self.token or path != self.current_path:
+            return
+        # 图片随信号传来：超过缓存上限未被缓存的大图也不必在界面线程重新读取
+        self.set_image(image)
+
+    def done(self, result):
+        self.prefetcher.stop()
+        super().done(result)
+
+    def eventFilter(self, source, event):
+        if source == self.image_label and event.type() == QEvent.MouseButtonDblClick:
+             if event.button() == Qt.LeftButton:
+                 # Toggle Fullscreen
+                 is_full = self.isFullScreen()
+                 self.toggle_fullscreen(not is_full)
+                 self.fullscreen_btn.setChecked(not is_full)
+                 return True
+        return super().eventFilter(source, event)
+
+    def toggle_info(self, checked):
+        self.info_frame.setVisible(checked)
+        if checked:
+            self.info_btn.setText("隐藏信息 (Hide Info) ▼")
+        else:
+            self.info_btn.setText("显示信息 (Show Info) ▲")
+
+    def toggle_fullscreen(self, checked):
+        if checked:
+            self.showFullScreen()
+            self.fullscreen_btn.setText("退出全屏 (Exit Fullscreen)")
+        else:
+            self.showNormal()
+            self.fullscreen_btn.setText("全屏 (Fullscreen)")
+            
+    def keyPressEvent(self, event):
+        # Allow Esc to exit fullscreen first, then close dialog
+        if event.key() == Qt.Key_Escape:
+            if self.isFullScreen():
                 self.toggle_fullscreen(False)
                 self.fullscreen_btn.setChecked(False)
             else:
-                self.close()
+                self.close()
+        else:
+            super().keyPressEvent(event)
+
+# --- ModelScope API ---
+class GenerationError(Exception):
+    pass
+
+class ChatError(Exception):
+    pass
+
+def set_api_base(url):
+    """Send API requests to url, e.g. a local daemon (config.json: daemon_url) instead of ModelScope."""
+    global API_BASE_URL
+    API_BASE_URL = url.rstrip("/") + "/"
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def http_session():
+    """Process-wide requests.Session: connections to the API host are pooled and kept alive between requests.
+
+    Host names resolve through DNS_CACHE, and CONNECTION_WARMER tracks every request from
+    start to end (a streamed response until it is closed) so it can pre-open a connection
+    before the next request and close the pool only once nothing is in flight.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests # 延迟导入：首次请求时才加载 requests，缩短启动时间
+
+            class TrackedSession(requests.Session):
+                def send(self, request, **kwargs):
+                    CONNECTION_WARMER.begin()
+                    try:
+                        response = super().send(request, **kwargs)
+                    except BaseException:
+                        CONNECTION_WARMER.end()
+                        raise
+                    if not kwargs.get("stream"):
+                        CONNECTION_WARMER.end() # 非流式响应在 send 内已读完
+                        return response
+                    # 流式响应 (SSE、分块下载) 直到关闭才算结束；未关闭就被回收时也只结束一次
+                    finished = weakref.finalize(response, CONNECTION_WARMER.end)
+                    close = response.close
+                    def close_and_finish():
+                        try:
+                            close()
+                        finally:
+                            finished()
+                    response.close = close_and_finish
+                    return response
+
+            session = TrackedSession()
+            adapter = cached_dns_adapter(pool_connections=4, pool_maxsize=16)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
+DNS_CACHE_TTL = 300 # 秒：DNS 解析结果的缓存时间
+CONNECTION_IDLE_TIMEOUT = 60 # 秒：连接空闲超过此时间即主动关闭（服务器一般也会在一分钟左右断开空闲连接）
+WARMUP_MIN_INTERVAL = 15 # 秒：最近这么久内用过连接时不再预热
+WARMUP_TIMEOUT = 10 # 秒
+
+class DNSCache:
+    """getaddrinfo results per (host, port), reused for DNS_CACHE_TTL seconds."""
+
+    def __init__(self, ttl=DNS_CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {} # (host, port) -> (address, expires)
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "lookups": 0, "lookup_ms": 0.0}
+
+    def resolve(self, host, port):
+        """First address for host (cached), or None when it cannot be resolved here."""
+        import socket
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get((host, port))
+            if entry is not None and entry[1] > now:
+                self.stats["hits"] += 1
+                return entry[0]
+        start = time.perf_counter()
+        try:
+            infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except OSError:
+            return None
+        address = infos[0][4][0]
+        with self.lock:
+            self.stats["lookups"] += 1
+            self.stats["lookup_ms"] += (time.perf_counter() - start) * 1000
+            self.entries[(host, port)] = (address, now + self.ttl)
+        return address
+
+    def forget(self, host, port):
+        with self.lock:
+            self.entries.pop((host, port), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+DNS_CACHE = DNSCache()
+
+class ConnectionStats:
+    """Connections opened per thread, so a request can tell whether it reused a pooled (warm) one."""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.totals = {"opened": 0, "handshake_ms": 0.0}
+
+    def opened(self, ms):
+        self.local.count = getattr(self.local, "count", 0) + 1
+        self.local.ms = getattr(self.local, "ms", 0.0) + ms
+        with self.lock:
+            self.totals["opened"] += 1
+            self.totals["handshake_ms"] += ms
+
+    def checkpoint(self):
+        return getattr(self.local, "count", 0), getattr(self.local, "ms", 0.0)
+
+    def since(self, checkpoint):
+        """{"connection": "warm" | "cold", "handshake_ms"} for requests made on this thread since checkpoint."""
+        count, ms = self.checkpoint()
+        if count == checkpoint[0]:
+            return {"connection": "warm"}
+        return {"connection": "cold", "handshake_ms": round(ms - checkpoint[1], 1)}
+
+CONNECTION_STATS = ConnectionStats()
+
+def cached_dns_adapter(**kwargs):
+    """HTTPAdapter whose new connections resolve through DNS_CACHE and report their handshake time."""
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+    from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+    class CachedDNSConnection:
+        def _new_conn(self):
+            # _dns_host 是 urllib3 (1.26 与 2.x，见 requirements.txt) 建立 TCP 连接所用的主机名；
+            # 其他版本没有此属性时退回普通解析，而不是让请求失败
+            host = getattr(self, "_dns_host", None)
+            if host is None:
+                return super()._new_conn()
+            address = DNS_CACHE.resolve(host, self.port)
+            if address is None:
+                return super()._new_conn()
+            # 只替换建立 TCP 连接所用的地址；TLS 的 SNI 与证书校验仍使用原主机名
+            self._dns_host = address
+            try:
+                return super()._new_conn()
+            except (NewConnectionError, ConnectTimeoutError):
+                DNS_CACHE.forget(host, self.port) # 缓存的地址已不可用，重新解析
+            finally:
+                self._dns_host = host
+            return super()._new_conn()
+
+        def connect(self):
+            start = time.perf_counter()
+            super().connect()
+            CONNECTION_STATS.opened((time.perf_counter() - start) * 1000)
+
+    class HTTPPool(HTTPConnectionPool):
+        ConnectionCls = type("CachedDNSHTTPConnection", (CachedDNSConnection, HTTPConnection), {})
+
+    class HTTPSPool(HTTPSConnectionPool):
+        ConnectionCls = type("CachedDNSHTTPSConnection", (CachedDNSConnection, HTTPSConnection), {})
+
+    class CachedDNSAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **pool_kwargs):
+            super().init_poolmanager(*args, **pool_kwargs)
+            self.poolmanager.pool_classes_by_scheme = {"http": HTTPPool, "https": HTTPSPool}
+
+    return CachedDNSAdapter(**kwargs)
+
+class ConnectionWarmer:
+    """Opens a pooled connection to the API host ahead of the first request, and closes it once idle.
+
+    warm() is cheap enough to call on every keystroke: it only starts a background HEAD
+    request when no connection has been used for WARMUP_MIN_INTERVAL seconds. Pooled
+    connections idle for longer than idle_timeout are closed before the server drops
+    them, so the next request never lands on a half-closed socket. Idle means no request
+    in flight: a long poll or an SSE stream keeps the pool open however long it lasts.
+    """
+
+    def __init__(self, idle_timeout=CONNECTION_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.active = 0 # 进行中的请求数（流式响应在关闭前都算进行中）
+        self.last_used = 0.0 # 最近一次请求开始或结束的时间 (monotonic)，0 表示没有可复用的连接
+        self.warming = None # 正在进行的预热线程
+        self.reaper = None
+
+    def begin(self):
+        with self.lock:
+            self.active += 1
+            self.last_used = time.monotonic()
+
+    def end(self):
+        with self.lock:
+            self.active -= 1
+            self.last_used = time.monotonic()
+
+    def warm(self, reason):
+        """Start a warm-up in the background unless a connection is already warm; returns the thread or None."""
+        with self.lock:
+            if self.warming is not None or self.active or time.monotonic() - self.last_used < WARMUP_MIN_INTERVAL:
+                return None
+            self.warming = threading.Thread(target=self.run, args=(reason,), name="connection-warmup", daemon=True)
+            self.warming.start()
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self.reap_forever, name="connection-reaper", daemon=True)
+                self.reaper.start()
+            return self.warming
+
+    def run(self, reason):
+        record = {"ts": datetime.datetime.now().isoformat(timespec="seconds"), "reason": reason,
+                  "host": API_BASE_URL}
+        dns_before = DNS_CACHE.stats["hits"]
+        start = time.perf_counter()
+        try:
+            session = http_session()
+            checkpoint = CONNECTION_STATS.checkpoint()
+            request_start = time.perf_counter()
+            # 任何状态码都可以：目的只是完成 DNS、TCP 与 TLS 握手并把连接留在连接池中
+            response = session.head(API_BASE_URL, timeout=WARMUP_TIMEOUT, allow_redirects=False)
+            response.close()
+            record.update(CONNECTION_STATS.since(checkpoint), status="ok", http_status=response.status_code,
+                          request_ms=round((time.perf_counter() - request_start) * 1000, 1))
+        except Exception as e:
+            record.update(status="error", error=str(e)[:500])
+        record["dns"] = "cached" if DNS_CACHE.stats["hits"] > dns_before else "lookup"
+        record["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        write_metrics(CONNECTION_METRICS_LOG, record)
+        with self.lock:
+            self.warming = None
+
+    def reap(self):
+        """Close pooled connections once no request has been in flight for idle_timeout seconds."""
+        with self.lock:
+            if not self.last_used or self.warming is not None or self.active:
+                return False
+            if time.monotonic() - self.last_used < self.idle_timeout:
+                return False
+            self.last_used = 0.0
+            # 持锁关闭：关闭期间开始的请求会等到连接池清空后再取连接
+            if _http_session is not None:
+                _http_session.close() # 只清空连接池；会话仍可继续使用，下次请求时重新建立连接
+        return True
+
+    def reap_forever(self):
+        while True:
+            time.sleep(max(1.0, self.idle_timeout / 4))
+            self.reap()
+
+CONNECTION_WARMER = ConnectionWarmer()
+
+def generate_image(api_key, model, prompt, resolution, span, output_dir=None, n=1, embed=False, on_preview=None,
+                   cancelled=None):
+    """Submit an async generation task for n images, poll it and save every output image.
+
+    Outputs are downloaded in parallel; with embed the metadata is stored inside the image
+    file instead of a sidecar. With on_preview, downloads are streamed and
+    on_preview(index, QImage, fraction) receives coarse previews while bytes arrive. Returns a list of (PIL image, file_path, metadata)
+    in output order (models that ignore n return a single image). Raises GenerationError
+    with the message shown to the user when the API reports a failure, or when the
+    cancelled() callback returns True between polls.
+    """
+    from PIL import Image # 延迟导入：首次生成时才加载 PIL，缩短启动时间
+    session = http_session()
+    output_dir = output_dir or OUTPUT_DIR
+    common_headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+    }
+    # 构建请求数据
+    data_payload = {
+        "model": model,
+        "prompt": prompt,
+        "size": resolution # Already parsed to format "1024x1024"
+    }
+    if n > 1:
+        data_payload["n"] = n
+
+    checkpoint = CONNECTION_STATS.checkpoint()
+    with span.phase("submit"):
+        response = session.post(
+            f"{API_BASE_URL}v1/images/generations",
+            headers={**common_headers, "X-ModelScope-Async-Mode": "true"},
+            data=json.dumps(data_payload, ensure_ascii=False).encode('utf-8')
+        )
+    span.mark("submitted")
+    # 提交请求是否复用了已预热的连接；新建连接时记录握手耗时
+    span.record.update(CONNECTION_STATS.since(checkpoint))
+
+    if response.status_code != 200:
+        raise GenerationError(f"API Error: {response.text}")
+
+    try:
+        task_id = response.json()["task_id"]
+    except KeyError:
+        raise GenerationError(f"API Error (No task_id): {response.text}")
+
+    poll_headers = {**common_headers, "X-ModelScope-Task-Type": "image_generation"}
+    if response.headers.get("Server", "").startswith(DAEMON_SERVER_VERSION.split("/")[0]):
+        # 本地守护进程 (--daemon) 支持长轮询：挂起请求直到任务结束；不向 ModelScope 发送私有请求头
+        poll_headers["X-ZImage-Wait"] = "30"
+
+    while True:
+        result = session.get(f"{API_BASE_URL}v1/tasks/{task_id}", headers=poll_headers)
+        span.record["polls"] += 1
+
+        if result.status_code != 200:
+            raise GenerationError(f"Task Status Error: {result.text}")
+
+        data = result.json()
+        status = data.get("task_status")
+        if status == "RUNNING" and "running" not in span.marks:
+            span.set("queue_wait_ms", span.since("submitted"))
+            span.mark("running")
+
+        if status == "SUCCEED":
+            # 未观察到 RUNNING 时，排队与生成时间无法拆分，整体计入生成时间
+            span.set("remote_gen_ms", span.since("running" if "running" in span.marks else "submitted"))
+            span.mark("succeeded")
+            break
+        elif status == "FAILED":
+            raise GenerationError("Image Generation Failed: " + str(data))
+
+        if cancelled is not None and cancelled():
+            raise GenerationError("已取消 (Cancelled)")
+        time.sleep(POLL_INTERVAL) # 轮询间隔
+
+    local_files = data.get("output_files") or []
+    if local_files and all(os.path.exists(p) for p in local_files):
+        # 本地守护进程已把图片保存到同一目录：直接使用，不再下载与保存
+        metadata_list = data.get("output_metadata") or [{} for _ in local_files]
+        span.set("images", len(local_files))
+        return [(None, path, {**metadata, "filename": os.path.basename(path), "file_path": path})
+                for path, metadata in zip(local_files, metadata_list)]
+
+    # 获取图片
+    if not data.get("output_images"):
+        raise GenerationError("No output image found in response.")
+    img_urls = data["output_images"]
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    group_id = uuid.uuid4().hex[:12] if len(img_urls) > 1 else None
+
+    def download(index, img_url):
+        """Stream one output, handing coarse previews of the partial file to on_preview."""
+        with session.get(img_url, stream=True) as img_response:
+            img_response.raise_for_status()
+            total = int(img_response.headers.get("Content-Length") or 0)
+            step = max(PREVIEW_MIN_BYTES, total // PREVIEW_STEPS)
+            buf = bytearray()
+            next_at, last = PREVIEW_MIN_BYTES, 0.0
+            for chunk in img_response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                buf += chunk
+                if len(buf) < next_at or len(buf) == total or time.perf_counter() - last < PREVIEW_INTERVAL:
+                    continue
+                preview = decode_preview(bytes(buf))
+                next_at, last = len(buf) + step, time.perf_counter()
+                if preview is not None:
+                    if "first_preview_ms" not in span.record:
+                        span.set("first_preview_ms", span.since("succeeded"))
+                    on_preview(index, preview, len(buf) / total if total else 0.0)
+            return bytes(buf)
+
+    def fetch(index, img_url):
+        timings = {}
+        t = time.perf_counter()
+        if on_preview is not None:
+            image_data = download(index, img_url)
+        else:
+            img_response = session.get(img_url)
+            img_response.raise_for_status()
+            image_data = img_response.content
+        timings["download_ms"] = (time.perf_counter() - t) * 1000
+
+        t = time.perf_counter()
+        image = Image.open(BytesIO(image_data))
+        image.load()
+        timings["decode_ms"] = (time.perf_counter() - t) * 1000
+
+        # 保存图片：直接存储下载的原始字节 (不重新编码)，按内容哈希命名，不会互相覆盖
+        t = time.perf_counter()
+        ext = FORMAT_EXTS.get(image.format)
+        if ext is None:
+            buf = BytesIO()
+            image.convert("RGB").save(buf, format="JPEG", quality=95)
+            image_data, ext = buf.getvalue(), ".jpg"
+        # 易读的文件名记录在元数据与 index.jsonl 中 (同一任务的多张图片以 _序号 区分)
+        name = f"img_{timestamp}_{index + 1}{ext}" if group_id else f"img_{timestamp}{ext}"
+        metadata = {
+            "name": name,
+            "prompt": prompt,
+            "model": model,
+            "resolution": resolution,
+            "timestamp": timestamp
+        }
+        if group_id:
+            metadata.update({"group_id": group_id, "group_index": index, "group_size": len(img_urls)})
+        file_path, deduped = store_image(image_data, ext, metadata, output_dir, embed=embed)
+        metadata = {**metadata, "filename": os.path.basename(file_path), "file_path": file_path, "deduped": deduped}
+        timings["save_ms"] = (time.perf_counter() - t) * 1000
+        return image, file_path, metadata, len(image_data), timings
+
+    if len(img_urls) == 1:
+        fetched = [fetch(0, img_urls[0])]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(len(img_urls), 4)) as pool:
+            fetched = list(pool.map(fetch, range(len(img_urls)), img_urls))
+
+    # 并行下载时 download_ms 取最慢的一张（近似墙钟时间），解码与保存累计
+    span.set("download_ms", round(max(f[4]["download_ms"] for f in fetched), 1))
+    span.set("decode_ms", round(sum(f[4]["decode_ms"] for f in fetched), 1))
+    span.set("save_ms", round(sum(f[4]["save_ms"] for f in fetched), 1))
+    span.set("download_bytes", sum(f[3] for f in fetched))
+    span.set("images", len(fetched))
+    return [(image, file_path, metadata) for image, file_path, metadata, _, _ in fetched]
+
+def key_fingerprint(api_key):
+    """Short digest of a credential: requests can be grouped by key without keeping the key itself."""
+    import hashlib
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+class GenerationCoordinator:
+    """Deduplicates identical generation requests (same credential, model, prompt, resolution and n).
+
+    Concurrent identical requests share one remote task: the first caller runs it, later
+    callers wait on its Future. Requests are only shared within one API key, so a caller
+    never receives (or fails with) a task submitted under someone else's credential. With cache_ttl > 0 (config.json: result_cache_ttl_minutes)
+    an exact repeat within the TTL is served from an existing history image instead.
+    run() returns (outputs, source) with source "remote", "coalesced" or "cached"; cached
+    outputs carry None instead of a PIL image. Download previews reach only the caller
+    that runs the remote task.
+    """
+    MAX_PER_KEY = 16
+
+    def __init__(self, cache_ttl=0):
+        self.cache_ttl = cache_ttl
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.recent = {} # (key fingerprint, model, prompt, resolution) -> [(time, path, metadata)], newest first
+
+    @staticmethod
+    def key(api_key, model, prompt, resolution):
+        return (key_fingerprint(api_key), model, prompt.strip(), resolution)
+
+    def remember(self, model, prompt, resolution, path, metadata, when=None, api_key=""):
+        """Record a finished image (generated with api_key) so exact repeats can be served from cache."""
+        entry = (when or time.time(), path, metadata)
+        with self.lock:
+            entries = self.recent.setdefault(self.key(api_key, model, prompt, resolution), [])
+            entries.append(entry)
+            entries.sort(key=lambda e: e[0], reverse=True)
+            del entries[self.MAX_PER_KEY:]
+
+    def lookup(self, key, n):
+        if self.cache_ttl <= 0:
+            return None
+        cutoff = time.time() - self.cache_ttl
+        entries = [e for e in self.recent.get(key, []) if e[0] >= cutoff and os.path.exists(e[1])]
+        if len(entries) < n:
+            return None
+        return [(None, path, {**metadata, "cached_at": when}) for when, path, metadata in entries[:n]]
+
+    def run(self, api_key, model, prompt, resolution, span, n=1, embed=False, output_dir=None, on_preview=None,
+            cancelled=None):
+        key = self.key(api_key, model, prompt, resolution)
+        with self.lock:
+            cached = self.lookup(key, n)
+            if cached is not None:
+                return cached, "cached"
+            future = self.inflight.get((key, n))
+            owner = future is None
+            if owner:
+                from concurrent.futures import Future
+                future = Future()
+                self.inflight[(key, n)] = future
+        if not owner:
+            # 相同的请求正在进行：等待它的结果，不再提交新任务
+            return future.result(), "coalesced"
+        try:
+            outputs = generate_image(api_key, model, prompt, resolution, span, output_dir=output_dir, n=n, embed=embed,
+                                     on_preview=on_preview, cancelled=cancelled)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop((key, n), None)
+        future.set_result(outputs)
+        now = time.time()
+        for _, file_path, metadata in outputs:
+            self.remember(model, prompt, resolution, file_path, metadata, now, api_key=api_key)
+        return outputs, "remote"
+
+GENERATION_COORDINATOR = GenerationCoordinator()
+
+SSE_DONE = "[DONE]"
+
+def parse_sse_line(raw):
+    """Parse one raw SSE line: returns the JSON payload, SSE_DONE, or None for lines to skip."""
+    if not raw:
+        return None
+    try:
+        line = raw.decode('utf-8', errors='replace').strip()
+    except Exception:
+        return None
+    if not line.startswith("data:"):
+        return None
+    data_str = line[len("data:"):].strip()
+    if data_str == SSE_DONE:
+        return SSE_DONE
+    try:
+        return json.loads(data_str)
+    except ValueError:
+        return None
+
+def stream_chat_completion(api_key, model, messages, stats, on_delta, on_live=None, cancelled=None):
+    """Stream a chat completion, calling on_delta for each content piece. Returns the full text.
+
+    Raises ChatError when the cancelled() callback returns True between chunks.
+    """
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+    }
+    payload = {"model": model, "messages": messages, "stream": True}
+    session = http_session()
+    checkpoint = CONNECTION_STATS.checkpoint()
+    resp = session.post(
+        f"{API_BASE_URL}v1/chat/completions",
+        headers=headers,
+        data=json.dumps(payload, ensure_ascii=False).encode('utf-8'),
+        stream=True
+    )
+    stats.on_connected(CONNECTION_STATS.since(checkpoint))
+    if resp.status_code != 200:
+        raise ChatError(f"API Error: {resp.text}")
+    acc = ""
+    resp.encoding = 'utf-8'
+    with resp: # 提前结束时也把连接归还连接池
+        for raw in resp.iter_lines(decode_unicode=False):
+            if cancelled is not None and cancelled():
+                raise ChatError("已取消 (Cancelled)")
+            obj = parse_sse_line(raw)
+            if obj is None:
+                continue
+            if obj is SSE_DONE:
+                break
+            try:
+                if obj.get("usage"):
+                    stats.usage = obj["usage"]
+                delta = (obj.get("choices") or [{}])[0].get("delta", {}).get("content", "")
+            except Exception:
+                continue
+            if delta:
+                stats.on_token()
+                acc += delta
+                on_delta(delta)
+                if on_live is not None and stats.live_due():
+                    on_live(stats.snapshot())
+    return acc
+
+def request_chat_completion(api_key, model, messages, stats):
+    """Non-streaming chat completion. Returns the assistant text."""
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+    }
+    payload = {"model": model, "messages": messages, "stream": False}
+    session = http_session()
+    checkpoint = CONNECTION_STATS.checkpoint()
+    resp = session.post(
+        f"{API_BASE_URL}v1/chat/completions",
+        headers=headers,
+        data=json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    )
+    stats.on_connected(CONNECTION_STATS.since(checkpoint))
+    if resp.status_code != 200:
+        raise ChatError(f"API Error: {resp.text}")
+    data = resp.json()
+    try:
+        content = data["choices"][0]["message"]["content"]
+    except Exception:
+        raise ChatError(f"Invalid Response: {data}")
+    stats.usage = data.get("usage")
+    return content
+
+# --- Local daemon (--daemon) ---
+# 一个本机进程统一持有连接池、任务队列、限流与元数据索引；界面 (config.json: daemon_url)、
+# 脚本 (ZIMAGE_API_BASE) 与其他工具都通过兼容 ModelScope / OpenAI 的 HTTP 接口使用它。
+DAEMON_HOST = "127.0.0.1"
+DAEMON_PORT = 8765
+DAEMON_JOB_TTL = 3600 # 已结束的任务保留 1 小时供查询
+DAEMON_SERVER_VERSION = "ZImageDaemon/1.0" # 响应的 Server 头，客户端据此启用长轮询
+
+def is_loopback_host(host):
+    """True when host only accepts connections from this machine (127.0.0.1, ::1, localhost)."""
+    import ipaddress
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+class TokenBucket:
+    """Blocking token-bucket rate limiter: `rate` tokens per minute, bursts up to `burst`."""
+
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Take one token, sleeping until one is available. Returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate if self.rate > 0 else 1.0
+            time.sleep(delay)
+            waited += delay
+
+    def available(self):
+        with self.lock:
+            self.refill()
+            return round(self.tokens, 2)
+
+class GenerationDaemon:
+    """Job queue and shared state behind the daemon's HTTP API.
+
+    Image jobs run on a fixed worker pool through GENERATION_COORDINATOR, so identical
+    requests from different clients are coalesced. Every upstream request that costs
+    quota (task submit, chat completion) first takes a token from the shared bucket.
+    """
+
+    def __init__(self, config, base_url, workers=2):
+        from concurrent.futures import ThreadPoolExecutor
+        self.config = config
+        self.default_api_key = config.get("api_key", "")
+        # 未带密钥的请求能否使用 config.json 中的密钥：只对本机监听开放 (run_daemon 设置)，
+        # 或者请求携带 daemon_token
+        self.share_default_key = False
+        self.token = config.get("daemon_token", "")
+        self.embed = bool(config.get("embed_metadata", False))
+        rate = float(config.get("daemon_rate_per_minute", 30))
+        self.bucket = TokenBucket(rate, max(1, int(config.get("daemon_burst", 5))))
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="daemon-job")
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.jobs = {} # task_id -> job dict
+        self.owners = {} # task_id -> key_fingerprint of the submitting key (not part of the public job)
+        self.completed = 0
+        self.failed = 0
+        # 图片链接的前缀：daemon_public_url，否则取请求的 Host 头 (监听 0.0.0.0 时 base_url 不可用)
+        self.base_url = base_url
+        self.public_url = config.get("daemon_public_url", "").rstrip("/")
+
+    def submit(self, api_key, model, prompt, size, n=1):
+        task_id = uuid.uuid4().hex
+        job = {"task_id": task_id, "task_status": "PENDING", "model": model, "prompt": prompt, "size": size,
+               "n": n, "created": time.time()}
+        with self.lock:
+            self.prune()
+            self.jobs[task_id] = job
+            self.owners[task_id] = key_fingerprint(api_key)
+        self.executor.submit(self.run_job, job, api_key)
+        return job
+
+    def set_status(self, job, **fields):
+        with self.changed:
+            job.update(fields)
+            self.changed.notify_all()
+
+    def run_job(self, job, api_key):
+        span = GenerationSpan(job["model"], job["size"])
+        # 先取得令牌再标记 RUNNING：限流等待属于排队时间，不能计入生成时间
+        span.set("rate_wait_ms", round(self.bucket.acquire() * 1000, 1))
+        self.set_status(job, task_status="RUNNING")
+        try:
+            outputs, source = GENERATION_COORDINATOR.run(api_key, job["model"], job["prompt"], job["size"], span,
+                                                         n=job["n"], embed=self.embed)
+        except Exception as e:
+            span.finish("error", e)
+            with self.lock:
+                self.failed += 1
+            self.set_status(job, task_status="FAILED", errors={"message": str(e)}, finished=time.time())
+            return
+        span.set("source", source)
+        span.finish("ok")
+        paths = [file_path for _, file_path, _ in outputs]
+        SIMILARITY_INDEX.submit(paths)
+        with self.lock:
+            self.completed += 1
+        self.set_status(job, task_status="SUCCEED", source=source, finished=time.time(), output_files=paths,
+                        output_metadata=[{k: v for k, v in metadata.items() if k in EMBEDDED_FIELDS}
+                                         for _, _, metadata in outputs])
+
+    def file_url(self, path, base_url=None):
+        rel = os.path.relpath(path, OUTPUT_DIR).replace(os.sep, "/")
+        return f"{self.public_url or base_url or self.base_url}/files/{rel}"
+
+    def public_job(self, job, base_url=None):
+        """The job as returned to clients, with output_images pointing at base_url (the request's host)."""
+        if "output_files" in job:
+            job = {**job, "output_images": [self.file_url(p, base_url) for p in job["output_files"]]}
+        return job
+
+    def wait(self, task_id, timeout):
+        """The job, once it has finished or `timeout` seconds have passed (long polling)."""
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            job = self.jobs.get(task_id)
+            while job is not None and job["task_status"] not in ("SUCCEED", "FAILED"):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.changed.wait(remaining)
+            return dict(job) if job is not None else None
+
+    def prune(self):
+        cutoff = time.time() - DAEMON_JOB_TTL
+        for task_id in [t for t, j in self.jobs.items() if j.get("finished", time.time()) < cutoff]:
+            del self.jobs[task_id]
+            self.owners.pop(task_id, None)
+
+    def owns(self, task_id, api_key):
+        """Whether api_key submitted task_id (unknown tasks count as not owned)."""
+        with self.lock:
+            return self.owners.get(task_id) == key_fingerprint(api_key)
+
+    def status(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job["task_status"]] = counts.get(job["task_status"], 0) + 1
+            return {"workers": self.workers, "jobs": counts, "completed": self.completed, "failed": self.failed,
+                    "rate_tokens": self.bucket.available(), "indexed_images": len(SIMILARITY_INDEX.hashes)}
+
+def make_daemon_handler(daemon):
+    from http.server import BaseHTTPRequestHandler
+
+    class DaemonHandler(BaseHTTPRequestHandler):
+        server_version = DAEMON_SERVER_VERSION
+
+        def log_message(self, format, *args):
+            pass # 逐条请求日志太多；错误单独打印
+
+        def api_key(self):
+            """ModelScope key for this request, or "" when the caller may not use the daemon's own key."""
+            auth = self.headers.get("Authorization", "")
+            key = auth[len("Bearer "):].strip() if auth.startswith("Bearer ") else ""
+            if daemon.token and key == daemon.token:
+                return daemon.default_api_key
+            if key:
+                return key
+            return daemon.default_api_key if daemon.share_default_key else ""
+
+        def request_base_url(self):
+            host = self.headers.get("Host")
+            return f"http://{host}" if host else None
+
+        def cross_site(self):
+            """True for requests a web page could have sent on the user's behalf.
+
+            A foreign Origin is a cross-site request. While the daemon shares its key with
+            loopback callers, the Host must also name a loopback address, which defeats
+            DNS rebinding (a foreign name that resolves to 127.0.0.1).
+            """
+            from urllib.parse import urlsplit
+            host = self.headers.get("Host", "")
+            origin = self.headers.get("Origin")
+            if origin and urlsplit(origin).netloc != host:
+                return True
+            return daemon.share_default_key and not is_loopback_host(urlsplit(f"//{host}").hostname or "")
+
+        def read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                return json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                return None
+
+        def send_json(self, status, obj):
+            body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_error_json(self, status, message):
+            self.send_json(status, {"error": {"message": message}})
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if self.cross_site():
+                self.send_error_json(403, "cross-site requests are not allowed")
+                return
+            # 对局域网开放时，查询任务与读取图片同样需要密钥；任务只对提交它的密钥可见
+            api_key = self.api_key()
+            if not daemon.share_default_key and not api_key:
+                self.send_error_json(401, "Authorization: Bearer <ModelScope key or daemon_token> is required")
+                return
+            if path.startswith("/v1/tasks/"):
+                try:
+                    wait = max(0.0, min(float(self.headers.get("X-ZImage-Wait") or 0), 60))
+                except ValueError:
+                    self.send_error_json(400, "X-ZImage-Wait must be a number of seconds")
+                    return
+                task_id = path[len("/v1/tasks/"):]
+                owned = daemon.share_default_key or daemon.owns(task_id, api_key)
+                job = daemon.wait(task_id, wait) if owned else None
+                if job is None:
+                    self.send_error_json(404, "task not found")
+                else:
+                    self.send_json(200, daemon.public_job(job, self.request_base_url()))
+            elif path.startswith("/files/"):
+                self.send_file(path[len("/files/"):])
+            elif path in ("/", "/v1/status"):
+                self.send_json(200, daemon.status())
+            else:
+                self.send_error_json(404, "not found")
+
+        def send_file(self, rel):
+            """Serve one stored image; index.jsonl, sidecars and other files under OUTPUT_DIR stay private."""
+            from urllib.parse import unquote
+            root = os.path.realpath(os.path.join(OUTPUT_DIR, STORE_DIRNAME))
+            full = os.path.realpath(os.path.join(OUTPUT_DIR, unquote(rel)))
+            if (not full.startswith(root + os.sep) or not full.lower().endswith(IMAGE_EXTS)
+                    or not os.path.isfile(full)):
+                self.send_error_json(404, "file not found")
+                return
+            with open(full, "rb") as f:
+                data = f.read()
+            ext = os.path.splitext(full)[1].lower()
+            self.send_response(200)
+            self.send_header("Content-Type", {".png": "image/png", ".webp": "image/webp"}.get(ext, "image/jpeg"))
+            self.send_header("X-Content-Type-Options", "nosniff")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            path = self.path.split("?", 1)[0]
+            # 网页可以不经预检直接提交 text/plain 表单：只接受 JSON，并拒绝来自其他站点的请求，
+            # 以免浏览器中打开的任意页面借本机密钥生成
+            if self.cross_site():
+                self.send_error_json(403, "cross-site requests are not allowed")
+                return
+            if not self.headers.get("Content-Type", "").lower().startswith("application/json"):
+                self.send_error_json(415, "Content-Type must be application/json")
+                return
+            body = self.read_json()
+            api_key = self.api_key()
+            if body is None:
+                self.send_error_json(400, "invalid JSON body")
+            elif path not in ("/v1/images/generations", "/v1/chat/completions"):
+                self.send_error_json(404, "not found")
+            elif not api_key:
+                self.send_error_json(401, "Authorization: Bearer <ModelScope key or daemon_token> is required")
+            elif path == "/v1/images/generations":
+                self.images(body, api_key)
+            else:
+                self.chat(body, api_key)
+
+        def images(self, body, api_key):
+            if not body.get("model") or not body.get("prompt"):
+                self.send_error_json(400, "model and prompt are required")
+                return
+            try:
+                n = max(1, min(int(body.get("n") or 1), 4))
+            except (TypeError, ValueError):
+                self.send_error_json(400, "n must be an integer")
+                return
+            job = daemon.submit(api_key, body["model"], body["prompt"], body.get("size", "1024x1024"), n)
+            if self.headers.get("X-ModelScope-Async-Mode", "").lower() == "true":
+                # ModelScope 兼容：返回 task_id，由客户端轮询 /v1/tasks/<id>
+                self.send_json(200, {"task_id": job["task_id"], "request_id": job["task_id"]})
+                return
+            # OpenAI 兼容：同步等待结果
+            job = daemon.public_job(daemon.wait(job["task_id"], 3600), self.request_base_url())
+            if job["task_status"] != "SUCCEED":
+                self.send_error_json(502, job.get("errors", {}).get("message", "generation failed"))
+                return
+            data = []
+            for url, path in zip(job["output_images"], job["output_files"]):
+                item = {"url": url, "path": path}
+                if body.get("response_format") == "b64_json":
+                    import base64
+                    with open(path, "rb") as f:
+                        item["b64_json"] = base64.b64encode(f.read()).decode("ascii")
+                data.append(item)
+            self.send_json(200, {"created": int(job["created"]), "data": data, "source": job.get("source")})
+
+        def chat(self, body, api_key):
+            daemon.bucket.acquire()
+            try:
+                resp = http_session().post(
+                    f"{API_BASE_URL}v1/chat/completions",
+                    headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+                    data=json.dumps(body, ensure_ascii=False).encode("utf-8"),
+                    stream=bool(body.get("stream")),
+                )
+            except Exception as e:
+                self.send_error_json(502, f"upstream error: {e}")
+                return
+            with resp:
+                self.send_response(resp.status_code)
+                self.send_header("Content-Type", resp.headers.get("Content-Type", "application/json"))
+                if not body.get("stream"):
+                    self.send_header("Content-Length", str(len(resp.content)))
+                    self.end_headers()
+                    self.wfile.write(resp.content)
+                    return
+                # 流式：收到多少转发多少 (HTTP/1.0，写完即关闭连接)
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                try:
+                    for chunk in resp.iter_content(chunk_size=None):
+                        self.wfile.write(chunk)
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass # 客户端已断开
+
+    return DaemonHandler
+
+def load_config_file():
+    try:
+        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def run_daemon(host=DAEMON_HOST, port=DAEMON_PORT):
+    """--daemon: serve the local HTTP API until interrupted. Upstream is ZIMAGE_UPSTREAM or ModelScope."""
+    from http.server import ThreadingHTTPServer
+    set_api_base(os.environ.get("ZIMAGE_UPSTREAM", "https://api-inference.modelscope.cn/"))
+    config = load_config_file()
+    CONNECTION_WARMER.idle_timeout = float(config.get("connection_idle_timeout", CONNECTION_IDLE_TIMEOUT))
+    if config.get("connection_warmup", True):
+        CONNECTION_WARMER.warm("daemon")
+    GENERATION_COORDINATOR.cache_ttl = float(config.get("result_cache_ttl_minutes", 0)) * 60
+    daemon = GenerationDaemon(config, f"http://{host}:{port}", workers=int(config.get("daemon_workers", 2)))
+    daemon.share_default_key = is_loopback_host(host)
+    if not daemon.share_default_key and not daemon.token:
+        print(f"Listening on {host}: requests must carry their own ModelScope key "
+              f"(set daemon_token in config.json to let trusted clients use the configured one)")
+    server = ThreadingHTTPServer((host, port), make_daemon_handler(daemon))
+    server.daemon_threads = True
+    # 后台补齐已有图片的感知哈希索引
+    threading.Thread(target=lambda: SIMILARITY_INDEX.submit(
+        [os.path.join(OUTPUT_DIR, name) for name in snapshot_output_dir(OUTPUT_DIR) if name.lower().endswith(IMAGE_EXTS)]),
+        daemon=True).start()
+    print(f"ZImage daemon listening on http://{host}:{port} (upstream {API_BASE_URL}, "
+          f"{daemon.workers} workers, {daemon.bucket.rate * 60:.0f} requests/min)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.executor.shutdown(wait=False, cancel_futures=True)
+
+# --- Worker Thread ---
+# 运行中的生成 / 对话线程：对话框或标签页关闭后仍在这里保留引用直到结束 (运行中的 QThread 不能被销毁)，
+# 退出时统一请求中断并等待
+_live_workers = set()
+_live_workers_lock = threading.Lock()
+
+def track_worker(thread):
+    with _live_workers_lock:
+        _live_workers.difference_update([t for t in _live_workers if t.isFinished()])
+        _live_workers.add(thread)
+
+def stop_workers():
+    """Ask every generation / chat worker to stop early and wait for it (on application exit)."""
+    with _live_workers_lock:
+        workers = list(_live_workers)
+        _live_workers.clear()
+    for thread in workers:
+        thread.requestInterruption()
+    for thread in workers:
+        thread.wait()
+
+class ImageGeneratorThread(QThread):
+    finished = Signal(list) # Emits [(thumbnail QImage, file_path, metadata), ...] for every output image
+    error = Signal(str)
+    preview = Signal(int, QImage, float) # output index, coarse thumbnail, downloaded fraction (0 = unknown)
+
+    def __init__(self, api_key, model, prompt, resolution, count=1, embed_metadata=False, progressive=False,
+                 thumbnail_size=THUMBNAIL_SIZE):
+        super().__init__()
+        self.api_key = api_key
+        self.model = model
+        self.prompt = prompt
+        self.resolution = resolution
+        self.count = count
+        self.embed_metadata = embed_metadata
+        self.progressive = progressive # 下载时逐步发出预览 (preview 信号)
+        self.thumbnail_size = thumbnail_size # 对比窗口使用更大的预览，同样在线程中缩放
+        self.span = GenerationSpan(model, resolution)
+        self.source = "remote" # remote / coalesced (与进行中的相同请求合并) / cached (历史结果)
+        track_worker(self)
+
+    def fail(self, msg):
+        self.span.finish("error", msg)
+        self.error.emit(msg)
+
+    def run(self):
+        try:
+            outputs, self.source = GENERATION_COORDINATOR.run(
+                self.api_key, self.model, self.prompt, self.resolution, self.span, n=self.count,
+                embed=self.embed_metadata, on_preview=self.preview.emit if self.progressive else None,
+                cancelled=self.isInterruptionRequested)
+        except Exception as e:
+            self.fail(str(e))
+            return
+        self.span.set("source", self.source)
+        # 只把缩略图交给界面线程，完整图片随线程结束释放，需要时再从磁盘读取
+        results = []
+        with self.span.phase("thumbnail"):
+            for image, file_path, metadata in outputs:
+                if image is not None:
+                    thumbnail = make_thumbnail(image, self.thumbnail_size)
+                elif self.thumbnail_size == THUMBNAIL_SIZE:
+                    thumbnail = read_thumbnail(file_path)
+                else:
+                    thumbnail = read_qimage(file_path, self.thumbnail_size)
+                results.append((thumbnail, file_path, metadata))
+        del outputs
+        self.span.mark("emitted")
+        self.finished.emit(results)
+
+class ChatThread(QThread):
+    finished = Signal(str)
+    error = Signal(str)
+    delta = Signal(str)
+    metrics = Signal(dict) # live 读数 (live=True) 与最终记录 (live=False)
+
+    def __init__(self, api_key, model, messages, stream=True):
+        super().__init__()
+        self.api_key = api_key
+        self.model = model
+        self.messages = messages
+        self.stream = stream
+        self.stats = ChatStreamStats(model)
+        track_worker(self)
+
+    def fail(self, msg):
+        record = self.stats.to_record("error", msg)
+        record_chat_metrics(record)
+        self.metrics.emit({**record, "live": False})
+        self.error.emit(msg)
+
+    def complete(self, text):
+        record = self.stats.to_record("ok")
+        record_chat_metrics(record)
+        self.metrics.emit({**record, "live": False})
+        self.finished.emit(text)
+
+    def run(self):
+        try:
+            if self.stream:
+                text = stream_chat_completion(self.api_key, self.model, self.messages, self.stats,
+                                              self.delta.emit, self.metrics.emit, self.isInterruptionRequested)
+            else:
+                text = request_chat_completion(self.api_key, self.model, self.messages, self.stats)
+        except Exception as e:
+            self.fail(str(e))
+            return
+        self.complete(text)
+
+class OutputDiffThread(QThread):
+    finished = Signal(dict, list, list, list) # new snapshot, added records (newest first), removed paths, changed records
+
+    def __init__(self, output_dir, old_snapshot, migrate=False):
+        super().__init__()
+        self.output_dir = output_dir
+        self.old_snapshot = old_snapshot
+        self.migrate = migrate
+
+    def run(self):
+        if self.migrate:
+            # 首次扫描前把旧版平铺的图片迁入分片存储
+            migrated = migrate_flat_store(self.output_dir)
+            if migrated:
+                print(f"Migrated {migrated} images into {os.path.join(self.output_dir, STORE_DIRNAME)}")
+        new = snapshot_output_dir(self.output_dir)
+        added, removed, changed = diff_output_snapshots(self.old_snapshot, new)
+        added.sort(key=lambda n: new[n][0], reverse=True)
+        join = lambda n: os.path.join(self.output_dir, n)
+        added_records = [read_history_record(join(n), new[n][0], sidecar_path(n) in new) for n in added]
+        changed_records = [read_history_record(join(n), new[n][0], sidecar_path(n) in new) for n in changed]
+        self.finished.emit(new, added_records, [join(n) for n in removed], changed_records)
+
+class DuplicateScanThread(QThread):
+    finished = Signal(list) # near-duplicate groups (lists of paths), largest first
+
+    def __init__(self, max_distance):
+        super().__init__()
+        self.max_distance = max_distance
+
+    def run(self):
+        self.finished.emit(SIMILARITY_INDEX.duplicate_groups(self.max_distance))
+
+class RetentionThread(QThread):
+    """Applies the retention policy off the GUI thread; the gallery follows through OutputDirWatcher."""
+    finished = Signal(dict) # plan statistics plus removed / failed counts
+
+    def __init__(self, output_dir, policy, favorites):
+        super().__init__()
+        self.output_dir = output_dir
+        self.policy = policy
+        self.favorites = favorites
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        t_start = time.perf_counter()
+        victims, stats = plan_retention(self.output_dir, snapshot_output_dir(self.output_dir), self.favorites,
+                                        self.policy)
+        stats.update({"ts": datetime.datetime.now().isoformat(timespec="seconds"), "action": self.policy["action"],
+                      "dry_run": self.policy["dry_run"], "removed": 0, "failed": 0})
+        if not self.policy["dry_run"]:
+            links = store_links(self.output_dir) if victims else {}
+            retired = {}
+            for i, rel in enumerate(victims):
+                if self.stopped:
+                    break
+                try:
+                    retired[rel] = retire_image(self.output_dir, rel, self.policy["action"], links)
+                    stats["removed"] += 1
+                except OSError as e:
+                    stats["failed"] += 1
+                    log_error(f"Error retiring {rel}: {e}")
+                if i % 20 == 19:
+                    time.sleep(0.05) # 分批让出磁盘，避免大量删除时拖慢界面读图
+            # index.jsonl 中删除已清理对象的记录、归档对象改指向 archive/，避免索引无限增长
+            try:
+                stats["index_dropped"] = rewrite_store_index(self.output_dir, retired)
+            except OSError as e:
+                log_error(f"Error rewriting {STORE_INDEX_NAME}: {e}")
+        stats["ms"] = round((time.perf_counter() - t_start) * 1000, 1)
+        write_metrics(RETENTION_LOG, stats)
+        self.finished.emit(stats)
+
+class ExportThread(QThread):
+    progress = Signal(int, int, float) # done, total, bytes written
+    finished = Signal(dict)
+    error = Signal(str)
+
+    def __init__(self, records, dest, fmt):
+        super().__init__()
+        self.records = records
+        self.dest = dest
+        self.fmt = fmt
+        self.cancelled = False
+        self.last_emit = 0.0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def on_progress(self, done, total, written):
+        # 限制信号频率：数万张小图时逐张发射会淹没界面线程
+        now = time.monotonic()
+        if now - self.last_emit >= 0.1 or done == total:
+            self.last_emit = now
+            self.progress.emit(done, total, float(written))
+
+    def run(self):
+        t_start = time.perf_counter()
+        try:
+            result = export_archive(self.records, self.dest, self.fmt, self.on_progress, lambda: self.cancelled)
+        except Exception as e:
+            self.error.emit(str(e))
+            return
+        result["seconds"] = time.perf_counter() - t_start
+        self.finished.emit(result)
+
+class OutputDirWatcher(QObject):
+    """Watches OUTPUT_DIR and reports added / removed / changed images (debounced, diffed off the GUI thread).
+
+    The first pass migrates legacy flat files and diffs against an empty snapshot, so it
+    doubles as the startup history scan. The objects/ dir and every shard are watched too.
+    Falls back to polling when the platform watcher cannot watch the directory.
+    """
+    changes = Signal(list, list, list, bool) # added records, removed paths, changed records, initial
+    DEBOUNCE_MS = 300
+    MAX_DELAY_MS = 2000
+    POLL_MS = 5000
+
+    def __init__(self, directory, parent=None):
+        super().__init__(parent)
+        from PySide6.QtCore import QFileSystemWatcher
+        self.directory = directory
+        self.snapshot = {}
+        self.initial = True
+        self.thread = None
+        self.rescan_requested = False
+        self.first_event = None
+        self.debounce = QTimer(self)
+        self.debounce.setSingleShot(True)
+        self.debounce.timeout.connect(self.rescan)
+        self.poll = QTimer(self)
+        self.poll.timeout.connect(self.rescan)
+        self.fs = QFileSystemWatcher(self)
+        self.fs.directoryChanged.connect(self.on_directory_changed)
+
+    def start(self):
+        store = os.path.join(self.directory, STORE_DIRNAME)
+        os.makedirs(store, exist_ok=True)
+        if not self.fs.addPath(self.directory) or not self.fs.addPath(store):
+            self.poll.start(self.POLL_MS)
+        self.rescan()
+
+    def watch_shards(self):
+        # 新建的分片目录会触发 objects/ 的变化，扫描后再把它加入监视
+        watched = set(self.fs.directories())
+        missing = [d for d in store_shards(self.directory) if d not in watched]
+        if missing:
+            failed = self.fs.addPaths(missing)
+            if failed and not self.poll.isActive():
+                self.poll.start(self.POLL_MS)
+
+    def on_directory_changed(self, _path):
+        now = time.monotonic()
+        if self.first_event is None:
+            self.first_event = now
+        # 持续有文件写入时最多推迟 MAX_DELAY_MS 再扫描，避免批量写入期间一直不刷新
+        if (now - self.first_event) * 1000 >= self.MAX_DELAY_MS:
+            self.debounce.start(0)
+        else:
+            self.debounce.start(self.DEBOUNCE_MS)
+
+    def rescan(self):
+        self.first_event = None
+        if self.thread is not None and self.thread.isRunning():
+            self.rescan_requested = True
+            return
+        self.thread = OutputDiffThread(self.directory, dict(self.snapshot), migrate=self.initial)
+        self.thread.finished.connect(self.on_diff_finished)
+        self.thread.start()
+
+    def on_diff_finished(self, snapshot, added, removed, changed):
+        self.snapshot = snapshot
+        self.watch_shards()
+        initial, self.initial = self.initial, False
+        if added or removed or changed or initial:
+            self.changes.emit(added, removed, changed, initial)
+        if self.rescan_requested:
+            self.rescan_requested = False
+            self.rescan()
+
+class AvatarDownloadThread(QThread):
+    finished = Signal(bool)
+
+    def run(self):
+        try:
+            import requests
+            r = requests.get(USER_AVATAR_URL, timeout=10)
+            if r.status_code == 200:
+                tmp_path = USER_AVATAR_PATH + ".part"
+                with open(tmp_path, "wb") as f:
+                    f.write(r.content)
+                os.replace(tmp_path, USER_AVATAR_PATH)
+                self.finished.emit(True)
+                return
+        except Exception:
+            pass
+        self.finished.emit(False)
+
+def fallback_avatar(size=36):
+    """Built-in silhouette avatar used until (or instead of) the downloaded user avatar."""
+    pm = QPixmap(size, size)
+    pm.fill(Qt.transparent)
+    painter = QPainter(pm)
+    painter.setRenderHint(QPainter.Antialiasing)
+    clip = QPainterPath()
+    clip.addEllipse(0, 0, size, size)
+    painter.setClipPath(clip)
+    painter.fillRect(0, 0, size, size, QColor("#b9c5d1"))
+    painter.setPen(Qt.NoPen)
+    painter.setBrush(QColor("#ffffff"))
+    painter.drawEllipse(int(size * 0.33), int(size * 0.18), int(size * 0.34), int(size * 0.34))
+    painter.drawEllipse(int(size * 0.16), int(size * 0.58), int(size * 0.68), int(size * 0.6))
+    painter.end()
+    return pm
+
+# --- Image Card (Thumbnail) ---
+class ThumbnailView(QWidget):
+    """Paints the cached thumbnail for `path`; holds no pixels of its own."""
+
+    def __init__(self, path, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.failed = False
+        self.setFixedSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        clip = QPainterPath()
+        clip.addRoundedRect(self.rect(), 4, 4)
+        painter.fillPath(clip, QColor("#eeeeee"))
+        # 解码失败后不再反复排队，避免 加载->重绘->加载 循环；下载中的占位预览没有对应文件
+        if self.failed or self.path.startswith(PREVIEW_PATH_PREFIX):
+            image = IMAGE_CACHE.get(self.path, "thumb")
+        else:
+            image = IMAGE_CACHE.request(self.path, "thumb")
+        if image is not None and not image.isNull():
+            size = image.size().scaled(self.size(), Qt.KeepAspectRatio)
+            target = QRect(QPoint((self.width() - size.width()) // 2, (self.height() - size.height()) // 2), size)
+            painter.drawImage(target, image)
+        elif self.failed:
+            painter.setPen(QColor("#333333"))
+            painter.drawText(self.rect(), Qt.AlignCenter, "Error")
+        painter.end()
+
+class ImageCard(QFrame):
+    clicked = Signal(str, str, str, str) # file_path, prompt, model, resolution
+    select_requested = Signal(str, bool) # file_path, extend (Shift 范围选择；Ctrl 为单张切换)
+
+    @profiled_slot("ImageCard.__init__")
+    def __init__(self, file_path, prompt, model, resolution, thumbnail=None, name=None):
+        """
+        thumbnail: optional ready-made QImage (freshly generated images); otherwise loaded lazily from file_path
+        name: display name (stored images are named by content hash on disk)
+        """
+        super().__init__()
+        self.file_path = file_path
+        self.prompt = prompt
+        self.model = model
+        self.resolution = resolution
+        if thumbnail is not None:
+            IMAGE_CACHE.put(file_path, "thumb", thumbnail)
+        
+        self.setFixedSize(220, 260)
+        self.setCursor(Qt.PointingHandCursor)
+        self.setStyleSheet("""
+            ImageCard {
+                background-color: #ffffff;
+                border-radius: 8px;
+                border: 1px solid #e0e0e0;
+            }
+            ImageCard:hover {
+                border: 2px solid #3498db;
+                background-color: #f0f8ff;
+            }
+            ImageCard[selected="true"] {
+                border: 3px solid #e67e22;
+                background-color: #fff5e6;
+            }
+            QLabel {
+                color: #333;
+                border: none;
+            }
+        """)
+        self.setProperty("selected", False)
+        
+        layout = QVBoxLayout()
+        layout.setContentsMargins(10, 10, 10, 10)
+        layout.setSpacing(5)
+        
+        # 图片显示 (缩略图，绘制时从缓存读取)
+        self.image_view = ThumbnailView(file_path)
+        layout.addWidget(self.image_view)
+        
+        # 信息显示 (文件名)
+        filename = name or os.path.basename(file_path)
+        name_label = QLabel(filename)
+        name_label.setStyleSheet("font-size: 11px; color: #666;")
+        name_label.setAlignment(Qt.AlignCenter)
+        name_label.setWordWrap(False) # 单行显示
+        
+        # 截断过长的文件名
+        font_metrics = name_label.fontMetrics()
+        elided_text = font_metrics.elidedText(filename, Qt.ElideMiddle, 190)
+        name_label.setText(elided_text)
+        
+        layout.addWidget(name_label)
+        self.setLayout(layout)
+
+    def on_image_loaded(self):
+        self.image_view.failed = IMAGE_CACHE.get(self.file_path, "thumb") is None
+        self.image_view.update()
+
+    def update_record(self, record, image_changed=False):
+        """Apply metadata (and optionally pixels) changed on disk by another process."""
+        self.prompt = record["prompt"]
+        self.model = record["model"]
+        self.resolution = record["resolution"]
+        if image_changed:
+            IMAGE_CACHE.invalidate(self.file_path)
+            self.image_view.failed = False
+            self.image_view.update()
+
+    def set_selected(self, selected):
+        if self.property("selected") != selected:
+            self.setProperty("selected", selected)
+            self.style().unpolish(self)
+            self.style().polish(self)
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            modifiers = event.modifiers()
+            if modifiers & (Qt.ControlModifier | Qt.ShiftModifier):
+                self.select_requested.emit(self.file_path, bool(modifiers & Qt.ShiftModifier))
+            else:
+                self.clicked.emit(self.file_path, self.prompt, self.model, self.resolution)
+
+# --- Chat sessions (多会话对话) ---
+CHAT_RENDER_INTERVAL_MS = 50 # 当前标签页合并渲染增量的间隔
+
+class ChatSession(QWidget):
+    """One chat tab: its own message list, model, bubbles and streaming worker.
+
+    Deltas are only appended to a buffer; the assistant bubble is re-rendered on a short
+    timer while the tab is visible, and once when a background tab is shown again, so
+    several sessions can stream at once without repainting hidden ones.
+    """
+    state_changed = Signal(object) # self：开始、结束、出错或有新的实时读数时发出
+
+    def __init__(self, title, avatar_pixmap, parent=None):
+        super().__init__(parent)
+        self.title = title
+        self.avatar_pixmap = avatar_pixmap
+        self.messages = [{"role": "system", "content": SYSTEM_PROMPT_CN}]
+        self.model = None
+        self.thread = None # 保留最近一个线程的引用，直到下一次发送
+        self.streaming = False
+        self.unread = False
+        self.assistant_label = None
+        self.assistant_text = ""
+        self.dirty = False
+        self.readout = ""
+        self.live_readout = ""
+        self.error = None
+
+        self.render_timer = QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.setInterval(CHAT_RENDER_INTERVAL_MS)
+        self.render_timer.timeout.connect(self.render)
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.scroll_area = QScrollArea()
+        self.scroll_area.setWidgetResizable(True)
+        self.scroll_area.setStyleSheet("background-color: transparent; border: none;")
+        container = QWidget()
+        container.setStyleSheet("background-color: transparent;")
+        self.messages_layout = QVBoxLayout(container)
+        self.messages_layout.setContentsMargins(10, 10, 10, 10)
+        self.messages_layout.setSpacing(10)
+        self.scroll_area.setWidget(container)
+        layout.addWidget(self.scroll_area)
+
+    def tab_text(self):
+        if self.streaming:
+            return f"⋯ {self.title}"
+        return f"● {self.title}" if self.unread else self.title
+
+    def scroll_to_bottom(self):
+        bar = self.scroll_area.verticalScrollBar()
+        bar.setValue(bar.maximum())
+
+    def add_message(self, author, text):
+        is_assistant = (author == "助手")
+        row = QWidget()
+        row_layout = QHBoxLayout(row)
+        row_layout.setContentsMargins(10, 6, 10, 6)
+        row_layout.setSpacing(8)
+
+        avatar_label = QLabel()
+        avatar_label.setFixedSize(36, 36)
+        pm = self.avatar_pixmap(is_assistant)
+        if not pm.isNull():
+            avatar_label.setPixmap(pm)
+        avatar_label.setStyleSheet("border-radius:18px; background:#dfe7ef;")
+
+        bubble = QFrame()
+        bubble.setFrameShape(QFrame.NoFrame)
+        bubble.setLineWidth(0)
+        max_w = int(self.scroll_area.viewport().width() * 0.6)
+        bubble_layout = QHBoxLayout(bubble)
+        bubble_layout.setContentsMargins(14, 10, 14, 10)
+        bubble_layout.setSpacing(8)
+
+        body = QLabel()
+        body.setWordWrap(True)
+        body.setTextFormat(Qt.RichText)
+        body.setOpenExternalLinks(True)
+        body.setText(render_markdown(text))
+        body.setStyleSheet("background: transparent; margin:0; padding:0;")
+        fm = body.fontMetrics()
+        calc_w = fm.horizontalAdvance(text) + 40
+        bubble_w = min(max_w, max(240, calc_w))
+        if is_assistant and (text is None or text == ""):
+            bubble_w = max_w
+        bubble.setFixedWidth(bubble_w)
+        bubble.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Minimum)
+
+        shadow = QGraphicsDropShadowEffect()
+        shadow.setBlurRadius(8)
+        shadow.setOffset(0, 2)
+        shadow.setColor(QColor(0, 0, 0, 30))
+        bubble.setGraphicsEffect(shadow)
+
+        if is_assistant:
+            bubble.setStyleSheet("QFrame{background:#f1f3f6; border:1px solid #e1e5ea; border-radius:12px;} QLabel{color:#2c3e50; font-size:14px; background: transparent; border: none;}")
+            row_layout.setAlignment(Qt.AlignLeft)
+            row_layout.addWidget(avatar_label)
+            row_layout.setAlignment(avatar_label, Qt.AlignTop)
+            row_layout.addWidget(bubble)
+            row_layout.setAlignment(bubble, Qt.AlignTop)
         else:
-            super().keyPressEvent(event)
+            bubble.setStyleSheet("QFrame{background:#4e8df5; border:1px solid #4e8df5; border-radius:12px;} QLabel{color:#ffffff; font-size:14px;}")
+            row_layout.setAlignment(Qt.AlignRight)
+            row_layout.addWidget(bubble)
+            row_layout.setAlignment(bubble, Qt.AlignTop)
+            row_layout.addWidget(avatar_label)
+            row_layout.setAlignment(avatar_label, Qt.AlignTop)
 
-# --- Worker Thread ---
-class ImageGeneratorThread(QThread):
-    finished = Signal(object, str, dict) # Emits PIL Image, file_path, metadata
-    error = Signal(str)
+        bubble_layout.addWidget(body)
+        self.messages_layout.addWidget(row)
+        self.scroll_to_bottom()
+        return body
+
+    def send(self, api_key, model, content):
+        self.model = model
+        self.error = None
+        self.messages.append({"role": "user", "content": content})
+        self.add_message("用户", content)
+        self.assistant_label = self.add_message("助手", "")
+        self.assistant_text = ""
+        self.dirty = False
+        self.readout = self.live_readout = ""
+        self.streaming = True
+        self.thread = ChatThread(api_key, model, list(self.messages), stream=True)
+        self.thread.delta.connect(self.on_delta)
+        self.thread.metrics.connect(self.on_metrics)
+        self.thread.finished.connect(self.on_finished)
+        self.thread.error.connect(self.on_error)
+        self.thread.start()
+        self.state_changed.emit(self)
+
+    def on_delta(self, delta_text):
+        self.assistant_text += delta_text
+        self.dirty = True
+        # 隐藏的标签页只缓存增量，切换回来时在 showEvent 中一次渲染
+        if self.isVisible() and not self.render_timer.isActive():
+            self.render_timer.start()
+
+    @profiled_slot()
+    def render(self):
+        if self.dirty and self.assistant_label is not None:
+            self.assistant_label.setText(render_markdown(self.assistant_text))
+            self.scroll_to_bottom()
+        self.dirty = False
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.unread = False
+        if self.dirty:
+            self.render()
 
-    def __init__(self, api_key, model, prompt, resolution):
+    def on_metrics(self, m):
+        parts = []
+        if m.get("ttft_ms") is not None:
+            parts.append(f"首字 (TTFT) {m['ttft_ms'] / 1000:.2f}s")
+        if m.get("tokens_per_sec"):
+            parts.append(f"{m['tokens_per_sec']:.1f} tok/s")
+        if not m.get("live") and m.get("completion_tokens"):
+            parts.append(f"{m['completion_tokens']} tokens")
+        self.readout = " · ".join(parts)
+        if m.get("live") and self.readout:
+            self.live_readout = self.readout
+            self.state_changed.emit(self)
+
+    def on_finished(self, assistant_text):
+        self.messages.append({"role": "assistant", "content": assistant_text})
+        self.assistant_text = assistant_text
+        self.dirty = True
+        self.render_timer.stop()
+        self.render()
+        self.assistant_label = None
+        self.finish()
+
+    def on_error(self, msg):
+        self.error = msg
+        self.render_timer.stop()
+        if self.assistant_label is not None:
+            self.assistant_label.setText(render_markdown(self.assistant_text + f"\n\n请求失败 (Error): {msg}"))
+            self.assistant_label = None
+        self.dirty = False
+        self.finish()
+
+    def finish(self):
+        self.streaming = False
+        self.unread = not self.isVisible()
+        self.state_changed.emit(self)
+
+# --- Compare Dialog (多模型对比) ---
+COMPARE_IMAGE_SIZE = 356 # 对比列宽 380 减去边距
+
+class CompareColumn(QFrame):
+    """One model's result column: header, latency readout and the streamed / generated output."""
+
+    def __init__(self, model, is_image):
         super().__init__()
-        self.api_key = api_key
         self.model = model
+        self.is_image = is_image
+        self.t0 = None
+        self.elapsed = None
+        self.text = ""
+        self.metrics = {}
+        self.setFixedWidth(380)
+        self.setStyleSheet("CompareColumn { background-color: #ffffff; border: 1px solid #e0e0e0; border-radius: 8px; }")
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(10, 10, 10, 10)
+        layout.setSpacing(6)
+
+        title = QLabel(model)
+        title.setStyleSheet("font-weight: bold; color: #2c3e50;")
+        title.setWordWrap(True)
+        layout.addWidget(title)
+
+        self.latency_label = QLabel("等待中... (Waiting...)")
+        self.latency_label.setStyleSheet("color: #7f8c8d;")
+        self.latency_label.setWordWrap(True)
+        layout.addWidget(self.latency_label)
+
+        if is_image:
+            self.images_layout = QVBoxLayout()
+            self.images_layout.setSpacing(6)
+            layout.addLayout(self.images_layout)
+            layout.addStretch()
+        else:
+            self.browser = QTextBrowser()
+            self.browser.setOpenExternalLinks(True)
+            self.browser.setStyleSheet("background-color: #f7f9fc; border: none; color: #333;")
+            layout.addWidget(self.browser, 1)
+
+    def start(self):
+        self.t0 = time.perf_counter()
+        self.elapsed = None
+        self.text = ""
+        if self.is_image:
+            while self.images_layout.count():
+                widget = self.images_layout.takeAt(0).widget()
+                if widget is not None:
+                    widget.deleteLater()
+        else:
+            self.browser.clear()
+
+    def tick(self):
+        if self.t0 is not None and self.elapsed is None:
+            self.latency_label.setText(f"运行中... (Running) {time.perf_counter() - self.t0:.1f}s")
+
+    def finish(self, detail=""):
+        self.elapsed = time.perf_counter() - self.t0
+        text = f"耗时 (Latency) {self.elapsed:.1f}s"
+        self.latency_label.setText(f"{text} · {detail}" if detail else text)
+        self.latency_label.setStyleSheet("color: #27ae60;")
+
+    def fail(self, msg):
+        self.elapsed = time.perf_counter() - self.t0
+        self.latency_label.setText(f"失败 (Failed) {self.elapsed:.1f}s")
+        self.latency_label.setStyleSheet("color: #c0392b;")
+        self.latency_label.setToolTip(msg)
+        if not self.is_image:
+            self.browser.setPlainText(msg)
+
+    def add_images(self, results):
+        # 预览已由生成线程缩放到 COMPARE_IMAGE_SIZE，界面线程不再解码原图
+        for thumbnail, file_path, metadata in results:
+            label = QLabel()
+            label.setAlignment(Qt.AlignCenter)
+            label.setToolTip(file_path)
+            label.setPixmap(QPixmap.fromImage(thumbnail))
+            self.images_layout.addWidget(label)
+
+    def append_text(self, delta):
+        self.text += delta
+
+    def render(self):
+        self.browser.setHtml(render_markdown(self.text))
+
+class CompareDialog(QDialog):
+    """Runs one prompt against several models at once and shows the results side by side."""
+
+    def __init__(self, api_key, is_image, models, prompt, resolution=None, count=1, embed_metadata=False, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("多模型对比 (Compare Models)")
+        self.resize(1200, 760)
+        self.api_key = api_key
+        self.is_image = is_image
         self.prompt = prompt
         self.resolution = resolution
+        self.count = count
+        self.embed_metadata = embed_metadata
+        self.threads = {}
+        self.columns = {}
+        self.dirty = set() # 有新内容待渲染的对话列
+        self.t0 = None
+
+        layout = QVBoxLayout(self)
+
+        prompt_label = QLabel(f"<b>提示词 (Prompt):</b> {html_lib.escape(prompt)}")
+        prompt_label.setWordWrap(True)
+        layout.addWidget(prompt_label)
+
+        select_row = QHBoxLayout()
+        self.checks = {}
+        for model in models:
+            check = QCheckBox(model)
+            check.setChecked(True)
+            self.checks[model] = check
+            select_row.addWidget(check)
+        select_row.addStretch()
+        self.run_btn = QPushButton("开始对比 (Run)")
+        self.run_btn.clicked.connect(self.run)
+        select_row.addWidget(self.run_btn)
+        layout.addLayout(select_row)
+
+        self.summary_label = QLabel("")
+        self.summary_label.setStyleSheet("color: #7f8c8d;")
+        layout.addWidget(self.summary_label)
+
+        scroll = QScrollArea()
+        scroll.setWidgetResizable(True)
+        container = QWidget()
+        self.columns_layout = QHBoxLayout(container)
+        self.columns_layout.setAlignment(Qt.AlignLeft)
+        scroll.setWidget(container)
+        layout.addWidget(scroll, 1)
+
+        self.ticker = QTimer(self)
+        self.ticker.setInterval(100)
+        self.ticker.timeout.connect(self.on_tick)
+
+        self.run()
 
     def run(self):
-        base_url = 'https://api-inference.modelscope.cn/'
-        common_headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
+        models = [m for m, check in self.checks.items() if check.isChecked()]
+        if not models:
+            return
+        while self.columns_layout.count():
+            widget = self.columns_layout.takeAt(0).widget()
+            if widget is not None:
+                widget.deleteLater()
+        self.columns = {}
+        self.threads = {}
+        self.run_btn.setEnabled(False)
+        self.t0 = time.perf_counter()
+        # 所有模型同时发出请求：总耗时取决于最慢的模型，而不是各模型耗时之和
+        for model in models:
+            column = CompareColumn(model, self.is_image)
+            self.columns[model] = column
+            self.columns_layout.addWidget(column)
+            column.start()
+            if self.is_image:
+                thread = ImageGeneratorThread(self.api_key, model, self.prompt, self.resolution, self.count,
+                                              self.embed_metadata, thumbnail_size=COMPARE_IMAGE_SIZE)
+                thread.finished.connect(lambda results, m=model: self.on_image_finished(m, results))
+            else:
+                messages = [{"role": "system", "content": SYSTEM_PROMPT_CN}, {"role": "user", "content": self.prompt}]
+                thread = ChatThread(self.api_key, model, messages, stream=True)
+                thread.delta.connect(lambda delta, m=model: self.on_chat_delta(m, delta))
+                thread.metrics.connect(lambda metrics, m=model: self.on_chat_metrics(m, metrics))
+                thread.finished.connect(lambda text, m=model: self.on_chat_finished(m, text))
+            thread.error.connect(lambda msg, m=model: self.on_error(m, msg))
+            self.threads[model] = thread
+            thread.start()
+        self.ticker.start()
+        self.update_summary()
 
-        try:
-            # 构建请求数据
-            data_payload = {
-                "model": self.model,
-                "prompt": self.prompt,
-                "size": self.resolution # Already parsed to format "1024x1024"
-            }
+    def on_tick(self):
+        for model in self.dirty:
+            self.columns[model].render()
+        self.dirty.clear()
+        for column in self.columns.values():
+            column.tick()
 
-            response = requests.post(
-                f"{base_url}v1/images/generations",
-                headers={**common_headers, "X-ModelScope-Async-Mode": "true"},
-                data=json.dumps(data_payload, ensure_ascii=False).encode('utf-8')
-            )
-            
-            if response.status_code != 200:
-                self.error.emit(f"API Error: {response.text}")
-                return
+    def on_image_finished(self, model, results):
+        thread = self.threads[model]
+        column = self.columns[model]
+        column.add_images(results)
+        span = thread.span
+        span.set("time_to_card_ms", span.since(None))
+        span.finish("ok")
+        detail = f"{len(results)} 张 (images)" if len(results) > 1 else ""
+        column.finish(detail)
+        self.update_summary()
 
-            try:
-                task_id = response.json()["task_id"]
-            except KeyError:
-                 self.error.emit(f"API Error (No task_id): {response.text}")
-                 return
-            
-            while True:
-                result = requests.get(
-                    f"{base_url}v1/tasks/{task_id}",
-                    headers={**common_headers, "X-ModelScope-Task-Type": "image_generation"},
-                )
-                
-                if result.status_code != 200:
-                    self.error.emit(f"Task Status Error: {result.text}")
-                    return
+    def on_chat_delta(self, model, delta):
+        # 与主窗口一样，增量在定时器中合并渲染，避免每个 delta 都重新渲染 Markdown
+        self.columns[model].append_text(delta)
+        self.dirty.add(model)
 
-                data = result.json()
-
-                if data["task_status"] == "SUCCEED":
-                    # 获取图片
-                    if "output_images" in data and len(data["output_images"]) > 0:
-                        img_url = data["output_images"][0]
-                        img_response = requests.get(img_url)
-                        img_response.raise_for_status()
-                        
-                        image_data = img_response.content
-                        image = Image.open(BytesIO(image_data))
-                        
-                        # 保存图片
-                        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                        filename = f"img_{timestamp}.jpg"
-                        file_path = os.path.join(OUTPUT_DIR, filename)
-                        image.save(file_path)
-
-                        # 保存元数据 (JSON)
-                        metadata = {
-                            "filename": filename,
-                            "file_path": file_path,
-                            "prompt": self.prompt,
-                            "model": self.model,
-                            "resolution": self.resolution,
-                            "timestamp": timestamp
-                        }
-                        json_path = file_path.rsplit('.', 1)[0] + ".json"
-                        with open(json_path, "w", encoding="utf-8") as f:
-                            json.dump(metadata, f, ensure_ascii=False, indent=4)
-                        
-                        self.finished.emit(image, file_path, metadata)
-                    else:
-                        self.error.emit("No output image found in response.")
-                    break
-                elif data["task_status"] == "FAILED":
-                    self.error.emit("Image Generation Failed: " + str(data))
-                    break
-                
-                time.sleep(2) # 轮询间隔
+    def on_chat_metrics(self, model, metrics):
+        self.columns[model].metrics = metrics
+
+    def on_chat_finished(self, model, text):
+        column = self.columns[model]
+        column.text = text
+        column.render()
+        self.dirty.discard(model)
+        metrics = column.metrics
+        parts = []
+        if metrics.get("ttft_ms") is not None:
+            parts.append(f"首字 (TTFT) {metrics['ttft_ms'] / 1000:.2f}s")
+        if metrics.get("tokens_per_sec"):
+            parts.append(f"{metrics['tokens_per_sec']:.1f} tok/s")
+        column.finish(" · ".join(parts))
+        self.update_summary()
+
+    def on_error(self, model, msg):
+        self.columns[model].fail(msg)
+        self.update_summary()
+
+    def update_summary(self):
+        columns = list(self.columns.values())
+        done = [c for c in columns if c.elapsed is not None]
+        text = f"完成 (Done) {len(done)}/{len(columns)}"
+        if done:
+            fastest = min(done, key=lambda c: c.elapsed)
+            text += f" · 最快 (Fastest): {fastest.model} {fastest.elapsed:.1f}s"
+        if len(done) == len(columns):
+            wall = time.perf_counter() - self.t0
+            text += f" · 总耗时 (Wall) {wall:.1f}s，依次运行约需 (Sequential) {sum(c.elapsed for c in done):.1f}s"
+            self.ticker.stop()
+            self.on_tick()
+            self.run_btn.setEnabled(True)
+        self.summary_label.setText(text)
+
+    def done(self, result):
+        # 关闭对话框时仍在运行的请求继续完成（结果照常保存到画廊目录）：断开与对话框的信号，
+        # 线程由 track_worker 保留到结束，退出程序时由 stop_workers 等待
+        self.ticker.stop()
+        for thread in self.threads.values():
+            thread.blockSignals(True)
+        super().done(result)
+
+class DuplicatesDialog(QDialog):
+    """Near-duplicate report: groups of gallery images whose perceptual hashes are within max_distance."""
+    MAX_GROUPS_SHOWN = 100 # 只为前 100 组创建卡片，完整列表见 --duplicates
+
+    def __init__(self, records_by_path, max_distance=DUPLICATE_MAX_DISTANCE, parent=None):
+        super().__init__(parent)
+        self.records_by_path = records_by_path
+        self.max_distance = max_distance
+        self.cards = {} # path -> ImageCard
+        IMAGE_CACHE.loaded.connect(self.on_image_loaded)
+        self.setWindowTitle("相似重复图片 (Near Duplicates)")
+        self.resize(1000, 750)
+
+        layout = QVBoxLayout(self)
+        self.summary_label = QLabel("扫描中... (Scanning...)")
+        self.summary_label.setStyleSheet("color: #2c3e50; font-weight: bold; padding: 4px;")
+        layout.addWidget(self.summary_label)
+
+        scroll = QScrollArea()
+        scroll.setWidgetResizable(True)
+        self.groups_widget = QWidget()
+        self.groups_layout = QVBoxLayout(self.groups_widget)
+        self.groups_layout.setAlignment(Qt.AlignTop)
+        scroll.setWidget(self.groups_widget)
+        layout.addWidget(scroll)
+
+        self.t_start = time.perf_counter()
+        self.scan_thread = DuplicateScanThread(max_distance)
+        self.scan_thread.finished.connect(self.on_scanned)
+        self.scan_thread.start()
+
+    def record(self, path):
+        return self.records_by_path.get(path) or read_history_record(path)
+
+    def on_scanned(self, groups):
+        elapsed = time.perf_counter() - self.t_start
+        total = sum(len(g) for g in groups)
+        self.summary_label.setText(f"{len(groups)} 组, 共 {total} 张相似图片 ({len(groups)} groups, {total} images, "
+                                   f"distance ≤ {self.max_distance}) · {len(SIMILARITY_INDEX.hashes)} 张已索引 "
+                                   f"(indexed) · {elapsed:.1f}s")
+        for n, group in enumerate(groups[:self.MAX_GROUPS_SHOWN], 1):
+            title = QLabel(f"<b>组 (Group) {n}</b> · {len(group)} 张 (images)")
+            title.setStyleSheet("color: #2c3e50; margin-top: 8px;")
+            self.groups_layout.addWidget(title)
+            row = QWidget()
+            flow = FlowLayout(row)
+            records = [self.record(p) for p in group]
+            for record in records:
+                card = ImageCard(record["path"], record["prompt"], record["model"], record["resolution"],
+                                 name=record.get("name"))
+                card.clicked.connect(lambda path, *_, rs=records: self.show_group(rs, path))
+                self.cards[record["path"]] = card
+                flow.addWidget(card)
+            self.groups_layout.addWidget(row)
+
+    def on_image_loaded(self, path, kind):
+        card = self.cards.get(path)
+        if card is not None and kind == "thumb":
+            card.on_image_loaded()
+
+    def show_group(self, records, path):
+        index = next((i for i, r in enumerate(records) if r["path"] == path), 0)
+        DetailDialog(records, index, self).exec()
+
+    def done(self, result):
+        IMAGE_CACHE.loaded.disconnect(self.on_image_loaded)
+        super().done(result)
+
+class ExportDialog(QDialog):
+    """Export the selected, all, or filtered gallery images into a zip / tar archive with a manifest."""
+    SCOPE_SELECTED, SCOPE_ALL, SCOPE_FILTER = range(3)
+
+    def __init__(self, records, selected_paths, parent=None):
+        """records: every history record, newest first; selected_paths: paths selected in the gallery"""
+        super().__init__(parent)
+        self.records = records
+        self.selected_paths = selected_paths
+        self.export_thread = None
+        self.setWindowTitle("导出图片 (Export Images)")
+        self.setMinimumWidth(520)
+
+        layout = QVBoxLayout(self)
+        form = QFormLayout()
+
+        self.scope_combo = QComboBox()
+        self.scope_combo.addItems([f"所选图片 (Selected, {len(selected_paths)})", f"全部图片 (All, {len(records)})",
+                                   "按条件筛选 (Filter)"])
+        self.scope_combo.setCurrentIndex(self.SCOPE_SELECTED if selected_paths else self.SCOPE_ALL)
+        self.scope_combo.currentIndexChanged.connect(self.update_count)
+        form.addRow("范围 (Scope):", self.scope_combo)
+
+        self.model_filter = QComboBox()
+        self.model_filter.addItem("全部模型 (All Models)")
+        self.model_filter.addItems(sorted({r["model"] for r in records if r.get("model")}))
+        self.model_filter.currentIndexChanged.connect(self.update_count)
+        form.addRow("模型 (Model):", self.model_filter)
+
+        dates = [r["mtime"] for r in records if r.get("mtime")]
+        first = datetime.date.fromtimestamp(min(dates)) if dates else datetime.date.today()
+        self.date_from = QDateEdit(QDate(first.year, first.month, first.day))
+        self.date_to = QDateEdit(QDate.currentDate())
+        date_row = QHBoxLayout()
+        for edit in (self.date_from, self.date_to):
+            edit.setCalendarPopup(True)
+            edit.setDisplayFormat("yyyy-MM-dd")
+            edit.dateChanged.connect(self.update_count)
+            date_row.addWidget(edit)
+        form.addRow("日期 (Date):", date_row)
+
+        self.query_input = QLineEdit()
+        self.query_input.setPlaceholderText("提示词或文件名包含... (Prompt or name contains...)")
+        self.query_input.textChanged.connect(self.update_count)
+        form.addRow("搜索 (Search):", self.query_input)
+
+        self.format_combo = QComboBox()
+        self.format_combo.addItems(["ZIP (.zip)", "TAR (.tar)"])
+        form.addRow("格式 (Format):", self.format_combo)
+        layout.addLayout(form)
+
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setValue(0)
+        layout.addWidget(self.progress_bar)
+        self.status_label = QLabel()
+        self.status_label.setStyleSheet("color: #7f8c8d;")
+        layout.addWidget(self.status_label)
+
+        buttons = QHBoxLayout()
+        buttons.addStretch()
+        self.export_btn = QPushButton("导出 (Export)")
+        self.export_btn.clicked.connect(self.start_export)
+        buttons.addWidget(self.export_btn)
+        self.cancel_btn = QPushButton("取消导出 (Cancel)")
+        self.cancel_btn.setEnabled(False)
+        self.cancel_btn.clicked.connect(self.cancel_export)
+        buttons.addWidget(self.cancel_btn)
+        close_btn = QPushButton("关闭 (Close)")
+        close_btn.clicked.connect(self.close)
+        buttons.addWidget(close_btn)
+        layout.addLayout(buttons)
+        self.update_count()
+
+    def chosen_records(self):
+        scope = self.scope_combo.currentIndex()
+        if scope == self.SCOPE_SELECTED:
+            return [r for r in self.records if r["path"] in self.selected_paths]
+        if scope == self.SCOPE_ALL:
+            return list(self.records)
+        start = datetime.datetime.combine(self.date_from.date().toPython(), datetime.time()).timestamp()
+        end = datetime.datetime.combine(self.date_to.date().toPython(), datetime.time()).timestamp() + 86400
+        model = self.model_filter.currentText() if self.model_filter.currentIndex() > 0 else None
+        return filter_records(self.records, model, start, end, self.query_input.text())
 
-        except Exception as e:
-            self.error.emit(str(e))
+    def update_count(self):
+        is_filter = self.scope_combo.currentIndex() == self.SCOPE_FILTER
+        for widget in (self.model_filter, self.date_from, self.date_to, self.query_input):
+            widget.setEnabled(is_filter)
+        self.status_label.setText(f"将导出 {len(self.chosen_records())} 张图片 (images to export)")
 
-class ChatThread(QThread):
-    finished = Signal(str)
-    error = Signal(str)
-    delta = Signal(str)
+    def start_export(self):
+        records = self.chosen_records()
+        if not records:
+            QMessageBox.warning(self, "警告 (Warning)", "没有可导出的图片 (No images to export).")
+            return
+        fmt = "zip" if self.format_combo.currentIndex() == 0 else "tar"
+        default = os.path.join(os.path.expanduser("~"),
+                               f"zimage_export_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}")
+        dest, _ = QFileDialog.getSaveFileName(self, "导出到 (Export To)", default, f"{fmt.upper()} (*.{fmt})")
+        if not dest:
+            return
+        self.progress_bar.setRange(0, len(records))
+        self.progress_bar.setValue(0)
+        self.export_btn.setEnabled(False)
+        self.cancel_btn.setEnabled(True)
+        self.export_thread = ExportThread(records, dest, fmt)
+        self.export_thread.progress.connect(self.on_progress)
+        self.export_thread.finished.connect(self.on_finished)
+        self.export_thread.error.connect(self.on_error)
+        self.export_thread.start()
 
-    def __init__(self, api_key, model, messages, stream=True):
-        super().__init__()
-        self.api_key = api_key
-        self.model = model
-        self.messages = messages
-        self.stream = stream
+    def cancel_export(self):
+        if self.export_thread is not None:
+            self.export_thread.cancel()
+            self.cancel_btn.setEnabled(False)
 
-    def run(self):
-        try:
-            base_url = 'https://api-inference.modelscope.cn/'
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-            }
-            payload = {
-                "model": self.model,
-                "messages": self.messages,
-                "stream": bool(self.stream)
-            }
-            if self.stream:
-                resp = requests.post(
-                    f"{base_url}v1/chat/completions",
-                    headers=headers,
-                    data=json.dumps(payload, ensure_ascii=False).encode('utf-8'),
-                    stream=True
-                )
-                if resp.status_code != 200:
-                    self.error.emit(f"API Error: {resp.text}")
-                    return
-                acc = ""
-                resp.encoding = 'utf-8'
-                for raw in resp.iter_lines(decode_unicode=False):
-                    if not raw:
-                        continue
-                    try:
-                        line = raw.decode('utf-8', errors='replace').strip()
-                    except Exception:
-                        continue
-                    if line.startswith("data:"):
-                        data_str = line[len("data:"):].strip()
-                        if data_str == "[DONE]":
-                            break
-                        try:
-                            obj = json.loads(data_str)
-                            delta = obj.get("choices", [{}])[0].get("delta", {}).get("content", "")
-                            if delta:
-                                acc += delta
-                                self.delta.emit(delta)
-                        except Exception:
-                            continue
-                self.finished.emit(acc)
-            else:
-                resp = requests.post(
-                    f"{base_url}v1/chat/completions",
-                    headers=headers,
-                    data=json.dumps(payload, ensure_ascii=False).encode('utf-8')
-                )
-                if resp.status_code != 200:
-                    self.error.emit(f"API Error: {resp.text}")
-                    return
-                data = resp.json()
-                try:
-                    content = data["choices"][0]["message"]["content"]
-                except Exception:
-                    self.error.emit(f"Invalid Response: {data}")
-                    return
-                self.finished.emit(content)
-        except Exception as e:
-            self.error.emit(str(e))
-# --- Image Card (Thumbnail) ---
-class ImageCard(QFrame):
-    clicked = Signal(object, str, str, str, str) # image_source, file_path, prompt, model, resolution
+    def on_progress(self, done, total, written):
+        self.progress_bar.setValue(done)
+        self.status_label.setText(f"{done} / {total} · {written / 1e6:.1f} MB")
 
-    def __init__(self, image_source, file_path, prompt, model, resolution):
-        """
-        image_source: Can be PIL Image or file path string
-        """
-        super().__init__()
-        self.image_source = image_source
-        self.file_path = file_path
-        self.prompt = prompt
-        self.model = model
-        self.resolution = resolution
-        
-        self.setFixedSize(220, 260)
-        self.setCursor(Qt.PointingHandCursor)
-        self.setStyleSheet("""
-            ImageCard {
-                background-color: #ffffff;
-                border-radius: 8px;
-                border: 1px solid #e0e0e0;
-            }
-            ImageCard:hover {
-                border: 2px solid #3498db;
-                background-color: #f0f8ff;
-            }
-            QLabel {
-                color: #333;
-                border: none;
-            }
-        """)
-        
-        layout = QVBoxLayout()
-        layout.setContentsMargins(10, 10, 10, 10)
-        layout.setSpacing(5)
-        
-        # 图片显示 (缩略图)
-        self.image_label = QLabel()
-        self.image_label.setFixedSize(200, 200)
-        self.image_label.setStyleSheet("background-color: #eee; border-radius: 4px;")
-        self.image_label.setAlignment(Qt.AlignCenter)
-        
-        # Load and Scale Image
-        pixmap = QPixmap()
-        if isinstance(image_source, str): # File Path
-             if os.path.exists(image_source):
-                 pixmap.load(image_source)
-        else: # PIL Image
-            if image_source.mode != "RGB":
-                image_source = image_source.convert("RGB")
-            data = image_source.tobytes("raw", "RGB")
-            qimage = QImage(data, image_source.width, image_source.height, QImage.Format_RGB888)
-            pixmap = QPixmap.fromImage(qimage)
-            
-        if not pixmap.isNull():
-             scaled_pixmap = pixmap.scaled(QSize(200, 200), Qt.KeepAspectRatio, Qt.SmoothTransformation)
-             self.image_label.setPixmap(scaled_pixmap)
-        else:
-             self.image_label.setText("Error")
-        
-        layout.addWidget(self.image_label)
-        
-        # 信息显示 (文件名)
-        filename = os.path.basename(file_path)
-        name_label = QLabel(filename)
-        name_label.setStyleSheet("font-size: 11px; color: #666;")
-        name_label.setAlignment(Qt.AlignCenter)
-        name_label.setWordWrap(False) # 单行显示
-        
-        # 截断过长的文件名
-        font_metrics = name_label.fontMetrics()
-        elided_text = font_metrics.elidedText(filename, Qt.ElideMiddle, 190)
-        name_label.setText(elided_text)
-        
-        layout.addWidget(name_label)
-        self.setLayout(layout)
+    def on_finished(self, result):
+        self.export_btn.setEnabled(True)
+        self.cancel_btn.setEnabled(False)
+        if result["cancelled"]:
+            self.status_label.setText("已取消 (Cancelled)")
+            return
+        speed = result["bytes"] / 1e6 / result["seconds"] if result["seconds"] else 0
+        missing = f", {result['missing']} 张文件缺失 (missing)" if result["missing"] else ""
+        self.status_label.setText(f"导出完成 (Done): {result['images']} 张, {result['bytes'] / 1e6:.1f} MB, "
+                                  f"{speed:.0f} MB/s{missing}")
 
-    def mousePressEvent(self, event):
-        if event.button() == Qt.LeftButton:
-            self.clicked.emit(self.image_source, self.file_path, self.prompt, self.model, self.resolution)
+    def on_error(self, message):
+        self.export_btn.setEnabled(True)
+        self.cancel_btn.setEnabled(False)
+        self.status_label.setText("导出失败 (Export Failed)")
+        QMessageBox.critical(self, "错误 (Error)", message)
+
+    def done(self, result):
+        if self.export_thread is not None and self.export_thread.isRunning():
+            self.export_thread.cancel()
+            self.export_thread.wait()
+        super().done(result)
 
 class MainWindow(QWidget):
     def __init__(self):
@@ -601,12 +4808,57 @@ class MainWindow(QWidget):
         if os.path.exists(ICON_PATH):
             self.setWindowIcon(QIcon(ICON_PATH))
         self.resize(1300, 850)
-        self.chat_messages = []
+        self.avatar_cache = {}
+        self.chat_session_count = 0
+        self.closed_chat_sessions = set() # 关闭时仍在接收的会话，结束后再释放
+        self.generation_thread = None # 最近一次图片生成的线程
+        self.pending_history = [] # 待追加到画廊末尾的历史记录
+        self.pending_new = [] # 待插入到画廊顶部的新记录 (其他进程写入)
+        self.new_insert_pos = 0
+        self.cards_by_path = {}
+        self.selected_paths = set() # 画廊多选 (Ctrl / Shift + 单击)
+        self.selection_anchor = None
+        self.preview_cards = {} # 下载中的占位卡片：PREVIEW_PATH_PREFIX 键 -> ImageCard
+        IMAGE_CACHE.loaded.connect(self.on_image_loaded)
+        self.history_index = {} # path -> record (元数据索引)
+        self.gallery_index = GalleryIndex() # 画廊筛选的分面索引
+        self.gallery_filters = {facet: None for facet in GalleryIndex.FACETS}
+        self.day_headers = {} # 日期 -> 日期标题
+        self.gallery_refresh_timer = QTimer(self)
+        self.gallery_refresh_timer.setSingleShot(True)
+        self.gallery_refresh_timer.setInterval(100) # 合并连续的增删，计数与标题最多每 100ms 刷新一次
+        self.gallery_refresh_timer.timeout.connect(self.refresh_gallery_view)
+        self.first_paint_done = False
         self.apply_styles()
         self.init_ui()
         self.load_config() # Load config on startup
-        self.load_history() # Load history on startup
+        CONNECTION_WARMER.idle_timeout = float(self.config.get("connection_idle_timeout", CONNECTION_IDLE_TIMEOUT))
+        # 派生图片 (缩略图、预览、转码) 在进程池中生成，不占用界面与生成线程
+        self.pipeline = DerivativePipeline(self.config.get("derivatives", DEFAULT_DERIVATIVES), parent=self)
+        self.pipeline.progress.connect(self.on_pipeline_progress)
+        # 历史记录扫描与头像下载在首次绘制后于后台进行 (见 start_background_tasks)
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.first_paint_done:
+            self.first_paint_done = True
+            QTimer.singleShot(0, self.start_background_tasks)
+
+    def start_background_tasks(self):
+        """Disk and network side-tasks that must not delay the first frame."""
+        record_startup_time()
+        if "--startup-probe" in sys.argv:
+            # 打包产物的启动测速 (bench/bench_bundle.py)：记录后立即退出
+            QApplication.quit()
+            return
+        self.load_history()
         self.ensure_user_avatar()
+        self.warm_connection("startup")
+
+    def warm_connection(self, reason):
+        """Pre-open the API connection (startup, prompt box focus, typing) unless disabled in config.json."""
+        if self.config.get("connection_warmup", True):
+            CONNECTION_WARMER.warm(reason)
 
     def apply_styles(self):
         self.setStyleSheet("""
@@ -777,42 +5029,8 @@ class MainWindow(QWidget):
         
         # Resolution
         self.resolution_combo = QComboBox()
-        def ratio_cn(r):
-            return "方形" if r == "1:1" else ("横屏" if r in ("4:3","16:9","3:2","21:9") else "竖屏")
-        categories = [
-            ("标准 (Standard)", [
-                {"ratio": "1:1", "size": "512x512"},
-                {"ratio": "3:4", "size": "768x1024"},
-                {"ratio": "4:3", "size": "640x480"},
-                {"ratio": "16:9", "size": "640x360"},
-                {"ratio": "9:16", "size": "360x640"},
-                {"ratio": "3:2", "size": "720x480"},
-                {"ratio": "2:3", "size": "480x720"},
-                {"ratio": "21:9", "size": "840x360"},
-            ]),
-            ("高清 (HD)", [
-                {"ratio": "1:1", "size": "1024x1024"},
-                {"ratio": "3:4", "size": "1152x1536"},
-                {"ratio": "4:3", "size": "1280x960"},
-                {"ratio": "16:9", "size": "1600x900"},
-                {"ratio": "9:16", "size": "900x1600"},
-                {"ratio": "3:2", "size": "1536x1024"},
-                {"ratio": "2:3", "size": "1024x1536"},
-                {"ratio": "21:9", "size": "1680x720"},
-            ]),
-            ("超清 (Ultra)", [
-                {"ratio": "1:1", "size": "2048x2048"},
-                {"ratio": "3:4", "size": "1536x2048"},
-                {"ratio": "4:3", "size": "2048x1536"},
-                {"ratio": "16:9", "size": "2048x1152"},
-                {"ratio": "9:16", "size": "1152x2048"},
-                {"ratio": "3:2", "size": "2048x1365"},
-                {"ratio": "2:3", "size": "1365x2048"},
-                {"ratio": "21:9", "size": "2048x876"},
-            ]),
-        ]
         self.resolution_combo.clear()
-        for cat, items in categories:
+        for cat, items in RESOLUTION_CATEGORIES:
             self.resolution_combo.addItem(f"--- {cat} ---")
             self.resolution_combo.model().item(self.resolution_combo.count()-1).setEnabled(False)
             for it in items:
@@ -824,6 +5042,12 @@ class MainWindow(QWidget):
             self.resolution_combo.setCurrentIndex(default_index)
         self.res_label = QLabel("分辨率 (Resolution):")
         form_layout.addRow(self.res_label, self.resolution_combo)
+
+        # 每次任务生成的图片数量 (模型不支持时只返回一张)
+        self.count_combo = QComboBox()
+        self.count_combo.addItems(["1", "2", "3", "4"])
+        self.count_label = QLabel("数量 (Count):")
+        form_layout.addRow(self.count_label, self.count_combo)
         
         control_layout.addWidget(form_widget)
         
@@ -851,6 +5075,17 @@ class MainWindow(QWidget):
         self.prompt_input.setMinimumHeight(150)
         self.prompt_input.installEventFilter(self)
         control_layout.addWidget(self.prompt_input)
+
+        # 历史提示词自动补全：查询在后台线程完成，结果回到这里再弹出
+        self.prompt_completer = QCompleter(QStringListModel(self), self)
+        self.prompt_completer.setWidget(self.prompt_input)
+        self.prompt_completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.prompt_completer.setMaxVisibleItems(PROMPT_SUGGESTIONS)
+        self.prompt_completer.activated.connect(self.apply_prompt_suggestion)
+        self.prompt_completer.popup().installEventFilter(self)
+        self.applying_suggestion = False
+        self.prompt_input.textChanged.connect(self.on_prompt_text_changed)
+        PROMPT_HISTORY.suggestions.connect(self.on_prompt_suggestions)
         
         # Generate Button
         self.generate_btn = QPushButton("生成图像 (Generate Image)")
@@ -870,12 +5105,36 @@ class MainWindow(QWidget):
         """)
         self.generate_btn.clicked.connect(self.on_send_action)
         control_layout.addWidget(self.generate_btn)
+
+        # 多模型对比：同一提示词同时发送给多个模型
+        self.compare_btn = QPushButton("多模型对比 (Compare Models)")
+        self.compare_btn.setCursor(Qt.PointingHandCursor)
+        self.compare_btn.setMinimumHeight(36)
+        self.compare_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #ecf0f1;
+                color: #2c3e50;
+                border: 1px solid #bdc3c7;
+                border-radius: 8px;
+                font-size: 14px;
+            }
+            QPushButton:hover { background-color: #dfe6e9; }
+            QPushButton:pressed { background-color: #cfd8dc; }
+        """)
+        self.compare_btn.clicked.connect(self.open_compare_dialog)
+        control_layout.addWidget(self.compare_btn)
         
         # Status
         self.status_label = QLabel("就绪 (Ready)")
         self.status_label.setAlignment(Qt.AlignCenter)
         self.status_label.setStyleSheet("color: #7f8c8d; margin-top: 10px;")
         control_layout.addWidget(self.status_label)
+
+        self.pipeline_label = QLabel("")
+        self.pipeline_label.setAlignment(Qt.AlignCenter)
+        self.pipeline_label.setStyleSheet("color: #95a5a6; font-size: 11px;")
+        self.pipeline_label.hide()
+        control_layout.addWidget(self.pipeline_label)
         
         control_layout.addStretch()
         
@@ -887,7 +5146,60 @@ class MainWindow(QWidget):
         
         self.result_title = QLabel("生成记录 (Gallery)")
         self.result_title.setStyleSheet("font-size: 20px; font-weight: bold; color: #2c3e50; margin-bottom: 10px;")
-        result_layout.addWidget(self.result_title)
+        header_layout = QHBoxLayout()
+        header_layout.addWidget(self.result_title)
+        header_layout.addStretch()
+        # 按感知哈希查找近似重复的图片
+        self.duplicates_btn = QPushButton("查找相似重复 (Find Duplicates)")
+        self.duplicates_btn.setCursor(Qt.PointingHandCursor)
+        self.duplicates_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #ecf0f1;
+                color: #2c3e50;
+                border: 1px solid #bdc3c7;
+                border-radius: 6px;
+                padding: 4px 10px;
+            }
+            QPushButton:hover { background-color: #dfe6e9; }
+        """)
+        self.duplicates_btn.clicked.connect(self.open_duplicates_dialog)
+        header_layout.addWidget(self.duplicates_btn)
+        self.export_btn = QPushButton("导出 (Export)")
+        self.export_btn.setCursor(Qt.PointingHandCursor)
+        self.export_btn.setToolTip("Ctrl / Shift + 单击可多选图片 (Ctrl / Shift + click to select)")
+        self.export_btn.setStyleSheet(self.duplicates_btn.styleSheet())
+        self.export_btn.clicked.connect(self.open_export_dialog)
+        header_layout.addWidget(self.export_btn)
+        # Esc 清除画廊多选
+        clear_action = QAction(self)
+        clear_action.setShortcut(Qt.Key_Escape)
+        clear_action.triggered.connect(self.clear_selection)
+        self.addAction(clear_action)
+        result_layout.addLayout(header_layout)
+
+        # 画廊筛选：模型 / 分辨率档位 / 比例，选项后显示图片数量；可按日期分组
+        self.filter_bar = QWidget()
+        self.filter_bar.setStyleSheet("""
+            QWidget { border: none; background: transparent; }
+            QComboBox { background-color: #ffffff; border: 1px solid #bdc3c7; border-radius: 6px; padding: 2px 8px; }
+            QLabel { color: #7f8c8d; }
+        """)
+        filter_layout = QHBoxLayout(self.filter_bar)
+        filter_layout.setContentsMargins(0, 0, 0, 6)
+        self.facet_combos = {}
+        for facet in GalleryIndex.FACETS:
+            combo = QComboBox()
+            combo.setSizeAdjustPolicy(QComboBox.AdjustToContents)
+            combo.activated.connect(lambda _, f=facet: self.on_facet_changed(f))
+            self.facet_combos[facet] = combo
+            filter_layout.addWidget(combo)
+        self.group_by_date_check = QCheckBox("按日期分组 (Group by date)")
+        self.group_by_date_check.toggled.connect(self.on_group_by_date_toggled)
+        filter_layout.addWidget(self.group_by_date_check)
+        filter_layout.addStretch()
+        self.gallery_count_label = QLabel("")
+        filter_layout.addWidget(self.gallery_count_label)
+        result_layout.addWidget(self.filter_bar)
         
         # 滚动区域
         self.scroll_area = QScrollArea()
@@ -899,22 +5211,27 @@ class MainWindow(QWidget):
         
         # 使用 FlowLayout
         self.gallery_layout = FlowLayout(self.gallery_container, margin=10, hSpacing=15, vSpacing=15)
+        self.gallery_layout.order_key = self.gallery_sort_key
         
         self.scroll_area.setWidget(self.gallery_container)
         result_layout.addWidget(self.scroll_area)
 
-        # 对话滚动区域
-        self.chat_scroll_area = QScrollArea()
-        self.chat_scroll_area.setWidgetResizable(True)
-        self.chat_scroll_area.setStyleSheet("background-color: transparent; border: none;")
-        self.chat_container = QWidget()
-        self.chat_container.setStyleSheet("background-color: transparent;")
-        self.chat_layout = QVBoxLayout(self.chat_container)
-        self.chat_layout.setContentsMargins(10, 10, 10, 10)
-        self.chat_layout.setSpacing(10)
-        self.chat_scroll_area.setWidget(self.chat_container)
-        result_layout.addWidget(self.chat_scroll_area)
-        self.chat_scroll_area.hide()
+        # 对话标签页：每个会话有独立的消息列表、模型与接收线程，可同时接收
+        self.chat_tabs = QTabWidget()
+        self.chat_tabs.setDocumentMode(True)
+        self.chat_tabs.setTabsClosable(True)
+        self.chat_tabs.setMovable(True)
+        self.chat_tabs.tabCloseRequested.connect(self.close_chat_tab)
+        self.chat_tabs.currentChanged.connect(self.on_chat_tab_changed)
+        new_chat_btn = QToolButton()
+        new_chat_btn.setText("+")
+        new_chat_btn.setToolTip("新建对话 (New chat)")
+        new_chat_btn.setCursor(Qt.PointingHandCursor)
+        new_chat_btn.clicked.connect(self.new_chat_session)
+        self.chat_tabs.setCornerWidget(new_chat_btn, Qt.TopRightCorner)
+        result_layout.addWidget(self.chat_tabs)
+        self.chat_tabs.hide()
+        self.new_chat_session()
         
         # 添加布局
         main_layout.addWidget(control_panel)
@@ -931,21 +5248,23 @@ class MainWindow(QWidget):
                 "model": "Qwen/Qwen-Image",
                 "model_category": "image",
                 "resolution": "1024x1024 (1:1 方形)",
-                "prompt": ""
+                "prompt": "",
+                "image_cache_mb": DEFAULT_IMAGE_CACHE_MB,
+                "embed_metadata": False,
+                "result_cache_ttl_minutes": 0
             }
             # Save default config to create the file
             try:
-                with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-                    json.dump(default_config, f, indent=4, ensure_ascii=False)
+                atomic_write_json(CONFIG_FILE, default_config)
             except Exception as e:
-                print(f"Error creating default config: {e}")
+                log_error(f"Error creating default config: {e}")
             self.config = default_config
         else:
             try:
                 with open(CONFIG_FILE, "r", encoding="utf-8") as f:
                     self.config = json.load(f)
             except Exception as e:
-                print(f"Error loading config: {e}")
+                log_error(f"Error loading config: {e}")
                 self.config = {}
 
         # Apply config to UI
@@ -969,60 +5288,290 @@ class MainWindow(QWidget):
         if "prompt" in self.config:
             self.prompt_input.setPlainText(self.config["prompt"])
 
+        if "image_count" in self.config:
+            index = self.count_combo.findText(str(self.config["image_count"]))
+            if index >= 0:
+                self.count_combo.setCurrentIndex(index)
+
+        self.group_by_date_check.setChecked(bool(self.config.get("gallery_group_by_date", False)))
+        self.refresh_facet_combos()
+
+        IMAGE_CACHE.set_budget(int(self.config.get("image_cache_mb", DEFAULT_IMAGE_CACHE_MB)) * 1024 * 1024)
+        # 0 表示关闭结果缓存 (默认)；相同请求只在进行中时合并
+        GENERATION_COORDINATOR.cache_ttl = float(self.config.get("result_cache_ttl_minutes", 0)) * 60
+        if self.config.get("daemon_url"):
+            # 通过本机守护进程 (--daemon) 共享连接池、任务队列与限流
+            set_api_base(self.config["daemon_url"])
+            self.status_label.setText(f"就绪 (Ready) · 守护进程 (Daemon) {self.config['daemon_url']}")
+
+    @profiled_slot()
     def save_config(self):
         """Save current settings to config.json."""
+        # 保留界面上没有对应控件的设置项 (如 image_cache_mb)
         self.config = {
+            **getattr(self, "config", {}),
             "api_key": self.api_key_input.text().strip(),
             "model": self.model_combo.currentText(),
             "model_category": "image" if self.model_category_combo.currentIndex() == 0 else "chat",
             "resolution": self.resolution_combo.currentText(),
-            "prompt": self.prompt_input.toPlainText()
+            "image_count": int(self.count_combo.currentText()),
+            "prompt": self.prompt_input.toPlainText(),
+            "gallery_group_by_date": self.group_by_date_check.isChecked()
         }
         try:
-            with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-                json.dump(self.config, f, indent=4, ensure_ascii=False)
+            atomic_write_json(CONFIG_FILE, self.config)
         except Exception as e:
-            print(f"Error saving config: {e}")
+            log_error(f"Error saving config: {e}")
 
     def closeEvent(self, event):
         """Save config on app close."""
         self.save_config()
+        self.pipeline.shutdown()
+        IMAGE_CACHE.shutdown()
+        stop_workers() # 生成、对话与对比窗口中仍在运行的线程
+        if getattr(self, "retention_thread", None) is not None and self.retention_thread.isRunning():
+            self.retention_thread.stop()
+            self.retention_thread.wait()
         event.accept()
 
+    def on_pipeline_progress(self, stats):
+        if stats["backlog"]:
+            self.pipeline_label.setText(f"后台处理 (Post-processing): 积压 (Backlog) {stats['backlog']} · "
+                                        f"{stats['per_sec']:.1f}/s")
+            self.pipeline_label.show()
+        else:
+            self.pipeline_label.hide()
+
+    @profiled_slot()
     def load_history(self):
-        """Load images from the output directory on startup."""
-        if not os.path.exists(OUTPUT_DIR):
+        """Start watching OUTPUT_DIR; its first (background) pass loads the existing history."""
+        self.output_watcher = OutputDirWatcher(OUTPUT_DIR, self)
+        self.output_watcher.changes.connect(self.on_output_changes)
+        self.output_watcher.start()
+        # 保留策略：启动后稍等片刻再做第一次清理，之后定期执行
+        self.retention_thread = None
+        self.retention_timer = QTimer(self)
+        self.retention_timer.timeout.connect(self.run_retention)
+        minutes = float(self.config.get("retention_interval_minutes", DEFAULT_RETENTION_INTERVAL_MINUTES))
+        self.retention_timer.start(int(max(minutes, 1) * 60 * 1000))
+        QTimer.singleShot(30 * 1000, self.run_retention)
+
+    def run_retention(self):
+        policy = retention_policy(self.config)
+        if policy is None or (self.retention_thread is not None and self.retention_thread.isRunning()):
             return
-            
-        # Find all images
-        image_files = []
-        for ext in ["*.jpg", "*.jpeg", "*.png"]:
-            image_files.extend(glob.glob(os.path.join(OUTPUT_DIR, ext)))
-            
-        # Sort by modification time (newest first)
-        image_files.sort(key=os.path.getmtime, reverse=True)
-        
-        for img_path in image_files:
-            # Try to find corresponding JSON
-            json_path = img_path.rsplit('.', 1)[0] + ".json"
-            prompt = "Unknown (未知)"
-            model = "Unknown"
-            resolution = "Unknown"
-            
-            if os.path.exists(json_path):
-                try:
-                    with open(json_path, "r", encoding="utf-8") as f:
-                        metadata = json.load(f)
-                        prompt = metadata.get("prompt", prompt)
-                        model = metadata.get("model", model)
-                        resolution = metadata.get("resolution", resolution)
-                except Exception as e:
-                    print(f"Error reading JSON for {img_path}: {e}")
-            
-            # Create Card (Pass path instead of PIL Image to save memory on load)
-            card = ImageCard(img_path, img_path, prompt, model, resolution)
-            card.clicked.connect(self.show_detail_dialog)
-            self.gallery_layout.addWidget(card)
+        self.retention_thread = RetentionThread(OUTPUT_DIR, policy, FAVORITES.snapshot())
+        self.retention_thread.finished.connect(self.on_retention_finished)
+        self.retention_thread.start(QThread.LowestPriority)
+
+    def on_retention_finished(self, stats):
+        if stats["dry_run"] or not stats["removed"]:
+            return
+        action = "归档 (archived)" if stats["action"] == "archive" else "删除 (deleted)"
+        self.pipeline_label.setText(f"保留策略 (Retention): {action} {stats['removed']} 张, "
+                                    f"释放 {stats['freed_bytes'] / 1e6:.1f} MB")
+        self.pipeline_label.show()
+
+    def on_output_changes(self, added, removed, changed, initial):
+        if removed:
+            self.remove_gallery_paths(removed)
+            SIMILARITY_INDEX.remove(removed)
+        for record in changed:
+            card = self.cards_by_path.get(record["path"])
+            old = self.history_index.get(record["path"])
+            self.history_index[record["path"]] = record
+            if card is not None:
+                image_changed = old is not None and old.get("mtime") != record.get("mtime")
+                card.update_record(record, image_changed=image_changed)
+                if image_changed:
+                    self.gallery_layout.out_of_order = True # 修改时间变化后卡片可能换到别的日期
+                self.gallery_index.add(record)
+                card.setVisible(self.gallery_index.matches(record["path"], self.gallery_filters))
+                self.schedule_gallery_refresh()
+        added = [r for r in added if r["path"] not in self.cards_by_path]
+        # 本机历史图片视为当前密钥生成的结果 (缓存按密钥区分)
+        api_key = self.api_key_input.text().strip()
+        for r in added:
+            GENERATION_COORDINATOR.remember(r["model"], r["prompt"], r["resolution"], r["path"],
+                                            {"name": r.get("name"), "prompt": r["prompt"], "model": r["model"],
+                                             "resolution": r["resolution"]}, r.get("mtime"), api_key=api_key)
+        # 缺失或过期的派生图片与感知哈希在后台补齐
+        self.pipeline.submit([r["path"] for r in added + changed])
+        SIMILARITY_INDEX.submit([r["path"] for r in added + changed])
+        if initial:
+            # 首次运行时用已有图片的提示词初始化提示词历史
+            PROMPT_HISTORY.import_records(added)
+            self.pending_history.extend(added)
+            self.add_history_batch()
+        elif added:
+            was_idle = not self.pending_new
+            self.pending_new.extend(added)
+            if was_idle:
+                self.new_insert_pos = 0
+                self.add_new_batch()
+
+    def on_image_loaded(self, path, kind):
+        card = self.cards_by_path.get(path)
+        if card is not None and kind == "thumb":
+            card.on_image_loaded()
+
+    def create_gallery_card(self, record, thumbnail=None):
+        card = ImageCard(record["path"], record["prompt"], record["model"], record["resolution"], thumbnail,
+                         record.get("name"))
+        card.clicked.connect(self.show_detail_dialog)
+        card.select_requested.connect(self.on_card_select)
+        self.cards_by_path[record["path"]] = card
+        self.history_index[record["path"]] = record
+        self.gallery_index.add(record)
+        if not self.gallery_index.matches(record["path"], self.gallery_filters):
+            card.hide() # 不符合当前筛选：插入布局后保持隐藏
+        self.schedule_gallery_refresh()
+        return card
+
+    @profiled_slot()
+    def add_history_batch(self):
+        batch = self.pending_history[:HISTORY_BATCH_SIZE]
+        del self.pending_history[:HISTORY_BATCH_SIZE]
+        for record in batch:
+            if record["path"] not in self.cards_by_path:
+                self.gallery_layout.addWidget(self.create_gallery_card(record))
+        if self.pending_history:
+            # 让出事件循环，保持界面响应
+            QTimer.singleShot(0, self.add_history_batch)
+
+    @profiled_slot()
+    def add_new_batch(self):
+        """Insert images written by other processes at the top of the gallery, newest first, in batches."""
+        batch = self.pending_new[:HISTORY_BATCH_SIZE]
+        del self.pending_new[:HISTORY_BATCH_SIZE]
+        cards = [self.create_gallery_card(r) for r in batch if r["path"] not in self.cards_by_path]
+        self.gallery_layout.insertWidgets(self.new_insert_pos, cards)
+        self.new_insert_pos += len(cards)
+        if self.pending_new:
+            QTimer.singleShot(0, self.add_new_batch)
+
+    def remove_gallery_paths(self, paths):
+        paths = set(paths)
+        self.pending_history = [r for r in self.pending_history if r["path"] not in paths]
+        self.pending_new = [r for r in self.pending_new if r["path"] not in paths]
+        cards = [self.cards_by_path.pop(p) for p in paths if p in self.cards_by_path]
+        if self.selected_paths & paths:
+            self.selected_paths -= paths
+            self.update_selection_label()
+        for p in paths:
+            self.history_index.pop(p, None)
+            self.gallery_index.remove(p)
+        for p in paths:
+            IMAGE_CACHE.invalidate(p)
+        self.schedule_gallery_refresh()
+        if cards:
+            self.gallery_layout.removeWidgets(cards)
+            for card in cards:
+                card.hide()
+                card.deleteLater()
+
+    def schedule_gallery_refresh(self):
+        # 已在计时则不重新开始：连续添加历史卡片时仍每 100ms 刷新一次，而不是一直推迟
+        if not self.gallery_refresh_timer.isActive():
+            self.gallery_refresh_timer.start()
+
+    def on_facet_changed(self, facet):
+        self.gallery_filters[facet] = self.facet_combos[facet].currentData()
+        self.apply_gallery_filter()
+
+    def on_group_by_date_toggled(self, checked):
+        self.refresh_gallery_view()
+
+    @profiled_slot()
+    def apply_gallery_filter(self):
+        """Show only the cards matching the facet filters; cards are never rebuilt and only
+        those whose visibility changes are touched."""
+        visible = self.gallery_index.query(self.gallery_filters)
+        changed = [card for path, card in self.cards_by_path.items()
+                   if card.isHidden() == (visible is None or path in visible)]
+        if changed:
+            # 容器可见时每显示一张卡片都会重新布局整个画廊 (O(n²))；先隐藏容器，切换完再统一布局一次
+            self.gallery_container.hide()
+            for card in changed:
+                card.setVisible(card.isHidden())
+            self.gallery_container.show()
+        self.refresh_gallery_view()
+
+    def refresh_facet_combos(self):
+        """Rebuild the facet options with counts; each count respects the other facets' filters."""
+        counts = self.gallery_index.counts(self.gallery_filters)
+        orders = {
+            "tier": [tier for tier, _ in RESOLUTION_CATEGORIES],
+            "ratio": [it["ratio"] for it in RESOLUTION_CATEGORIES[0][1]],
+        }
+        titles = {"model": "全部模型 (All models)", "tier": "全部档位 (All tiers)", "ratio": "全部比例 (All ratios)"}
+        for facet, combo in self.facet_combos.items():
+            if combo.view().isVisible():
+                continue # 下拉列表展开时不重建，避免打断选择
+            selected = self.gallery_filters[facet]
+            facet_counts = dict(counts[facet])
+            if selected is not None:
+                facet_counts.setdefault(selected, 0)
+            order = orders.get(facet, [])
+            values = sorted(facet_counts, key=lambda v: (order.index(v) if v in order else len(order), v))
+            combo.clear()
+            combo.addItem(f"{titles[facet]} ({sum(counts[facet].values())})", None)
+            for value in values:
+                label = f"{value} {ratio_cn(value)}" if facet == "ratio" and value in order else value
+                combo.addItem(f"{label} ({facet_counts[value]})", value)
+            combo.setCurrentIndex(max(0, combo.findData(selected)) if selected is not None else 0)
+
+    def refresh_gallery_view(self):
+        """Facet counts, the match count and the date headers after filters or gallery contents changed."""
+        self.gallery_refresh_timer.stop()
+        self.refresh_facet_combos()
+        visible = self.gallery_index.query(self.gallery_filters)
+        total = len(self.cards_by_path)
+        if visible is None:
+            self.gallery_count_label.setText(f"{total} 张 (images)")
+        else:
+            self.gallery_count_label.setText(f"显示 {len(visible)} / {total} 张 (Showing)")
+        self.update_day_headers(visible)
+
+    def update_day_headers(self, visible):
+        grouped = self.group_by_date_check.isChecked()
+        days = self.gallery_index.day_counts(visible) if grouped else {}
+        stale = [self.day_headers.pop(day) for day in list(self.day_headers) if day not in days]
+        if stale:
+            self.gallery_layout.removeWidgets(stale)
+            for header in stale:
+                header.hide()
+                header.deleteLater()
+        new_headers = []
+        for day in days:
+            if day not in self.day_headers:
+                header = QLabel()
+                header.setProperty("fullRow", True) # FlowLayout 中独占一行
+                header.setStyleSheet("font-size: 14px; font-weight: bold; color: #2c3e50; border: none; "
+                                     "border-bottom: 1px solid #dfe6e9; padding: 4px 2px;")
+                header.day = day
+                self.day_headers[day] = header
+                new_headers.append(header)
+        if new_headers:
+            self.gallery_layout.insertWidgets(0, new_headers)
+        today = datetime.date.today()
+        for day, count in days.items():
+            header = self.day_headers[day]
+            header.setText(f"{day_title(day, today)}  ·  {count} 张")
+            header.show()
+        if grouped and self.gallery_layout.out_of_order:
+            # 只在插入打乱顺序后调整布局中条目的顺序：标题在前，同一天的卡片按时间从新到旧
+            self.gallery_layout.sortWidgets(self.gallery_sort_key)
+
+    def gallery_sort_key(self, widget):
+        if isinstance(widget, ImageCard):
+            record = self.history_index.get(widget.file_path)
+            if record is None:
+                return (0, 0, 0, 0) # 下载中的占位卡片在最前
+            mtime = record.get("mtime") or 0
+            day = self.gallery_index.day_of.get(widget.file_path)
+            return (1, -day.toordinal() if day else 0, 1, -mtime)
+        return (1, -widget.day.toordinal() if widget.day else 0, 0, 0)
 
     def toggle_api_visibility(self, checked):
         if checked:
@@ -1039,18 +5588,31 @@ class MainWindow(QWidget):
             self.model_combo.addItems(self.image_models)
             self.res_label.show()
             self.resolution_combo.show()
+            self.count_label.show()
+            self.count_combo.show()
             self.scroll_area.show()
-            self.chat_scroll_area.hide()
+            self.chat_tabs.hide()
+            self.duplicates_btn.show()
+            self.export_btn.show()
+            self.filter_bar.show()
             self.result_title.setText("生成记录 (Gallery)")
-            self.generate_btn.setText("生成图像 (Generate Image)")
+            # 对话会话仍在接收时按钮可能处于禁用状态；绘画模式只看图片生成线程
+            generating = self.generation_thread is not None and self.generation_thread.isRunning()
+            self.generate_btn.setEnabled(not generating)
+            self.generate_btn.setText("生成中... (Generating...)" if generating else "生成图像 (Generate Image)")
         else:
             self.model_combo.addItems(self.chat_models)
             self.res_label.hide()
             self.resolution_combo.hide()
+            self.count_label.hide()
+            self.count_combo.hide()
             self.scroll_area.hide()
-            self.chat_scroll_area.show()
+            self.chat_tabs.show()
+            self.duplicates_btn.hide()
+            self.export_btn.hide()
+            self.filter_bar.hide()
             self.result_title.setText("对话记录 (Chat)")
-            self.generate_btn.setText("发送消息 (Send Message)")
+            self.on_chat_tab_changed()
 
     def on_send_action(self):
         if self.model_category_combo.currentIndex() == 0:
@@ -1059,6 +5621,9 @@ class MainWindow(QWidget):
             self.start_chat()
 
     def start_chat(self):
+        session = self.chat_tabs.currentWidget()
+        if session is None or session.streaming:
+            return
         self.save_config()
         api_key = self.api_key_input.text().strip()
         model = self.model_combo.currentText()
@@ -1066,30 +5631,79 @@ class MainWindow(QWidget):
         if not content:
             QMessageBox.warning(self, "警告 (Warning)", "请输入消息 (Please enter a message).")
             return
-        self.ensure_system_prompt()
-        user_msg = {"role": "user", "content": content}
-        self.chat_messages.append(user_msg)
-        self.add_chat_message("用户", content)
+        PROMPT_HISTORY.submit(content, "chat")
+        session.send(api_key, model, content)
         self.prompt_input.clear()
         self.prompt_input.setFocus()
-        assistant_label = self.add_chat_message("助手", "")
-        self.current_assistant_label = assistant_label
-        self.current_assistant_acc = ""
-        self.generate_btn.setEnabled(False)
-        self.generate_btn.setText("发送中... (Sending...)")
-        self.status_label.setText("对话请求已发送... (Chat request sent...)")
-        self.chat_thread = ChatThread(api_key, model, self.chat_messages, stream=True)
-        self.chat_thread.finished.connect(self.on_chat_finished)
-        self.chat_thread.error.connect(self.on_chat_error)
-        self.chat_thread.delta.connect(self.on_chat_delta)
-        self.chat_thread.start()
-
-    def ensure_system_prompt(self):
-        if not self.chat_messages or self.chat_messages[0].get("role") != "system":
-            self.chat_messages.insert(0, {"role": "system", "content": SYSTEM_PROMPT_CN})
+
+    def new_chat_session(self):
+        self.chat_session_count += 1
+        session = ChatSession(f"对话 {self.chat_session_count} (Chat {self.chat_session_count})", self.avatar_pixmap)
+        session.model = self.model_combo.currentText() if self.model_category_combo.currentIndex() == 1 else None
+        session.state_changed.connect(self.on_chat_session_state)
+        self.chat_tabs.setCurrentIndex(self.chat_tabs.addTab(session, session.tab_text()))
+        return session
+
+    def close_chat_tab(self, index):
+        session = self.chat_tabs.widget(index)
+        self.chat_tabs.removeTab(index)
+        if session.streaming:
+            # 线程结束前不能释放；结束时 on_chat_session_state 再清理
+            self.closed_chat_sessions.add(session)
+        else:
+            session.deleteLater()
+        if self.chat_tabs.count() == 0:
+            self.new_chat_session()
+
+    def on_chat_tab_changed(self, index=None):
+        session = self.chat_tabs.currentWidget()
+        if session is None or self.model_category_combo.currentIndex() != 1:
+            return
+        if session.model:
+            index = self.model_combo.findText(session.model)
+            if index >= 0:
+                self.model_combo.setCurrentIndex(index)
+        self.chat_tabs.setTabText(self.chat_tabs.currentIndex(), session.tab_text())
+        self.update_chat_controls(session)
+
+    def on_chat_session_state(self, session):
+        index = self.chat_tabs.indexOf(session)
+        if index < 0:
+            if not session.streaming and session in self.closed_chat_sessions:
+                self.closed_chat_sessions.discard(session)
+                session.thread.wait()
+                session.deleteLater()
+            return
+        self.chat_tabs.setTabText(index, session.tab_text())
+        if session is self.chat_tabs.currentWidget() and self.model_category_combo.currentIndex() == 1:
+            self.update_chat_controls(session)
+            if session.error and not session.streaming:
+                QMessageBox.critical(self, "错误 (Error)", session.error)
+
+    def update_chat_controls(self, session):
+        """Send button and status line for the chat tab being shown."""
+        self.generate_btn.setEnabled(not session.streaming)
+        self.generate_btn.setText("发送中... (Sending...)" if session.streaming else "发送消息 (Send Message)")
+        if session.streaming:
+            self.status_label.setText(f"接收中... (Streaming) · {session.live_readout}" if session.live_readout
+                                      else "对话请求已发送... (Chat request sent...)")
+        elif session.error:
+            self.status_label.setText("发生错误 (Error Occurred)")
+        else:
+            self.status_label.setText(f"就绪 (Ready) · {session.readout}" if session.readout else "就绪 (Ready)")
 
     def eventFilter(self, source, event):
         try:
+            if source == self.prompt_completer.popup() and event.type() == QEvent.KeyPress:
+                # QCompleter 会先把按键交给 QTextEdit（插入换行）；在此之前处理确认键
+                if event.key() in (Qt.Key_Return, Qt.Key_Enter, Qt.Key_Tab):
+                    index = source.currentIndex()
+                    source.hide()
+                    if index.isValid():
+                        self.apply_prompt_suggestion(index.data())
+                    return True
+            if source == self.prompt_input and event.type() == QEvent.FocusIn:
+                self.warm_connection("focus")
             if source == self.prompt_input and event.type() == QEvent.KeyPress:
                 if event.key() in (Qt.Key_Return, Qt.Key_Enter):
                     is_chat = self.model_category_combo.currentIndex() == 1
@@ -1100,178 +5714,289 @@ class MainWindow(QWidget):
             pass
         return super().eventFilter(source, event)
 
-    def add_chat_message(self, author, text):
-        is_assistant = (author == "助手")
-        row = QWidget()
-        row_layout = QHBoxLayout(row)
-        row_layout.setContentsMargins(10, 6, 10, 6)
-        row_layout.setSpacing(8)
-
-        avatar_label = QLabel()
-        avatar_label.setFixedSize(36, 36)
-        if is_assistant and os.path.exists(AI_AVATAR_PATH):
-            pm = QPixmap(AI_AVATAR_PATH)
-        elif is_assistant and os.path.exists(ICON_PATH):
-            pm = QPixmap(ICON_PATH)
-        else:
-            pm = QPixmap(USER_AVATAR_PATH) if os.path.exists(USER_AVATAR_PATH) else QPixmap()
-        if not pm.isNull():
-            pm = pm.scaled(36, 36, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            avatar_label.setPixmap(pm)
-        avatar_label.setStyleSheet("border-radius:18px; background:#dfe7ef;")
-
-        bubble = QFrame()
-        bubble.setFrameShape(QFrame.NoFrame)
-        bubble.setLineWidth(0)
-        max_w = int(self.chat_scroll_area.viewport().width() * 0.6) if self.chat_scroll_area else 600
-        bubble_layout = QHBoxLayout(bubble)
-        bubble_layout.setContentsMargins(14, 10, 14, 10)
-        bubble_layout.setSpacing(8)
-
-        body = QLabel()
-        body.setWordWrap(True)
-        body.setTextFormat(Qt.RichText)
-        body.setOpenExternalLinks(True)
-        body.setText(self.render_markdown(text))
-        body.setStyleSheet("background: transparent; margin:0; padding:0;")
-        fm = body.fontMetrics()
-        calc_w = fm.horizontalAdvance(text) + 40
-        bubble_w = min(max_w, max(240, calc_w))
-        if is_assistant and (text is None or text == ""):
-            bubble_w = max_w
-        bubble.setFixedWidth(bubble_w)
-        bubble.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Minimum)
+    def prompt_kind(self):
+        return "image" if self.model_category_combo.currentIndex() == 0 else "chat"
 
-        shadow = QGraphicsDropShadowEffect()
-        shadow.setBlurRadius(8)
-        shadow.setOffset(0, 2)
-        shadow.setColor(QColor(0, 0, 0, 30))
-        bubble.setGraphicsEffect(shadow)
+    def on_prompt_text_changed(self):
+        if self.applying_suggestion or not self.prompt_input.hasFocus():
+            return
+        self.warm_connection("typing")
+        text = self.prompt_input.toPlainText()
+        if len(normalize_prompt(text)) < PROMPT_MIN_QUERY:
+            self.prompt_completer.popup().hide()
+            return
+        PROMPT_HISTORY.request(text, self.prompt_kind())
 
-        if is_assistant:
-            bubble.setStyleSheet("QFrame{background:#f1f3f6; border:1px solid #e1e5ea; border-radius:12px;} QLabel{color:#2c3e50; font-size:14px; background: transparent; border: none;}")
-            row_layout.setAlignment(Qt.AlignLeft)
-            row_layout.addWidget(avatar_label)
-            row_layout.setAlignment(avatar_label, Qt.AlignTop)
-            row_layout.addWidget(bubble)
-            row_layout.setAlignment(bubble, Qt.AlignTop)
-        else:
-            bubble.setStyleSheet("QFrame{background:#4e8df5; border:1px solid #4e8df5; border-radius:12px;} QLabel{color:#ffffff; font-size:14px;}")
-            row_layout.setAlignment(Qt.AlignRight)
-            row_layout.addWidget(bubble)
-            row_layout.setAlignment(bubble, Qt.AlignTop)
-            row_layout.addWidget(avatar_label)
-            row_layout.setAlignment(avatar_label, Qt.AlignTop)
+    def on_prompt_suggestions(self, query, suggestions):
+        # 用户继续输入后返回的旧结果直接丢弃
+        if query != self.prompt_input.toPlainText() or not self.prompt_input.hasFocus():
+            return
+        if not suggestions:
+            self.prompt_completer.popup().hide()
+            return
+        self.prompt_completer.model().setStringList(suggestions)
+        self.prompt_completer.complete()
 
-        bubble_layout.addWidget(body)
-        self.chat_layout.addWidget(row)
-        self.chat_scroll_area.verticalScrollBar().setValue(self.chat_scroll_area.verticalScrollBar().maximum())
-        return body
+    def apply_prompt_suggestion(self, text):
+        self.applying_suggestion = True
+        try:
+            self.prompt_input.setPlainText(text)
+            self.prompt_input.moveCursor(QTextCursor.End)
+        finally:
+            self.applying_suggestion = False
 
-    def on_chat_delta(self, delta_text):
-        if getattr(self, "current_assistant_label", None) is not None:
-            self.current_assistant_acc = getattr(self, "current_assistant_acc", "") + delta_text
-            self.current_assistant_label.setText(self.render_markdown(self.current_assistant_acc))
-            self.chat_scroll_area.verticalScrollBar().setValue(self.chat_scroll_area.verticalScrollBar().maximum())
+    def avatar_pixmap(self, is_assistant):
+        key = "assistant" if is_assistant else "user"
+        if key not in self.avatar_cache:
+            if is_assistant and os.path.exists(AI_AVATAR_PATH):
+                pm = QPixmap(AI_AVATAR_PATH)
+            elif is_assistant and os.path.exists(ICON_PATH):
+                pm = QPixmap(ICON_PATH)
+            elif not is_assistant and os.path.exists(USER_AVATAR_PATH):
+                pm = QPixmap(USER_AVATAR_PATH)
+            else:
+                pm = QPixmap()
+            if pm.isNull() and not is_assistant:
+                pm = fallback_avatar(36)
+            elif not pm.isNull():
+                pm = pm.scaled(36, 36, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            self.avatar_cache[key] = pm
+        return self.avatar_cache[key]
 
     def ensure_user_avatar(self):
-        try:
-            if not os.path.exists(USER_AVATAR_PATH):
-                url = "https://www.gravatar.com/avatar/00000000000000000000000000000000?d=mp&s=96"
-                r = requests.get(url, timeout=10)
-                if r.status_code == 200:
-                    with open(USER_AVATAR_PATH, "wb") as f:
-                        f.write(r.content)
-        except Exception:
-            pass
+        """Download the user avatar in the background if missing; the built-in fallback is used meanwhile."""
+        if os.path.exists(USER_AVATAR_PATH):
+            return
+        self.avatar_thread = AvatarDownloadThread()
+        self.avatar_thread.finished.connect(self.on_avatar_downloaded)
+        self.avatar_thread.start()
+
+    def on_avatar_downloaded(self, ok):
+        if ok:
+            self.avatar_cache.pop("user", None)
 
     def render_markdown(self, text):
-        s = text
-        s = html_lib.escape(s)
-        s = re.sub(r"```([\s\S]*?)```", lambda m: f"<pre style='background:#f6f8fa;border:1px solid #e1e4e8;border-radius:6px;padding:8px;white-space:pre-wrap;'>{m.group(1)}</pre>", s)
-        s = re.sub(r"`([^`]+)`", r"<code style='background:#f6f8fa;border:1px solid #e1e4e8;border-radius:4px;padding:2px 4px;'>\1</code>", s)
-        s = re.sub(r"\*\*([^*]+)\*\*", r"<b>\1</b>", s)
-        s = re.sub(r"_([^_]+)_", r"<i>\1</i>", s)
-        s = re.sub(r"\\\(([^)]*)\\\)", r"<i>\1</i>", s)
-        s = re.sub(r"\[([^\]]+)\]\((https?://[^)]+)\)", r"<a href='\2' style='color:#2d8cf0;text-decoration:none;'>\1</a>", s)
-        s = s.replace("\n", "<br/>")
-        return s
-
-    def on_chat_finished(self, assistant_text):
-        self.chat_messages.append({"role": "assistant", "content": assistant_text})
-        if getattr(self, "current_assistant_label", None) is not None:
-            self.current_assistant_label.setText(self.render_markdown(assistant_text))
-            self.current_assistant_acc = assistant_text
-            self.chat_scroll_area.verticalScrollBar().setValue(self.chat_scroll_area.verticalScrollBar().maximum())
-            self.current_assistant_label = None
-        else:
-            self.add_chat_message("助手", assistant_text)
-        self.generate_btn.setEnabled(True)
-        self.generate_btn.setText("发送消息 (Send Message)")
-        self.status_label.setText("就绪 (Ready)")
+        return render_markdown(text)
 
-    def on_chat_error(self, msg):
-        QMessageBox.critical(self, "错误 (Error)", msg)
-        self.generate_btn.setEnabled(True)
-        self.generate_btn.setText("发送消息 (Send Message)")
-        self.status_label.setText("发生错误 (Error Occurred)")
+    def selected_resolution(self):
+        """Resolution from the combo box text (e.g. "1024*1024 (1:1 Square)" -> "1024x1024"), or None after warning."""
+        resolution_text = self.resolution_combo.currentText()
+        if resolution_text.startswith("---"):
+            QMessageBox.warning(self, "警告 (Warning)", "请选择有效的分辨率 (Please select a valid resolution).")
+            return None
+        return resolution_text.split(' ')[0].replace("*", "x")
+
+    def open_compare_dialog(self):
+        self.save_config()
+        is_image = self.model_category_combo.currentIndex() == 0
+        prompt = self.prompt_input.toPlainText().strip()
+        if not prompt:
+            QMessageBox.warning(self, "警告 (Warning)", "请输入提示词 (Please enter a prompt).")
+            return
+        resolution = self.selected_resolution() if is_image else None
+        if is_image and resolution is None:
+            return
+        models = self.image_models if is_image else self.chat_models
+        self.compare_dialog = CompareDialog(self.api_key_input.text().strip(), is_image, models, prompt,
+                                            resolution, int(self.count_combo.currentText()),
+                                            bool(self.config.get("embed_metadata", False)), self)
+        self.compare_dialog.show()
 
     def start_generation(self):
         self.save_config() # Save config before generation
         api_key = self.api_key_input.text().strip()
         model = self.model_combo.currentText()
         prompt = self.prompt_input.toPlainText().strip()
-        # Parse resolution from combo box text (e.g., "1024*1024 (1:1 Square)" -> "1024x1024")
-        resolution_text = self.resolution_combo.currentText()
-        if resolution_text.startswith("---"):
-            QMessageBox.warning(self, "警告 (Warning)", "请选择有效的分辨率 (Please select a valid resolution).")
+        resolution = self.selected_resolution()
+        if resolution is None:
             return
-            
-        resolution = resolution_text.split(' ')[0].replace("*", "x")
         
         if not prompt:
             QMessageBox.warning(self, "警告 (Warning)", "请输入提示词 (Please enter a prompt).")
             return
 
+        PROMPT_HISTORY.submit(prompt, "image")
         self.generate_btn.setEnabled(False)
         self.generate_btn.setText("生成中... (Generating...)")
         self.status_label.setText("请求已发送，等待响应... (Request sent...)")
         
-        self.thread = ImageGeneratorThread(api_key, model, prompt, resolution)
-        self.thread.finished.connect(self.on_generation_finished)
-        self.thread.error.connect(self.on_generation_error)
-        self.thread.start()
+        self.generation_thread = ImageGeneratorThread(api_key, model, prompt, resolution,
+                                                      int(self.count_combo.currentText()),
+                                                      bool(self.config.get("embed_metadata", False)),
+                                                      bool(self.config.get("progressive_preview", True)))
+        self.generation_thread.finished.connect(self.on_generation_finished)
+        self.generation_thread.error.connect(self.on_generation_error)
+        self.generation_thread.preview.connect(self.on_generation_preview)
+        self.generation_thread.start()
+
+    def on_generation_preview(self, index, image, fraction):
+        """Show or refresh a placeholder card with the partially downloaded image."""
+        span = getattr(self.sender(), "span", None)
+        key = f"{PREVIEW_PATH_PREFIX}{span.record['job_id'] if span else ''}/{index}"
+        IMAGE_CACHE.put(key, "thumb", image)
+        card = self.preview_cards.get(key)
+        if card is None:
+            card = ImageCard(key, "", "", "", name="下载中... (Downloading...)")
+            card.setEnabled(False) # 占位卡片不响应点击与多选，下载完成后替换为正式卡片
+            # 多张输出按序号排列，与完成后插入的正式卡片顺序一致
+            position = len([k for k in self.preview_cards if int(k.rsplit("/", 1)[1]) < index])
+            self.gallery_layout.insertWidgets(position, [card])
+            self.preview_cards[key] = card
+            self.scroll_area.verticalScrollBar().setValue(0)
+        card.image_view.update()
+        if fraction:
+            self.status_label.setText(f"下载中... (Downloading... {fraction:.0%})")
 
-    def on_generation_finished(self, pil_image, file_path, metadata):
+    def drop_preview_cards(self, span):
+        prefix = f"{PREVIEW_PATH_PREFIX}{span.record['job_id'] if span else ''}/"
+        cards = [self.preview_cards.pop(k) for k in list(self.preview_cards) if k.startswith(prefix)]
+        if cards:
+            self.gallery_layout.removeWidgets(cards)
+            for card in cards:
+                IMAGE_CACHE.invalidate(card.file_path)
+                card.hide()
+                card.deleteLater()
+
+    @profiled_slot()
+    def on_generation_finished(self, results):
+        span = getattr(self.sender(), "span", None)
+        if span is not None:
+            span.set("signal_ms", span.since("emitted"))
         self.status_label.setText("生成成功! (Success!)")
         self.generate_btn.setEnabled(True)
         self.generate_btn.setText("生成图像 (Generate Image)")
         
-        prompt = metadata.get("prompt", "")
-        model = metadata.get("model", "")
-        resolution = metadata.get("resolution", "")
-        
-        # Create Image Card
-        card = ImageCard(pil_image, file_path, prompt, model, resolution)
-        card.clicked.connect(self.show_detail_dialog)
+        # Create Image Cards (同一任务的多张图片作为一组插入到顶部，替换下载中的占位卡片)
+        t_card = time.perf_counter()
+        self.drop_preview_cards(span)
+        cards = []
+        for thumbnail, file_path, metadata in results:
+            record = {"path": file_path, "name": metadata.get("name"), "prompt": metadata.get("prompt", ""),
+                      "model": metadata.get("model", ""),
+                      "resolution": metadata.get("resolution", ""),
+                      "mtime": os.path.getmtime(file_path) if os.path.exists(file_path) else None}
+            existing = self.cards_by_path.get(file_path)
+            if existing is not None:
+                # 目录监视已先一步添加了这张图片
+                self.gallery_layout.removeWidgets([existing])
+                existing.deleteLater()
+            cards.append(self.create_gallery_card(record, thumbnail))
         
         # Insert at top using the new helper method
-        self.gallery_layout.insertWidget(0, card)
+        self.gallery_layout.insertWidgets(0, cards)
+        self.pipeline.submit([card.file_path for card in cards])
+        SIMILARITY_INDEX.submit([card.file_path for card in cards])
         
         # Scroll to top
         self.scroll_area.verticalScrollBar().setValue(0)
 
-    def show_detail_dialog(self, image_source, file_path, prompt, model, resolution):
-        dialog = DetailDialog(image_source, file_path, prompt, model, resolution, self)
+        if span is not None:
+            span.set("card_ms", round((time.perf_counter() - t_card) * 1000, 1))
+            # 下一轮事件循环时卡片已完成布局与绘制，此时记录"出现在画廊"的时间
+            QTimer.singleShot(0, lambda: self.finish_generation_span(span))
+
+    def finish_generation_span(self, span):
+        span.set("time_to_card_ms", span.since(None))
+        span.finish("ok")
+        count = span.record.get("images", 1)
+        suffix = f", {count} 张 (images)" if count > 1 else ""
+        source = span.record.get("source", "remote")
+        if source == "cached":
+            # 明确标注：结果来自历史图片，没有发出新的请求
+            self.status_label.setText(f"缓存 (Cached): 使用 {self.config.get('result_cache_ttl_minutes')} 分钟内的相同请求结果")
+        elif source == "coalesced":
+            self.status_label.setText(f"生成成功! (与进行中的相同请求合并 Coalesced, {span.record['time_to_card_ms'] / 1000:.1f}s{suffix})")
+        else:
+            self.status_label.setText(f"生成成功! (Success! {span.record['time_to_card_ms'] / 1000:.1f}s{suffix})")
+
+    def gallery_records(self):
+        """Records of the visible gallery cards, in display order."""
+        records = []
+        for i in range(self.gallery_layout.count()):
+            card = self.gallery_layout.itemAt(i).widget()
+            if isinstance(card, ImageCard) and not card.isHidden() and not card.file_path.startswith(PREVIEW_PATH_PREFIX):
+                records.append(self.history_index.get(card.file_path) or
+                               {"path": card.file_path, "prompt": card.prompt, "model": card.model,
+                                "resolution": card.resolution})
+        return records
+
+    def on_card_select(self, path, extend):
+        if extend and self.selection_anchor in self.cards_by_path:
+            # Shift：选中锚点到当前卡片之间的所有可见卡片
+            paths = [r["path"] for r in self.gallery_records()]
+            if path in paths and self.selection_anchor in paths:
+                a, b = sorted((paths.index(self.selection_anchor), paths.index(path)))
+                for p in paths[a:b + 1]:
+                    self.selected_paths.add(p)
+                    self.cards_by_path[p].set_selected(True)
+        else:
+            selected = path not in self.selected_paths
+            if selected:
+                self.selected_paths.add(path)
+            else:
+                self.selected_paths.discard(path)
+            self.cards_by_path[path].set_selected(selected)
+            self.selection_anchor = path
+        self.update_selection_label()
+
+    def clear_selection(self):
+        for path in self.selected_paths:
+            card = self.cards_by_path.get(path)
+            if card is not None:
+                card.set_selected(False)
+        self.selected_paths.clear()
+        self.selection_anchor = None
+        self.update_selection_label()
+
+    def update_selection_label(self):
+        count = len(self.selected_paths)
+        self.export_btn.setText(f"导出所选 (Export {count})" if count else "导出 (Export)")
+
+    def open_export_dialog(self):
+        records = sorted(self.history_index.values(), key=lambda r: r.get("mtime") or 0, reverse=True)
+        ExportDialog(records, set(self.selected_paths), self).exec()
+
+    def open_duplicates_dialog(self):
+        max_distance = int(self.config.get("duplicate_max_distance", DUPLICATE_MAX_DISTANCE))
+        DuplicatesDialog(dict(self.history_index), max_distance, self).exec()
+
+    def show_detail_dialog(self, file_path, prompt, model, resolution):
+        records = self.gallery_records()
+        index = next((i for i, r in enumerate(records) if r["path"] == file_path), None)
+        if index is None:
+            records, index = [{"path": file_path, "prompt": prompt, "model": model, "resolution": resolution}], 0
+        dialog = DetailDialog(records, index, self)
         dialog.exec()
 
     def on_generation_error(self, error_msg):
+        self.drop_preview_cards(getattr(self.sender(), "span", None))
         self.status_label.setText("发生错误 (Error Occurred)")
         self.generate_btn.setEnabled(True)
         self.generate_btn.setText("生成图像 (Generate Image)")
         QMessageBox.critical(self, "错误 (Error)", error_msg)
 
 if __name__ == "__main__":
+    if not getattr(sys, "frozen", False):
+        # spawn 的子进程默认会以 __mp_main__ 重新执行本文件（导入 Qt、创建目录与全局索引）；
+        # 改为执行不依赖 Qt 的 zimage_derivatives，派生图片只需要它
+        import importlib.util
+        __spec__ = importlib.util.find_spec("zimage_derivatives")
+    if "--metrics-summary" in sys.argv:
+        print_metrics_summary()
+        sys.exit(0)
+    if "--daemon" in sys.argv:
+        run_daemon(cli_option("--host", DAEMON_HOST), int(cli_option("--port", DAEMON_PORT)))
+        sys.exit(0)
+    if "--retention-dry-run" in sys.argv:
+        print_retention_report()
+        sys.exit(0)
+    if "--duplicates" in sys.argv:
+        value = cli_option("--duplicates")
+        print_duplicate_report(int(value) if value and value.isdigit() else DUPLICATE_MAX_DISTANCE)
+        sys.exit(0)
+    if "--offscreen" in sys.argv:
+        # 无界面运行 (CI / 服务器上做性能诊断)
+        os.environ["QT_QPA_PLATFORM"] = "offscreen"
     try:
         QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
         QApplication.setAttribute(Qt.AA_UseHighDpiPixmaps, True)
@@ -1284,6 +6009,16 @@ if __name__ == "__main__":
             app.setWindowIcon(QIcon(ICON_PATH))
     except Exception:
         pass
+    if PROFILE_ENABLED:
+        install_profiling(app)
+    app.aboutToQuit.connect(IMAGE_CACHE.shutdown) # 未经 closeEvent 退出时也停止解码线程
+    app.aboutToQuit.connect(stop_workers)
     window = MainWindow()
     window.show()
+    if cli_option("--profile-seconds"):
+        # 经 closeEvent 退出：保存配置并关闭后台进程池，之后再结束事件循环
+        def close_and_quit():
+            window.close()
+            app.quit()
+        QTimer.singleShot(int(float(cli_option("--profile-seconds")) * 1000), close_and_quit)
     sys.exit(app.exec())